@@ -0,0 +1,152 @@
+import argparse, logging, os, sys, json, time, resource, subprocess, tempfile, itertools
+import numpy as np
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark and parity check of the MD-LSTM engines')
+    parser.add_argument('-e', '--engines', help='comma separated engines to run, the first one is the reference '
+                                                'of the parity check', type=str, default='while_loop,static,wavefront')
+    parser.add_argument('-g', '--grids', help='comma separated HxW sizes of the input', type=str, default='5x10,10x100')
+    parser.add_argument('-b', '--batch_sizes', help='comma separated batch sizes', type=str, default='32')
+    parser.add_argument('-n', '--rnn_sizes', help='comma separated hidden sizes', type=str, default='50')
+    parser.add_argument('-d', '--data', help='data type', type=str, default='ir')
+    parser.add_argument('-f', '--feature', help='ir feature used to generate match matrix (read by ir_match_matrix)',
+                        type=str, default='tf_proximity')
+    parser.add_argument('-w', '--windows', help='comma separated HxW window sizes sh', type=str, default='1x1')
+    parser.add_argument('-r', '--repeat', help='how many timed runs (after one warm up run)', type=int, default=5)
+    parser.add_argument('-t', '--tolerance', help='max absolute difference of the parity check', type=float,
+                        default=1e-4)
+    parser.add_argument('-o', '--output', help='path of the json report', type=str, default='bench.json')
+    parser.add_argument('--single', help=argparse.SUPPRESS, type=str, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+SEED = 2018
+
+
+def build_engine(engine, rnn_size, x, sh):
+    """returns the output of the MD-LSTM engine on x, all the engines create the same variables"""
+    from md_lstm import multi_dimensional_rnn_while_loop, multi_dimensional_rnn_static, \
+        multi_dimensional_rnn_wavefront, multi_dimensional_rnn_native
+    engines = {
+        'while_loop': multi_dimensional_rnn_while_loop,
+        'static': multi_dimensional_rnn_static,
+        'wavefront': multi_dimensional_rnn_wavefront,
+        'native': multi_dimensional_rnn_native,
+    }
+    if engine not in engines:
+        raise Exception('not supported engine (should be one of {}).'.format(', '.join(sorted(engines))))
+    y, _ = engines[engine](rnn_size=rnn_size, input_data=x, sh=sh)
+    return y
+
+
+def run_single(config):
+    """Times one engine on one configuration in this process and saves its outputs and
+    gradients to config['dump'] for the parity check"""
+    import tensorflow as tf
+    from data_gen import next_batch
+    np.random.seed(SEED)
+    bs, (h, w), rnn_size, sh = config['batch_size'], config['grid'], config['rnn_size'], config['sh']
+    if config['data'] == 'gau':
+        batch = next_batch(config['data'], bs, h, w, False)
+    else:
+        batch = next_batch(config['data'], bs, h, w, mean_match_query_term=3,
+                           mean_match_doc_term=max(1, int(5 * h / 3)), dist='binomial')
+    batch_x = np.expand_dims(batch[0], axis=3).astype(np.float32)
+
+    x = tf.placeholder(tf.float32, [None, h, w, 1])
+    st = time.time()
+    y = build_engine(config['engine'], rnn_size, x, sh)
+    variables = sorted(tf.trainable_variables(), key=lambda v: v.name)
+    grads = tf.gradients(tf.reduce_sum(tf.square(y)), variables)
+    build_time = time.time() - st
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        # the same weights for all the engines, whatever their graph
+        rng = np.random.RandomState(SEED)
+        for v in variables:
+            v.load(rng.uniform(-0.1, 0.1, v.get_shape().as_list()).astype(np.float32), sess)
+
+        def timeit(fetches):
+            out = sess.run(fetches, feed_dict={x: batch_x})
+            st = time.time()
+            for i in range(config['repeat']):
+                sess.run(fetches, feed_dict={x: batch_x})
+            return out, (time.time() - st) / config['repeat']
+
+        _, fwd_time = timeit(y)
+        out, fwd_bwd_time = timeit([y] + grads)
+    np.savez(config['dump'], y=out[0], **{v.name: g for v, g in zip(variables, out[1:])})
+
+    cells = bs * (-(-h // sh[0])) * (-(-w // sh[1]))
+    return {
+        'build_sec': build_time,
+        'fwd_sec': fwd_time,
+        'fwd_bwd_sec': fwd_bwd_time,
+        'fwd_cells_per_sec': cells / fwd_time,
+        'fwd_bwd_cells_per_sec': cells / fwd_bwd_time,
+        'fwd_samples_per_sec': bs / fwd_time,
+        'fwd_bwd_samples_per_sec': bs / fwd_bwd_time,
+        # ru_maxrss is in KB on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def parity(ref_path, path):
+    """max absolute difference of the outputs and the gradients of two dumps"""
+    with np.load(ref_path) as ref, np.load(path) as other:
+        return {k: float(np.max(np.abs(ref[k] - other[k]))) for k in ref.keys()}
+
+
+def bench(args):
+    def pairs(s):
+        return [tuple(int(v) for v in p.split('x')) for p in s.split(',')]
+    engines = args.engines.split(',')
+    report = []
+    dump_dir = tempfile.mkdtemp()
+    for grid, bs, rnn_size, sh in itertools.product(pairs(args.grids), [int(b) for b in args.batch_sizes.split(',')],
+                                                    [int(n) for n in args.rnn_sizes.split(',')], pairs(args.windows)):
+        config = {'grid': grid, 'batch_size': bs, 'rnn_size': rnn_size, 'sh': sh, 'repeat': args.repeat,
+                  'data': args.data}
+        result = dict(config, engines={})
+        for engine in engines:
+            logging.info('bench {} {}'.format(engine, config))
+            dump = os.path.join(dump_dir, '{}.npz'.format(engine))
+            # one process per engine so that its peak memory is its own
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '-f', args.feature, '--single',
+                                   json.dumps(dict(config, engine=engine, dump=dump))],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode != 0:
+                logging.warning('{} failed: {}'.format(engine, proc.stderr.strip().split('\n')[-1]))
+                result['engines'][engine] = {'error': proc.stderr.strip().split('\n')[-1]}
+                continue
+            result['engines'][engine] = json.loads(proc.stdout.strip().split('\n')[-1])
+            ref_dump = os.path.join(dump_dir, '{}.npz'.format(engines[0]))
+            if engine != engines[0] and os.path.exists(ref_dump):
+                diff = parity(ref_dump, dump)
+                result['engines'][engine]['max_abs_diff'] = max(diff.values())
+                result['engines'][engine]['parity'] = max(diff.values()) <= args.tolerance
+                if not result['engines'][engine]['parity']:
+                    logging.warning('{} differs from {}: {}'.format(engine, engines[0], diff))
+        for f in os.listdir(dump_dir):
+            os.remove(os.path.join(dump_dir, f))
+        report.append(result)
+        for engine, r in result['engines'].items():
+            if 'error' not in r:
+                logging.info('{:>10} fwd {:.3f}s ({:.0f} cells/s) fwd+bwd {:.3f}s ({:.0f} cells/s) rss {:.0f}MB'.format(
+                    engine, r['fwd_sec'], r['fwd_cells_per_sec'], r['fwd_bwd_sec'], r['fwd_bwd_cells_per_sec'],
+                    r['peak_rss_mb']))
+    os.rmdir(dump_dir)
+    with open(args.output, 'w') as fout:
+        json.dump(report, fout, indent=2)
+    logging.info('report written to "{}"'.format(args.output))
+    return report
+
+
+if __name__ == '__main__':
+    if args.single:
+        print(json.dumps(run_single(json.loads(args.single))))
+    else:
+        report = bench(args)
+        if not all(r.get('parity', True) for result in report for r in result['engines'].values()):
+            sys.exit(1)
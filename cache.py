@@ -0,0 +1,151 @@
+import os, json
+from collections import OrderedDict
+import numpy as np
+
+
+class MatchMatrixCache(object):
+    '''
+    On-disk cache of the match matrices keyed by (qid, docid). Matrices of shape (d_len, q_len) are
+    appended to "path.data" as float32 and read back through a memory map. "path.index" holds one
+    "qid docid offset d_len q_len" line per matrix, so the cache survives across runs. It is only
+    valid when the match matrix of a pair never changes, i.e., the word vectors are not trained.
+    config (interaction, word vectors, max lengths, ...) is written as the first line of the index and
+    a cache built with another config is refused.
+    '''
+    def __init__(self, path, config=None):
+        self.data_path = path + '.data'
+        self.index_path = path + '.index'
+        self.index = {}
+        header = '#config\t{}\n'.format(json.dumps(config, sort_keys=True))
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as fin:
+                if fin.readline() != header:
+                    raise ValueError('match cache "{}" was built with a config other than {}'
+                                     .format(path, header.rstrip('\n').split('\t')[1]))
+                for l in fin:
+                    qid, docid, offset, d_len, q_len = l.rstrip('\n').split('\t')
+                    # a later line of the same pair replaces the earlier one
+                    self.index[(qid, docid)] = (int(offset), int(d_len), int(q_len))
+        else:
+            with open(self.index_path, 'w') as fout:
+                fout.write(header)
+        self.size = os.path.getsize(self.data_path) // 4 if os.path.exists(self.data_path) else 0
+        self.data = None
+        self.hit = 0
+        self.miss = 0
+
+
+    def __contains__(self, key):
+        return key in self.index
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def get(self, qid, docid):
+        offset, d_len, q_len = self.index[(qid, docid)]
+        if self.data is None or len(self.data) < offset + d_len * q_len:
+            # remap after new matrices are appended
+            self.data = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(self.size,))
+        return self.data[offset:offset + d_len * q_len].reshape([d_len, q_len])
+
+
+    def put(self, qid, docid, matrix):
+        if (qid, docid) in self.index and self.index[(qid, docid)][1:] == matrix.shape:
+            return
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        with open(self.data_path, 'ab') as fout:
+            fout.write(matrix.tobytes())
+        with open(self.index_path, 'a') as fout:
+            fout.write('{}\t{}\t{}\t{}\t{}\n'.format(qid, docid, self.size, matrix.shape[0], matrix.shape[1]))
+        self.index[(qid, docid)] = (self.size, matrix.shape[0], matrix.shape[1])
+        self.size += matrix.size
+
+
+    def get_batch(self, fd):
+        '''
+        match matrices (batch_size, max_d_len, max_q_len) of a batch from the batcher padded with zeros,
+        None if any pair of the batch is not cached or is cached with other lengths
+        '''
+        keys = list(zip(fd['qid'], fd['docid']))
+        if not all(k in self.index and self.index[k][1:] == (d_len, q_len)
+                   for k, (q_len, d_len) in zip(keys, fd['qd_size'].tolist())):
+            self.miss += len(keys)
+            return None
+        self.hit += len(keys)
+        batch = np.zeros([len(keys), fd['doc'].shape[1], fd['query'].shape[1]], dtype=np.float32)
+        for b, (qid, docid) in enumerate(keys):
+            matrix = self.get(qid, docid)
+            batch[b, :matrix.shape[0], :matrix.shape[1]] = matrix
+        return batch
+
+
+    def put_batch(self, fd, match_matrix):
+        '''
+        save the match matrices (batch_size, max_d_len, max_q_len) of a batch from the batcher
+        '''
+        for b, (qid, docid) in enumerate(zip(fd['qid'], fd['docid'])):
+            q_len, d_len = fd['qd_size'][b]
+            self.put(qid, docid, match_matrix[b, :d_len, :q_len])
+
+
+    def hit_rate(self):
+        return self.hit / max(self.hit + self.miss, 1)
+
+
+class DocReprCache(object):
+    '''
+    In-memory cache of the pooled doc CNN representations keyed by the doc region (docid, start, offset),
+    the least recently used regions are evicted beyond capacity. A representation is only valid while
+    the CNN weights are frozen, so lookups miss and nothing is saved unless the cache is enabled
+    (when scoring), and it is cleared before the weights are updated.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.enabled = False
+        self.hit = 0
+        self.miss = 0
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def clear(self):
+        self.items.clear()
+
+
+    def lookup(self, docid, start, offset, shape):
+        '''
+        the hit mask (batch_size,) of the regions and the representations (num_hit, *shape) of the hits
+        '''
+        hit = np.zeros([len(docid)], dtype=bool)
+        reprs = []
+        if self.enabled:
+            for b, key in enumerate(zip(docid, start.tolist(), offset.tolist())):
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    hit[b] = True
+                    reprs.append(self.items[key])
+            self.hit += len(reprs)
+            self.miss += len(docid) - len(reprs)
+        return hit, np.array(reprs, dtype=np.float32).reshape([len(reprs)] + shape.tolist())
+
+
+    def store(self, docid, start, offset, reprs):
+        '''
+        save the representations (batch_size, *shape) of the regions
+        '''
+        if self.enabled:
+            for key, r in zip(zip(docid, start.tolist(), offset.tolist()), reprs):
+                self.items[key] = r.copy()
+                self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+        return np.array(self.enabled)
+
+
+    def hit_rate(self):
+        return self.hit / max(self.hit + self.miss, 1)
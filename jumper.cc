@@ -36,7 +36,7 @@ REGISTER_OP("MinDensity")
   });
 
 REGISTER_OP("MinDensityMultiCpu")
-  .Input("match_matrix: float")
+  .Input("density: float")
   .Input("dq_size: int32")
   .Input("location: float")
   .Input("min_density: float")
@@ -49,7 +49,7 @@ REGISTER_OP("MinDensityMultiCpu")
     ::tensorflow::shape_inference::ShapeHandle input1;
     ::tensorflow::shape_inference::ShapeHandle input2;
     ::tensorflow::shape_inference::ShapeHandle input3;
-    TF_RETURN_IF_ERROR(c->WithRank(c->input(0), 3, &input0));
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(0), 2, &input0));
     TF_RETURN_IF_ERROR(c->WithRank(c->input(1), 2, &input1));
     TF_RETURN_IF_ERROR(c->WithRank(c->input(2), 2, &input2));
     TF_RETURN_IF_ERROR(c->WithRank(c->input(3), 1, &input3));
@@ -57,6 +57,47 @@ REGISTER_OP("MinDensityMultiCpu")
     return Status::OK();
   });
 
+REGISTER_OP("MinDensityTrajectory")
+  .Input("density: float")
+  .Input("dq_size: int32")
+  .Input("min_density: float")
+  .Input("min_jump_offset: int32")
+  .Input("max_jump_offset: float")
+  .Input("max_jump_step: int32")
+  .Output("location: float")
+  .Output("step: int32")
+  .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
+    ::tensorflow::shape_inference::ShapeHandle input0;
+    ::tensorflow::shape_inference::ShapeHandle input1;
+    ::tensorflow::shape_inference::ShapeHandle input2;
+    ::tensorflow::shape_inference::DimensionHandle max_jump_step;
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(0), 2, &input0));
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(1), 2, &input1));
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(2), 1, &input2));
+    TF_RETURN_IF_ERROR(c->MakeDimForScalarInput(5, &max_jump_step));
+    c->set_output(0, c->MakeShape({c->Dim(c->input(0), 0), max_jump_step, 4}));
+    c->set_output(1, c->Vector(c->Dim(c->input(0), 0)));
+    return Status::OK();
+  });
+
+REGISTER_OP("IndicatorMatch")
+  .Input("query: int32")
+  .Input("doc: int32")
+  .Input("dq_size: int32")
+  .Output("indices: int64")
+  .Output("row_splits: int64")
+  .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
+    ::tensorflow::shape_inference::ShapeHandle input0;
+    ::tensorflow::shape_inference::ShapeHandle input1;
+    ::tensorflow::shape_inference::ShapeHandle input2;
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(0), 2, &input0));
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(1), 2, &input1));
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(2), 2, &input2));
+    c->set_output(0, c->Matrix(c->UnknownDim(), 3));
+    c->set_output(1, c->Vector(c->UnknownDim()));
+    return Status::OK();
+  });
+
 class ZeroOutOp : public OpKernel {
  public:
   explicit ZeroOutOp(OpKernelConstruction* context) : OpKernel(context) {}
@@ -228,13 +269,90 @@ class MinDensityOp : public OpKernel {
     }
 };
 
+// find the first region that are qualified (denser that min_density_value) in rows
+// [d_start, d_start + d_offset) of sample b, where row_density(b, i) is the maximal similarity
+// of doc position i among all positions considered in a query (see row_max_density in rri.py).
+// density, density_per and density_offset are buffers of at least d_offset elements.
+// max_end is -1 if there is no qualified region.
+static void MinDensityRegion(typename TTypes<float, 2>::ConstTensor row_density, int64 b,
+  int64 d_start, int64 d_offset, float min_density_value, int32 min_jump_offset, bool only_one,
+  float* density, float* density_per, int* density_offset, int64* max_end, int64* max_offset) {
+  *max_end = -1;
+  *max_offset = -1;
+  for (int64 i = 0; i < d_offset; i++) {
+    float cur_density = row_density(b, i + d_start);
+    density_per[i] = cur_density;
+    if (i == 0 || density_offset[i-1] <= 0) {
+      // the first position or all the previous ones are not qualified
+      if (cur_density < min_density_value) {
+        density[i] = cur_density;
+        density_offset[i] = 0;
+      } else {
+        // find max qualified region
+        float new_density = 0;
+        for (int64 o = 0; o <= i; o++) {
+          new_density = (density_per[i-o] + o * new_density) / (o + 1);
+          if (new_density >= min_density_value) {
+            density[i] = new_density;
+            density_offset[i] = o + 1;
+          }
+        }
+      }
+    } else {
+      // previous position is qualified
+      if (cur_density == min_density_value) {
+        // enlarge previous region by 1
+        density_offset[i] = density_offset[i-1] + 1;
+        density[i] = (density[i-1] * density_offset[i-1] + cur_density) / density_offset[i];
+      } else if (cur_density < min_density_value) {
+        // no larger region
+        float new_density = (density[i-1] * density_offset[i-1] + cur_density) / (density_offset[i-1] + 1);
+        density[i] = cur_density;
+        density_offset[i] = 0;
+        for (int64 o = i - density_offset[i-1]; o <= i - 1; o++) {
+          if (new_density >= min_density_value) {
+            density[i] = new_density;
+            density_offset[i] = 1 + i - o;
+            break;
+          }
+          new_density = (new_density * (1 + i - o) - density_per[o]) / (i - o);
+        }
+      } else {
+        // no smaller region
+        float new_density = 0;
+        density_offset[i] = density_offset[i-1] + 1;
+        density[i] = (density[i-1] * density_offset[i-1] + cur_density) / density_offset[i];
+        new_density = density[i];
+        for (int64 o = i - density_offset[i-1] - 1; o >= 0; o--) {
+          new_density = (density_per[o] + new_density * (i - o)) / (1 + i - o);
+          if (new_density >= min_density_value) {
+            density[i] = new_density;
+            density_offset[i] = 1 + i - o;
+          }
+        }
+      }
+    }
+    // terminate or continue
+    // regions smaller than min_jump_offset is not qualified
+    if (density_offset[i] == 0 && *max_end != -1) break;
+    else if (density_offset[i] > 0 && density_offset[i] >= min_jump_offset && density_offset[i] > *max_offset) {
+      *max_end = i;
+      *max_offset = density_offset[i];
+      if (only_one) {
+        *max_offset = 1;
+        break;
+      }
+    }
+  }
+}
+
 // find the first region that are qualified (denser that min_density)
 class MinDensityMultiCpuOp : public OpKernel {
   public:
     explicit MinDensityMultiCpuOp(OpKernelConstruction* context) : OpKernel(context) {}
 
     static void OneTask(int64 start, int64 limit, OpKernelContext* context,
-      typename TTypes<float, 3>::ConstTensor match_matrix, typename TTypes<int32, 2>::ConstTensor dq_size,
+      typename TTypes<float, 2>::ConstTensor row_density, typename TTypes<int32, 2>::ConstTensor dq_size,
       typename TTypes<float, 2>::ConstTensor location, typename TTypes<float, 1>::ConstTensor min_density, 
       int32 min_jump_offset, bool use_ratio, bool only_one, typename TTypes<float, 2>::Tensor next_location) {
       for (int64 b = start; b < limit; b++) {
@@ -267,11 +385,7 @@ class MinDensityMultiCpuOp : public OpKernel {
         float min_density_value = 0;
         if (use_ratio) {
           for (int64 i = 0; i < d_offset; i++) {
-            float cur_density = std::numeric_limits<float>::min();
-            // find the maximal similarity among all positions considered in a query
-            for (int64 j = q_start; j < q_start + q_offset; j++) {
-              if (match_matrix(b, i + d_start, j) > cur_density) cur_density = match_matrix(b, i + d_start, j);
-            }
+            float cur_density = row_density(b, i + d_start);
             density_per[i] = cur_density;
             mean_density += cur_density;
             // max_density with length not smaller than min_jump_offset
@@ -289,75 +403,8 @@ class MinDensityMultiCpuOp : public OpKernel {
           min_density_value = min_density(b);
         }
         //std::cout << "min_density: " << min_density_value << std::endl;
-        for (int64 i = 0; i < d_offset; i++) {
-          float cur_density = std::numeric_limits<float>::min();
-          // find the maximal similarity among all positions considered in a query
-          for (int64 j = q_start; j < q_start + q_offset; j++) {
-            if (match_matrix(b, i + d_start, j) > cur_density) cur_density = match_matrix(b, i + d_start, j);
-          }
-          density_per[i] = cur_density;
-          if (i == 0 || density_offset[i-1] <= 0) {
-            // the first position or all the previous ones are not qualified
-            if (cur_density < min_density_value) {
-              density[i] = cur_density;
-              density_offset[i] = 0;
-            } else {
-              // find max qualified region
-              float new_density = 0;
-              for (int64 o = 0; o <= i; o++) {
-                new_density = (density_per[i-o] + o * new_density) / (o + 1);
-                if (new_density >= min_density_value) {
-                  density[i] = new_density;
-                  density_offset[i] = o + 1;
-                }
-              }
-            }
-          } else {
-            // previous position is qualified
-            if (cur_density == min_density_value) {
-              // enlarge previous region by 1
-              density_offset[i] = density_offset[i-1] + 1;
-              density[i] = (density[i-1] * density_offset[i-1] + cur_density) / density_offset[i];
-            } else if (cur_density < min_density_value) {
-              // no larger region
-              float new_density = (density[i-1] * density_offset[i-1] + cur_density) / (density_offset[i-1] + 1);
-              density[i] = cur_density;
-              density_offset[i] = 0;
-              for (int64 o = i - density_offset[i-1]; o <= i - 1; o++) {
-                if (new_density >= min_density_value) {
-                  density[i] = new_density;
-                  density_offset[i] = 1 + i - o;
-                  break;
-                }
-                new_density = (new_density * (1 + i - o) - density_per[o]) / (i - o);
-              }
-            } else {
-              // no smaller region
-              float new_density = 0;
-              density_offset[i] = density_offset[i-1] + 1;
-              density[i] = (density[i-1] * density_offset[i-1] + cur_density) / density_offset[i];
-              new_density = density[i];
-              for (int64 o = i - density_offset[i-1] - 1; o >= 0; o--) {
-                new_density = (density_per[o] + new_density * (i - o)) / (1 + i - o);
-                if (new_density >= min_density_value) {
-                  density[i] = new_density;
-                  density_offset[i] = 1 + i - o;
-                }
-              }
-            }
-          }
-          // terminate or continue
-          // regions smaller than min_jump_offset is not qualified
-          if (density_offset[i] == 0 && max_end != -1) break;
-          else if (density_offset[i] > 0 && density_offset[i] >= min_jump_offset && density_offset[i] > max_offset) {
-            max_end = i;
-            max_offset = density_offset[i];
-            if (only_one) {
-              max_offset = 1;
-              break;
-            }
-          }
-        }
+        MinDensityRegion(row_density, b, d_start, d_offset, min_density_value, min_jump_offset, only_one,
+          density, density_per, density_offset, &max_end, &max_offset);
         // free
         free(density);
         free(density_per);
@@ -387,7 +434,7 @@ class MinDensityMultiCpuOp : public OpKernel {
 
     void Compute(OpKernelContext* context) override {
       // input
-      const Tensor& match_matrix_t = context->input(0);
+      const Tensor& row_density_t = context->input(0);
       const Tensor& dq_size_t = context->input(1);
       const Tensor& location_t = context->input(2);
       const Tensor& min_density_t = context->input(3);
@@ -400,7 +447,7 @@ class MinDensityMultiCpuOp : public OpKernel {
         errors::InvalidArgument("Must be a scalar"));
       OP_REQUIRES(context, TensorShapeUtils::IsScalar(only_one_t.shape()),
         errors::InvalidArgument("Must be a scalar"));
-      auto match_matrix = match_matrix_t.tensor<float, 3>();
+      auto row_density = row_density_t.tensor<float, 2>();
       auto dq_size = dq_size_t.tensor<int32, 2>();
       auto location = location_t.tensor<float, 2>();
       auto min_density = min_density_t.tensor<float, 1>();
@@ -408,7 +455,7 @@ class MinDensityMultiCpuOp : public OpKernel {
       auto use_ratio = use_ratio_t.scalar<bool>()();
       // this bool is used when we only want to find the first item >= threshold
       auto only_one = only_one_t.scalar<bool>()();
-      const int64 batch_size = match_matrix_t.dim_size(0);
+      const int64 batch_size = row_density_t.dim_size(0);
       // output
       TensorShape output_shape;
       output_shape.AddDim(batch_size);
@@ -424,15 +471,195 @@ class MinDensityMultiCpuOp : public OpKernel {
                 << std::endl;
       */
       Shard(worker_threads.num_threads, worker_threads.workers, batch_size, 2500,
-        [context, match_matrix, dq_size, location, min_density,  min_jump_offset, 
+        [context, row_density, dq_size, location, min_density,  min_jump_offset, 
         use_ratio, only_one, next_location]
         (int64 start, int64 limit) {
-          MinDensityMultiCpuOp::OneTask(start, limit, context, match_matrix, dq_size, location,
+          MinDensityMultiCpuOp::OneTask(start, limit, context, row_density, dq_size, location,
             min_density, min_jump_offset, use_ratio, only_one, next_location);
         });
     }
 };
 
+// the whole jump trajectory of "all_next_hard" glimpse and "min_density_hard" jump.
+// location(b, t) is the jump location after step t (truncated by max_jump_offset if it is positive),
+// which stays unchanged after the sample stops, and step(b) is the number of steps before it stops.
+class MinDensityTrajectoryOp : public OpKernel {
+  public:
+    explicit MinDensityTrajectoryOp(OpKernelConstruction* context) : OpKernel(context) {}
+
+    static void OneTask(int64 start, int64 limit, OpKernelContext* context,
+      typename TTypes<float, 2>::ConstTensor row_density, typename TTypes<int32, 2>::ConstTensor dq_size,
+      typename TTypes<float, 1>::ConstTensor min_density, int32 min_jump_offset, float max_jump_offset,
+      int32 max_jump_step, typename TTypes<float, 3>::Tensor location, typename TTypes<int32, 1>::Tensor step) {
+      const int64 max_d_len = row_density.dimension(1);
+      float* density = (float*)malloc(max_d_len * sizeof(float)); // density for the region
+      float* density_per = (float*)malloc(max_d_len * sizeof(float)); // density for the position
+      int* density_offset = (int*)malloc(max_d_len * sizeof(int)); // region span
+      for (int64 b = start; b < limit; b++) {
+        const int64 d_len = dq_size(b, 0);
+        const int64 q_len = dq_size(b, 1);
+        // start from the top-left corner
+        float cur_location[4] = {0, 0, 0, 0};
+        int32 t = 0;
+        for (; t < max_jump_step; t++) {
+          // glimpse: all the remaining doc after the last jump location
+          const int64 d_start = (int)floor(cur_location[0] + cur_location[2]);
+          if (d_start > d_len - 1 || q_len < 1) break;
+          const int64 d_offset = d_len - d_start;
+          int64 max_end = -1;
+          int64 max_offset = -1;
+          MinDensityRegion(row_density, b, d_start, d_offset, min_density(b), min_jump_offset, false,
+            density, density_per, density_offset, &max_end, &max_offset);
+          // jump
+          if (max_end == -1) break; // overflow
+          float offset = (float)max_offset;
+          if (max_jump_offset > 0 && offset > max_jump_offset) offset = max_jump_offset;
+          cur_location[0] = (float)(max_end + d_start - max_offset + 1);
+          cur_location[1] = 0;
+          cur_location[2] = offset;
+          cur_location[3] = (float)q_len;
+          for (int k = 0; k < 4; k++) location(b, t, k) = cur_location[k];
+        }
+        step(b) = t;
+        for (; t < max_jump_step; t++) {
+          for (int k = 0; k < 4; k++) location(b, t, k) = cur_location[k];
+        }
+      }
+      free(density);
+      free(density_per);
+      free(density_offset);
+    }
+
+    void Compute(OpKernelContext* context) override {
+      // input
+      const Tensor& row_density_t = context->input(0);
+      const Tensor& dq_size_t = context->input(1);
+      const Tensor& min_density_t = context->input(2);
+      const Tensor& min_jump_offset_t = context->input(3);
+      const Tensor& max_jump_offset_t = context->input(4);
+      const Tensor& max_jump_step_t = context->input(5);
+      OP_REQUIRES(context, TensorShapeUtils::IsScalar(min_jump_offset_t.shape()),
+        errors::InvalidArgument("Must be a scalar"));
+      OP_REQUIRES(context, TensorShapeUtils::IsScalar(max_jump_offset_t.shape()),
+        errors::InvalidArgument("Must be a scalar"));
+      OP_REQUIRES(context, TensorShapeUtils::IsScalar(max_jump_step_t.shape()),
+        errors::InvalidArgument("Must be a scalar"));
+      auto row_density = row_density_t.tensor<float, 2>();
+      auto dq_size = dq_size_t.tensor<int32, 2>();
+      auto min_density = min_density_t.tensor<float, 1>();
+      auto min_jump_offset = min_jump_offset_t.scalar<int32>()();
+      auto max_jump_offset = max_jump_offset_t.scalar<float>()();
+      auto max_jump_step = max_jump_step_t.scalar<int32>()();
+      const int64 batch_size = row_density_t.dim_size(0);
+      for (int64 b = 0; b < batch_size; b++) {
+        OP_REQUIRES(context, dq_size(b, 0) <= row_density_t.dim_size(1),
+          errors::InvalidArgument("doc length overflow"));
+      }
+      // output
+      TensorShape location_shape;
+      location_shape.AddDim(batch_size);
+      location_shape.AddDim(max_jump_step);
+      location_shape.AddDim(4);
+      Tensor* location_t = NULL;
+      OP_REQUIRES_OK(context, context->allocate_output(0, location_shape, &location_t));
+      TensorShape step_shape;
+      step_shape.AddDim(batch_size);
+      Tensor* step_t = NULL;
+      OP_REQUIRES_OK(context, context->allocate_output(1, step_shape, &step_t));
+      auto location = location_t->tensor<float, 3>();
+      auto step = step_t->tensor<int32, 1>();
+      // each sample walks through the whole doc at most once
+      const int64 cost = row_density_t.dim_size(1) * 10;
+      auto worker_threads = *(context->device()->tensorflow_cpu_worker_threads());
+      Shard(worker_threads.num_threads, worker_threads.workers, batch_size, cost,
+        [context, row_density, dq_size, min_density, min_jump_offset, max_jump_offset,
+        max_jump_step, location, step]
+        (int64 start, int64 limit) {
+          MinDensityTrajectoryOp::OneTask(start, limit, context, row_density, dq_size, min_density,
+            min_jump_offset, max_jump_offset, max_jump_step, location, step);
+        });
+    }
+};
+
+// the positions where the doc word is the same as the query word, which are the non-zero entries
+// of the match matrix of "indicator" interaction. indices(k) is (batch, doc position, query position)
+// sorted by doc position and the entries of doc position d of sample b are
+// [row_splits(b * max_d_len + d), row_splits(b * max_d_len + d + 1)) in indices (CSR offsets).
+class IndicatorMatchOp : public OpKernel {
+  public:
+    explicit IndicatorMatchOp(OpKernelConstruction* context) : OpKernel(context) {}
+
+    // count (when indices is NULL) or fill the matches of samples [start, limit)
+    static void OneTask(int64 start, int64 limit, typename TTypes<int32, 2>::ConstTensor query,
+      typename TTypes<int32, 2>::ConstTensor doc, typename TTypes<int32, 2>::ConstTensor dq_size,
+      int64* row_splits, int64* indices) {
+      const int64 max_d_len = doc.dimension(1);
+      for (int64 b = start; b < limit; b++) {
+        const int64 d_len = dq_size(b, 0);
+        const int64 q_len = dq_size(b, 1);
+        for (int64 i = 0; i < max_d_len; i++) {
+          int64 row = b * max_d_len + i;
+          int64 n = 0;
+          // padding of doc has no match
+          for (int64 j = 0; j < (i < d_len ? q_len : 0); j++) {
+            if (doc(b, i) != query(b, j)) continue;
+            if (indices != NULL) {
+              int64* ind = indices + (row_splits[row] + n) * 3;
+              ind[0] = b;
+              ind[1] = i;
+              ind[2] = j;
+            }
+            n++;
+          }
+          if (indices == NULL) row_splits[row + 1] = n;
+        }
+      }
+    }
+
+    void Compute(OpKernelContext* context) override {
+      // input
+      const Tensor& query_t = context->input(0);
+      const Tensor& doc_t = context->input(1);
+      const Tensor& dq_size_t = context->input(2);
+      auto query = query_t.tensor<int32, 2>();
+      auto doc = doc_t.tensor<int32, 2>();
+      auto dq_size = dq_size_t.tensor<int32, 2>();
+      const int64 batch_size = doc_t.dim_size(0);
+      const int64 max_d_len = doc_t.dim_size(1);
+      for (int64 b = 0; b < batch_size; b++) {
+        OP_REQUIRES(context, dq_size(b, 0) <= max_d_len, errors::InvalidArgument("doc length overflow"));
+        OP_REQUIRES(context, dq_size(b, 1) <= query_t.dim_size(1), errors::InvalidArgument("query length overflow"));
+      }
+      // count the matches of each doc position
+      TensorShape row_splits_shape;
+      row_splits_shape.AddDim(batch_size * max_d_len + 1);
+      Tensor* row_splits_t = NULL;
+      OP_REQUIRES_OK(context, context->allocate_output(1, row_splits_shape, &row_splits_t));
+      int64* row_splits = row_splits_t->flat<int64>().data();
+      row_splits[0] = 0;
+      auto worker_threads = *(context->device()->tensorflow_cpu_worker_threads());
+      const int64 cost = max_d_len * query_t.dim_size(1);
+      Shard(worker_threads.num_threads, worker_threads.workers, batch_size, cost,
+        [query, doc, dq_size, row_splits](int64 start, int64 limit) {
+          IndicatorMatchOp::OneTask(start, limit, query, doc, dq_size, row_splits, NULL);
+        });
+      for (int64 r = 0; r < batch_size * max_d_len; r++) row_splits[r + 1] += row_splits[r];
+      // fill the matches
+      TensorShape indices_shape;
+      indices_shape.AddDim(row_splits[batch_size * max_d_len]);
+      indices_shape.AddDim(3);
+      Tensor* indices_t = NULL;
+      OP_REQUIRES_OK(context, context->allocate_output(0, indices_shape, &indices_t));
+      int64* indices = indices_t->flat<int64>().data();
+      Shard(worker_threads.num_threads, worker_threads.workers, batch_size, cost,
+        [query, doc, dq_size, row_splits, indices](int64 start, int64 limit) {
+          IndicatorMatchOp::OneTask(start, limit, query, doc, dq_size, row_splits, indices);
+        });
+    }
+};
+
 REGISTER_KERNEL_BUILDER(Name("ZeroOut").Device(DEVICE_CPU), ZeroOutOp);
 REGISTER_KERNEL_BUILDER(Name("MinDensity").Device(DEVICE_CPU), MinDensityOp);
 REGISTER_KERNEL_BUILDER(Name("MinDensityMultiCpu").Device(DEVICE_CPU), MinDensityMultiCpuOp);
+REGISTER_KERNEL_BUILDER(Name("MinDensityTrajectory").Device(DEVICE_CPU), MinDensityTrajectoryOp);
+REGISTER_KERNEL_BUILDER(Name("IndicatorMatch").Device(DEVICE_CPU), IndicatorMatchOp);
@@ -3,7 +3,18 @@ import logging, argparse, random
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='MD-LSTM')
     parser.add_argument('-a', '--arch', help='NN architecture', type=str, default='mdlstm')
-    parser.add_argument('--rnn_type', help='which type of RNN to use', type=str, default='dynamic')
+    parser.add_argument('--rnn_type', help='which type of RNN to use (dynamic, static, wavefront, native)',
+                        type=str, default='dynamic')
+    parser.add_argument('--hoist_input', help='whether to compute the input projection of MD-LSTM before the loop',
+                        action='store_true')
+    parser.add_argument('--fused_ln', help='whether to normalize the gates of MD-LSTM with one fused layer norm',
+                        action='store_true')
+    parser.add_argument('--multi_directional', help='whether to scan the four directions with one MD-LSTM layer',
+                        action='store_true')
+    parser.add_argument('--checkpoint_rows', help='recompute MD-LSTM by blocks of this many rows in backprop '
+                                                  '(0 to keep all the activations)', type=int, default=0)
+    parser.add_argument('--num_layers', help='number of stacked MD-LSTM layers run by one pipelined wavefront',
+                        type=int, default=1)
     parser.add_argument('-d', '--data', help='data type', type=str, default='ir')
     parser.add_argument('-f', '--feature', help='ir feature used to generate match matrix',
                         type=str, default='tf_proximity')
@@ -16,6 +27,8 @@ if __name__ == '__main__':
     parser.add_argument('-S', '--save_model_epoch', help='how many epochs to run before save',
                         type=int, default=3000)
     parser.add_argument('-l', '--load_model_path', help='path to load the model from', type=str, default=None)
+    parser.add_argument('-X', '--export_path', help='path to export the MD-LSTM weights of the loaded model '
+                                                    'for md_lstm_np', type=str, default=None)
     parser.add_argument('-D', '--debug', help='whether to use debug log level', action='store_true')
     parser.add_argument('-B', '--tf_summary_path', help='path to save tf summary', type=str, default=None)
     parser.add_argument('--tf_summary', help='how many epochs to run before summarization',
@@ -77,6 +90,10 @@ def standard_lstm(input_data, rnn_size):
 def main():
     if args.arch not in {'lstm', 'mdlstm', 'cnn'}:
         raise Exception('not support arch type (should be one of "lstm", "mdlstm", "cnn").')
+    if args.export_path:
+        logging.info('export model "{}" to "{}"'.format(args.load_model_path, args.export_path))
+        export_weights(args.load_model_path, args.export_path)
+        return
 
     # config
     visualization = 'saliency' # kernel, saliency
@@ -110,10 +127,29 @@ def main():
     #with summary_writer.as_default(), tf.contrib.summary.always_record_summaries():
     if args.arch == 'mdlstm':
         print('Using Multi Dimensional LSTM !')
-        if args.rnn_type == 'dynamic':
-            nn_out, rnn_states = multi_dimensional_rnn_while_loop(rnn_size=hidden_size, input_data=x, sh=[1, 1])
+        if args.multi_directional:
+            nn_out, rnn_states = multi_dimensional_rnn_multi_directional(
+                rnn_size=hidden_size, input_data=x, sh=[1, 1], hoist_input=args.hoist_input, fused_ln=args.fused_ln)
+        elif args.num_layers > 1:
+            nn_out, rnn_states = multi_dimensional_rnn_stacked(
+                rnn_size=hidden_size, input_data=x, sh=[1, 1], num_layers=args.num_layers,
+                hoist_input=args.hoist_input, fused_ln=args.fused_ln)
+        elif args.checkpoint_rows:
+            nn_out, rnn_states = multi_dimensional_rnn_checkpointed(
+                rnn_size=hidden_size, input_data=x, sh=[1, 1], hoist_input=args.hoist_input, fused_ln=args.fused_ln,
+                checkpoint_rows=args.checkpoint_rows)
+        elif args.rnn_type == 'dynamic':
+            nn_out, rnn_states = multi_dimensional_rnn_while_loop(rnn_size=hidden_size, input_data=x, sh=[1, 1],
+                                                                  hoist_input=args.hoist_input, fused_ln=args.fused_ln)
         elif args.rnn_type == 'static':
-            nn_out, rnn_states = multi_dimensional_rnn_static(rnn_size=hidden_size, input_data=x, sh=[1, 1])
+            nn_out, rnn_states = multi_dimensional_rnn_static(rnn_size=hidden_size, input_data=x, sh=[1, 1],
+                                                              hoist_input=args.hoist_input, fused_ln=args.fused_ln)
+        elif args.rnn_type == 'wavefront':
+            nn_out, rnn_states = multi_dimensional_rnn_wavefront(rnn_size=hidden_size, input_data=x, sh=[1, 1],
+                                                                 hoist_input=args.hoist_input, fused_ln=args.fused_ln)
+        elif args.rnn_type == 'native':
+            nn_out, rnn_states = multi_dimensional_rnn_native(rnn_size=hidden_size, input_data=x, sh=[1, 1],
+                                                              fused_ln=args.fused_ln)
         #debug_rnn_states = grad_debugger.identify_gradient(rnn_states)
     elif args.arch == 'lstm':
         print('Using Standard LSTM !')
@@ -143,7 +179,8 @@ def main():
     else:
         used_model_out = model_out * tf.expand_dims(x_w, axis=-1)
         saliency = tf.gradients(used_model_out, x)
-        if args.rnn_type == 'static':
+        if args.rnn_type == 'static' and \
+                not (args.multi_directional or args.checkpoint_rows or args.num_layers > 1):
             rnn_states_grad = tf.gradients(used_model_out, [s.c for s in rnn_states])
     saver = tf.train.Saver()
     init = tf.global_variables_initializer()
@@ -162,7 +199,11 @@ def main():
     # load model or init model
     if type(args.load_model_path) is str:
         logging.info('load model from "{}"'.format(args.load_model_path))
-        saver.restore(sess, args.load_model_path)
+        if args.arch == 'mdlstm' and args.fused_ln:
+            # checkpoints saved without fused layer norm are mapped to the fused variables
+            restore_fused_ln(sess, args.load_model_path)
+        else:
+            saver.restore(sess, args.load_model_path)
     else:
         sess.run(init)
 
@@ -231,7 +272,8 @@ def main():
                                            axis=1, keepdims=True).astype(np.float32)
                     saliency_map[:, 0, 0, :] = saliency_map[:, 0, 0, :] * saliency_mask
                 cnn_vis.plot_saliency_map(batch_x, saliency_map)
-                if args.rnn_type == 'static':
+                if args.rnn_type == 'static' and \
+                        not (args.multi_directional or args.checkpoint_rows or args.num_layers > 1):
                     rnn_states_val = sess.run([s.h for s in rnn_states],
                                               feed_dict={x: batch_x, y: batch_y, x_w: batch_x_w})
                     rnn_states_grad_val = \
@@ -1,7 +1,11 @@
+import os
+import math
 import uuid
 import tensorflow as tf
 import numpy as np
+from tensorflow.python.framework import ops
 from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import gen_math_ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.contrib.rnn import RNNCell, LSTMStateTuple
@@ -28,6 +32,115 @@ def ln(tensor, scope=None, epsilon=1e-5):
     return ln_initial * scale + shift
 
 
+def fused_ln(tensor, num_gates, scope=None, epsilon=1e-5):
+    """ Layer normalizes the num_gates equal slices of a 2D tensor along its second axis at once """
+    assert (len(tensor.get_shape()) == 2)
+    num_units = tensor.get_shape()[1].value // num_gates
+    gates = tf.reshape(tensor, [-1, num_gates, num_units])
+    m, v = tf.nn.moments(gates, [2], keep_dims=True)
+    if not isinstance(scope, str):
+        scope = ''
+    with tf.variable_scope(scope + 'layer_norm'):
+        scale = tf.get_variable('scale',
+                                shape=[num_gates, num_units],
+                                initializer=tf.constant_initializer(1))
+        shift = tf.get_variable('shift',
+                                shape=[num_gates, num_units],
+                                initializer=tf.constant_initializer(0))
+    ln_initial = (gates - m) / tf.sqrt(v + epsilon)
+
+    return tf.reshape(ln_initial * scale + shift, [-1, num_gates * num_units])
+
+
+def int8_scale(tensor, axis):
+    """ The symmetric int8 scale of the max of |tensor| along axis, as md_lstm_np.quantize_weights """
+    return tf.maximum(tf.reduce_max(tf.abs(tensor), axis=axis, keepdims=True), 1e-8) / 127
+
+
+def _quantize_int8(tensor, scale):
+    # the levels -127, ..., 127 of tensor / scale, kept as quint8 with an offset of 127 since
+    # the CPU QuantizedMatMul only takes quint8
+    return tf.quantization.quantize(tf.clip_by_value(tensor / scale, -127.0, 127.0), -127.0, 128.0, tf.quint8)
+
+
+def quantize_kernel(kernel, precision, kernel_scale=None):
+    """ The 2D kernel in precision for reduced_precision_matmul: cast to bfloat16, or for int8
+    quantized with kernel_scale (one scale per column, the max of each column if None) and
+    returned with it """
+    if precision == 'bfloat16':
+        return tf.cast(kernel, tf.bfloat16)
+    if precision == 'int8':
+        if kernel_scale is None:
+            kernel_scale = int8_scale(kernel, 0)
+        return _quantize_int8(kernel, kernel_scale), kernel_scale
+    return kernel
+
+
+def reduced_precision_matmul(a, kernel, precision, scale=None):
+    """ matmul(a, kernel) of the float32 2D tensor a and a kernel given by quantize_kernel, the
+    result is float32. For int8, a is quantized with scale (the max of each row if None) and the
+    int32 products of QuantizedMatMul are scaled back by the scales of a and of the kernel """
+    if precision == 'bfloat16':
+        return tf.cast(math_ops.matmul(tf.cast(a, tf.bfloat16), kernel), tf.float32)
+    if precision == 'int8':
+        kernel, kernel_scale = kernel
+        if scale is None:
+            scale = int8_scale(a, -1)
+        a = _quantize_int8(a, scale)
+        product = gen_math_ops.quantized_mat_mul(a.output, kernel.output, a.output_min, a.output_max,
+                                                 kernel.output_min, kernel.output_max, Toutput=tf.qint32)
+        # SCALED keeps the int32 products exact
+        product = tf.quantization.dequantize(product.out, product.min_out, product.max_out, mode='SCALED')
+        return product * scale * kernel_scale
+    return math_ops.matmul(a, kernel)
+
+
+def restore_fused_ln(sess, checkpoint_path):
+    """Restores a checkpoint into a graph built with fused_ln cells.
+    Variables found in the checkpoint are restored by name. A missing gates/layer_norm
+    variable (or its optimizer slot) is stacked from the per gate i, j, f1, ..., fN, o
+    variables of a checkpoint saved without fused_ln.
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    saved = reader.get_variable_to_shape_map()
+    restore, stack, init = [], [], []
+    for v in tf.global_variables():
+        name = v.op.name
+        unfused = []
+        if '/gates/layer_norm/' in name:
+            # the fused scale and shift are (num_gates, num_units), or
+            # (num_directions, 1, num_gates, num_units) in a MultiDirectionalLSTMCell
+            num_dims = v.get_shape()[-2].value - 3
+            unfused = [name.replace('/gates/layer_norm/', '/{}/layer_norm/'.format(g))
+                       for g in MultiDimensionalLSTMCell.gate_names(num_dims)]
+        if name in saved:
+            restore.append(v)
+        elif unfused and all(n in saved for n in unfused):
+            stack.append((v, unfused))
+        else:
+            init.append(v)
+    if restore:
+        tf.train.Saver(restore).restore(sess, checkpoint_path)
+    for v, unfused in stack:
+        v.load(np.stack([reader.get_tensor(n) for n in unfused], axis=-2), sess)
+    sess.run(tf.variables_initializer(init))
+
+
+def export_weights(checkpoint_path, output_path, scope_n="layer1"):
+    """Writes the kernel and the layer norm scale and shift of the MD-LSTM layer scope_n of a
+    checkpoint to the npz file output_path, to be run by md_lstm_np without TensorFlow.
+    The names are relative to the cell scope, e.g. kernel or i/layer_norm/scale.
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    prefix = "MultiDimensionalLSTMCell-{}/MultiDimensionalLSTMCell/".format(scope_n)
+    # the optimizer slots (e.g. kernel/Adam) are left out
+    weights = {name[len(prefix):]: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()
+               if name.startswith(prefix) and name.split('/')[-1] in ('kernel', 'scale', 'shift')}
+    if not weights:
+        raise Exception('no MD-LSTM variables under "{}" in "{}"'.format(prefix, checkpoint_path))
+    np.savez(output_path, **weights)
+
+
 class MultiDimensionalLSTMCell(RNNCell):
     """
     Adapted from TF's BasicLSTMCell to use Layer Normalization.
@@ -35,11 +148,37 @@ class MultiDimensionalLSTMCell(RNNCell):
     """
 
     TIME_STEP = 0
+    GATES = ['i', 'j', 'f1', 'f2', 'o']
+    PRECISIONS = ['float32', 'bfloat16', 'int8']
 
-    def __init__(self, num_units, forget_bias=0.0, activation=tf.nn.tanh):
+    def __init__(self, num_units, forget_bias=0.0, activation=tf.nn.tanh, fused_ln=False, num_dims=2,
+                 precision='float32', input_scale=None):
+        """
+        @param fused_ln: normalize the gates with one moments computation, the scale and
+            shift of the gates are then stored together in gates/layer_norm (see restore_fused_ln)
+        @param num_dims: the dimensions of the grid, a cell has one predecessor and one
+            forget gate per dimension
+        @param precision: precision of the kernel matmuls for inference (float32, bfloat16 or int8 with
+            one scale per output channel), the layer norms and the states stay float32.
+            md_lstm_np.multi_dimensional_rnn gives their reference results
+        @param input_scale: int8 scale of the cell inputs (e.g. given by md_lstm_np.calibrate), the max
+            of each row if None. The hidden units are always quantized with the max of each row
+        """
+        if precision not in self.PRECISIONS:
+            raise Exception('not supported precision (should be one of "float32", "bfloat16", "int8").')
         self._num_units = num_units
         self._forget_bias = forget_bias
         self._activation = activation
+        self._fused_ln = fused_ln
+        self._num_dims = num_dims
+        self._num_gates = num_dims + 3
+        self._precision = precision
+        self._input_scale = input_scale
+
+    @staticmethod
+    def gate_names(num_dims):
+        """The gates i, j, f1, ..., fN, o of a cell, GATES for 2 dimensions"""
+        return ['i', 'j'] + ['f{}'.format(d + 1) for d in range(num_dims)] + ['o']
 
     @property
     def state_size(self):
@@ -53,53 +192,272 @@ class MultiDimensionalLSTMCell(RNNCell):
         MultiDimensionalLSTMCell.TIME_STEP += 1
         return MultiDimensionalLSTMCell.TIME_STEP
 
-    def __call__(self, inputs, state, scope=None):
-        """Long short-term memory cell (LSTM).
-        @param: inputs (batch,n)
-        @param state: the states and hidden unit of the two cells
+    def _split_recurrent_kernels(self, weights, input_size):
+        # the rows of h1, ..., hN in the kernel
+        return tuple(weights[..., input_size + d * self._num_units:input_size + (d + 1) * self._num_units, :]
+                     for d in range(self._num_dims))
+
+    def _kernels(self, weights, input_size):
+        # the rows of the inputs and of h1, ..., hN in the precision of the cell, the int8
+        # scales are the ones of the output channels of the whole kernel
+        kernel_scale = int8_scale(weights, 0) if self._precision == 'int8' else None
+        return tuple(quantize_kernel(w, self._precision, kernel_scale)
+                     for w in (weights[:input_size],) + self._split_recurrent_kernels(weights, input_size))
+
+    def _matmul(self, a, kernel, scale=None):
+        return reduced_precision_matmul(a, kernel, self._precision, scale)
+
+    def input_projection(self, inputs, scope=None):
+        """Computes the input part of the gates of many cells with one matmul.
+        The kernel keeps the layout [inputs, h1, ..., hN] x num_gates*num_units of __call__, so
+        checkpoints are shared. The recurrent rows are kept for input_projected calls.
+        @param: inputs (cells,n)
+        returns (cells,num_gates*num_units)
         """
         with tf.variable_scope(scope or type(self).__name__):
-            c1, c2, h1, h2 = state
-
-            # change bias argument to False since LN will add bias via shift
+            input_size = inputs.get_shape()[1].value
             weights = vs.get_variable(
-                'kernel', [inputs.get_shape()[1] + h1.get_shape()[1] + h2.get_shape()[1], 5 * self._num_units],
+                'kernel', [input_size + self._num_dims * self._num_units, self._num_gates * self._num_units],
                 dtype=inputs.dtype,
                 initializer=None)
-            concat = math_ops.matmul(array_ops.concat([inputs, h1, h2], 1), weights)
-            #concat = _linear([inputs, h1, h2], 5 * self._num_units, False)
+            # the kernels are put in the precision of the cell once, outside the recurrence
+            kernels = self._kernels(weights, input_size)
+            self._recurrent_kernels = kernels[1:]
+            return self._matmul(inputs, kernels[0], self._input_scale)
+
+    def __call__(self, inputs, state, scope=None, input_projected=False):
+        """Long short-term memory cell (LSTM).
+        @param: inputs (batch,n)
+        @param state: the states c1, ..., cN and hidden units h1, ..., hN of the num_dims
+            predecessor cells
+        @param input_projected: inputs are (batch,num_gates*num_units) rows of input_projection
+        """
+        with tf.variable_scope(scope or type(self).__name__):
+            cs, hs = state[:self._num_dims], state[self._num_dims:]
 
-            i, j, f1, f2, o = tf.split(value=concat, num_or_size_splits=5, axis=1)
+            if input_projected:
+                # only the recurrent projections are left inside the recurrence
+                concat = inputs
+                for h_d, w_d in zip(hs, self._recurrent_kernels):
+                    concat = concat + self._matmul(h_d, w_d)
+            else:
+                # change bias argument to False since LN will add bias via shift
+                weights = vs.get_variable(
+                    'kernel', [inputs.get_shape()[1] + sum(h_d.get_shape()[1] for h_d in hs),
+                               self._num_gates * self._num_units],
+                    dtype=inputs.dtype,
+                    initializer=None)
+                if self._precision == 'float32':
+                    concat = math_ops.matmul(array_ops.concat([inputs] + list(hs), 1), weights)
+                else:
+                    # the inputs and h1, ..., hN are quantized with their own scales
+                    kernels = self._kernels(weights, inputs.get_shape()[1].value)
+                    concat = self._matmul(inputs, kernels[0], self._input_scale)
+                    for h_d, w_d in zip(hs, kernels[1:]):
+                        concat = concat + self._matmul(h_d, w_d)
+                #concat = _linear([inputs, h1, h2], 5 * self._num_units, False)
+
+            return self._gates(concat, cs)
+
+    def _layer_norm(self, tensor, scope, num_gates=1):
+        if num_gates == 1:
+            return ln(tensor, scope=scope)
+        return fused_ln(tensor, num_gates, scope=scope)
+
+    def _gates(self, concat, cs):
+        """The gates, new state and hidden unit from the projections concat (...,num_gates*num_units)
+        and the states cs of the predecessors"""
+        if self._fused_ln:
+            # add layer normalization to all the gates at once
+            concat = self._layer_norm(concat, 'gates/', num_gates=self._num_gates)
 
+        gates = tf.split(value=concat, num_or_size_splits=self._num_gates, axis=-1)
+
+        if not self._fused_ln:
             # add layer normalization to each gate
-            i = ln(i, scope='i/')
-            j = ln(j, scope='j/')
-            f1 = ln(f1, scope='f1/')
-            f2 = ln(f2, scope='f2/')
-            o = ln(o, scope='o/')
+            gates = [self._layer_norm(g, name + '/') for g, name in zip(gates, self.gate_names(self._num_dims))]
+        i, j, fs, o = gates[0], gates[1], gates[2:-1], gates[-1]
+
+        # gate activation
+        i = tf.nn.sigmoid(i)
+        fs = [tf.nn.sigmoid(f + self._forget_bias) for f in fs]
+        o = tf.nn.sigmoid(o)
+
+        # gate summary
+        #tf.summary.histogram('forget1', f1)
+        #tf.summary.histogram('forget2', f2)
+        #tf.contrib.summary.histogram('forget1_{}'.format(self.time_step()), f1)
+        #tf.contrib.summary.histogram('forget2_{}'.format(self.time_step()), f2)
+
+        new_c = cs[0] * fs[0]
+        for c_d, f_d in zip(cs[1:], fs[1:]):
+            new_c = new_c + c_d * f_d
+        new_c = new_c + i * self._activation(j)
+
+        # add layer_normalization in calculation of new hidden state
+        new_h = self._activation(self._layer_norm(new_c, 'new_h/')) * o
+        new_state = LSTMStateTuple(new_c, new_h)
+
+        return new_h, new_state
+
+
+class MultiDirectionalLSTMCell(MultiDimensionalLSTMCell):
+    """
+    num_directions MultiDimensionalLSTMCell with their own weights run as one cell.
+    The batch is made of num_directions equal blocks, block k uses the weights of direction k
+    and the projections of all the directions are done by one batched matmul.
+    """
+
+    def __init__(self, num_units, num_directions=4, forget_bias=0.0, activation=tf.nn.tanh, fused_ln=False):
+        super(MultiDirectionalLSTMCell, self).__init__(num_units, forget_bias=forget_bias,
+                                                       activation=activation, fused_ln=fused_ln)
+        self._num_directions = num_directions
+
+    def _directions(self, tensor):
+        # (num_directions*batch,n) => (num_directions,batch,n)
+        return tf.reshape(tensor, [self._num_directions, -1, tensor.get_shape()[-1].value])
+
+    def _kernel(self, input_size, dtype):
+        # each direction is initialized like the kernel of a MultiDimensionalLSTMCell
+        rows, cols = input_size + self._num_dims * self._num_units, self._num_gates * self._num_units
+        limit = np.sqrt(6.0 / (rows + cols))
+        return vs.get_variable(
+            'kernel', [self._num_directions, rows, cols],
+            dtype=dtype,
+            initializer=tf.random_uniform_initializer(-limit, limit))
+
+    def input_projection(self, inputs, scope=None):
+        """Same as MultiDimensionalLSTMCell.input_projection with one kernel per direction
+        @param: inputs (num_directions*cells,n)
+        returns (num_directions*cells,num_gates*num_units)
+        """
+        with tf.variable_scope(scope or type(self).__name__):
+            input_size = inputs.get_shape()[1].value
+            weights = self._kernel(input_size, inputs.dtype)
+            self._recurrent_kernels = self._split_recurrent_kernels(weights, input_size)
+            concat = math_ops.matmul(self._directions(inputs), weights[:, :input_size])
+            return tf.reshape(concat, [-1, self._num_gates * self._num_units])
+
+    def __call__(self, inputs, state, scope=None, input_projected=False):
+        """Long short-term memory cell (LSTM) of all the directions.
+        @param: inputs (num_directions*batch,n)
+        @param state: the states and hidden units of the predecessor cells
+        @param input_projected: inputs are (num_directions*batch,num_gates*num_units) rows of input_projection
+        """
+        with tf.variable_scope(scope or type(self).__name__):
+            inputs = self._directions(inputs)
+            state = [self._directions(s) for s in state]
+            cs, hs = state[:self._num_dims], state[self._num_dims:]
+
+            if input_projected:
+                concat = inputs
+                for h_d, w_d in zip(hs, self._recurrent_kernels):
+                    concat = concat + math_ops.matmul(h_d, w_d)
+            else:
+                weights = self._kernel(inputs.get_shape()[2].value, inputs.dtype)
+                concat = math_ops.matmul(array_ops.concat([inputs] + hs, 2), weights)
+
+            new_h, new_state = self._gates(concat, cs)
 
-            # gate activation
-            i = tf.nn.sigmoid(i)
-            f1 = tf.nn.sigmoid(f1 + self._forget_bias)
-            f2 = tf.nn.sigmoid(f2 + self._forget_bias)
-            o = tf.nn.sigmoid(o)
+            def merge(t):
+                return tf.reshape(t, [-1, self._num_units])
+            return merge(new_h), LSTMStateTuple(merge(new_state[0]), merge(new_state[1]))
 
-            # gate summary
-            #tf.summary.histogram('forget1', f1)
-            #tf.summary.histogram('forget2', f2)
-            #tf.contrib.summary.histogram('forget1_{}'.format(self.time_step()), f1)
-            #tf.contrib.summary.histogram('forget2_{}'.format(self.time_step()), f2)
+    def _layer_norm(self, tensor, scope, num_gates=1):
+        # same as ln and fused_ln with a scale and shift per direction
+        num_units = tensor.get_shape()[2].value // num_gates
+        gates = tf.reshape(tensor, [self._num_directions, -1, num_gates, num_units])
+        m, v = tf.nn.moments(gates, [3], keep_dims=True)
+        shape = [self._num_directions, 1, num_units] if num_gates == 1 \
+            else [self._num_directions, 1, num_gates, num_units]
+        with tf.variable_scope(scope + 'layer_norm'):
+            scale = tf.get_variable('scale', shape=shape, initializer=tf.constant_initializer(1))
+            shift = tf.get_variable('shift', shape=shape, initializer=tf.constant_initializer(0))
+        ln_initial = tf.reshape((gates - m) / tf.sqrt(v + 1e-5), [self._num_directions, -1, num_units * num_gates])
+        if num_gates > 1:
+            scale = tf.reshape(scale, [self._num_directions, 1, num_gates * num_units])
+            shift = tf.reshape(shift, [self._num_directions, 1, num_gates * num_units])
+        return ln_initial * scale + shift
 
-            new_c = (c1 * f1 + c2 * f2 + i * self._activation(j))
 
-            # add layer_normalization in calculation of new hidden state
-            new_h = self._activation(ln(new_c, scope='new_h/')) * o
-            new_state = LSTMStateTuple(new_c, new_h)
+def _window_input(input_data, sh, dims=None):
+    """Pads the input to a multiple of the window size and reshapes it to the grid of steps
 
-            return new_h, new_state
+    @param input_data: the data to process of shape [batch,h,w,channels]
+    @param sh: [height,width] of the windows
+    @param dims: dimensions to reverse the input data
+
+    returns the input of shape [batch,h/sh[0],w/sh[1],features], the steps in X and Y axis
+    and the number of features
+    """
+    # Get the shape of the imput (batch_size, x, y, channels)
+    shape = input_data.get_shape().as_list()
+    if shape[1] is None or shape[2] is None:
+        return _window_input_dynamic(input_data, sh, dims)
+    X_dim = shape[1]
+    Y_dim = shape[2]
+    channels = shape[3]
+    # Window size
+    X_win = sh[0]
+    Y_win = sh[1]
+    # Get the runtime batch size
+    batch_size_runtime = tf.shape(input_data)[0]
+
+    # If the imput cannot be exactly sampled by the window, we patch it with zeros
+    if X_dim % X_win != 0:
+        # Get offset size
+        offset = tf.zeros([batch_size_runtime, X_win - (X_dim % X_win), Y_dim, channels])
+        # Concatenate X dimension
+        input_data = tf.concat(axis=1, values=[input_data, offset])
+        # Update shape value
+        X_dim = input_data.get_shape().as_list()[1]
+
+    # The same but for Y axis
+    if Y_dim % Y_win != 0:
+        # Get offset size
+        offset = tf.zeros([batch_size_runtime, X_dim, Y_win - (Y_dim % Y_win), channels])
+        # Concatenate Y dimension
+        input_data = tf.concat(axis=2, values=[input_data, offset])
+        # Update shape value
+        Y_dim = input_data.get_shape().as_list()[2]
+
+    # Get the steps to perform in X and Y axis
+    h, w = int(X_dim / X_win), int(Y_dim / Y_win)
 
+    # Get the number of features (total number of imput values per step)
+    features = Y_win * X_win * channels
 
-def multi_dimensional_rnn_while_loop(rnn_size, input_data, sh, dims=None, scope_n="layer1"):
+    # Reshape input data to a tensor containing the step indexes and features inputs
+    # The batch size is inferred from the tensor size
+    x = tf.reshape(input_data, [batch_size_runtime, h, w, features])
+
+    # Reverse the selected dimensions
+    if dims is not None:
+        assert dims[0] is False and dims[3] is False
+        x = tf.reverse(x, dims)
+    return x, h, w, features
+
+
+def _window_input_dynamic(input_data, sh, dims=None):
+    """Same as _window_input for an input whose height and width are only known at runtime,
+    the steps in X and Y axis are then returned as scalar tensors"""
+    channels = input_data.get_shape().as_list()[3]
+    shape_runtime = tf.shape(input_data)
+    X_win, Y_win = sh
+    # Pad with zeros to a multiple of the window
+    input_data = tf.pad(input_data, [[0, 0], [0, -shape_runtime[1] % X_win], [0, -shape_runtime[2] % Y_win], [0, 0]])
+    h = (shape_runtime[1] + X_win - 1) // X_win
+    w = (shape_runtime[2] + Y_win - 1) // Y_win
+    features = Y_win * X_win * channels
+    x = tf.reshape(input_data, [shape_runtime[0], h, w, features])
+    if dims is not None:
+        assert dims[0] is False and dims[3] is False
+        x = tf.reverse(x, dims)
+    return x, h, w, features
+
+
+def multi_dimensional_rnn_while_loop(rnn_size, input_data, sh, dims=None, scope_n="layer1", hoist_input=False,
+                                     fused_ln=False, precision='float32', input_scale=None):
     """Implements naive multi dimension recurrent neural networks
 
     @param rnn_size: the hidden units
@@ -108,6 +466,12 @@ def multi_dimensional_rnn_while_loop(rnn_size, input_data, sh, dims=None, scope_
     @param dims: dimensions to reverse the input data,eg.
         dims=[False,True,True,False] => true means reverse dimension
     @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+    @param precision: precision of the kernel matmuls (float32, bfloat16 or int8),
+        see MultiDimensionalLSTMCell
+    @param input_scale: int8 scale of the inputs of the cells, the max of each row if None
 
     returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm
     """
@@ -115,71 +479,21 @@ def multi_dimensional_rnn_while_loop(rnn_size, input_data, sh, dims=None, scope_
     with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
         
         # Create multidimensional cell with selected size
-        cell = MultiDimensionalLSTMCell(rnn_size)
-
-        # Get the shape of the imput (batch_size, x, y, channels)
-        shape = input_data.get_shape().as_list()
-        batch_size = shape[0]
-        X_dim = shape[1]
-        Y_dim = shape[2]
-        channels = shape[3]
-        # Window size
-        X_win = sh[0]
-        Y_win = sh[1]
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln, precision=precision, input_scale=input_scale)
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh, dims)
         # Get the runtime batch size
         batch_size_runtime = tf.shape(input_data)[0]
-        
-        # If the imput cannot be exactly sampled by the window, we patch it with zeros
-        if X_dim % X_win != 0:
-            # Get offset size
-            offset = tf.zeros([batch_size_runtime, X_win - (X_dim % X_win), Y_dim, channels])
-            # Concatenate X dimension
-            input_data = tf.concat(axis=1, values=[input_data, offset])
-            # Get new shape
-            shape = input_data.get_shape().as_list()
-            # Update shape value
-            X_dim = shape[1]
-            
-        # The same but for Y axis
-        if Y_dim % Y_win != 0:
-            # Get offset size
-            offset = tf.zeros([batch_size_runtime, X_dim, Y_win - (Y_dim % Y_win), channels])
-            # Concatenate Y dimension
-            input_data = tf.concat(axis=2, values=[input_data, offset])
-            # Get new shape
-            shape = input_data.get_shape().as_list()
-            # Update shape value
-            Y_dim = shape[2]
-
-        # Get the steps to perform in X and Y axis
-        h, w = int(X_dim / X_win), int(Y_dim / Y_win)
-        
-        # Get the number of features (total number of imput values per step)
-        features = Y_win * X_win * channels
-        
-        
 
-    
-        # Reshape input data to a tensor containing the step indexes and features inputs
-        # The batch size is inferred from the tensor size
-        x = tf.reshape(input_data, [batch_size_runtime, h, w, features])
-        
-        # Reverse the selected dimensions
-        if dims is not None:
-            assert dims[0] is False and dims[3] is False
-            x = tf.reverse(x, dims)
-            
-        # Reorder inputs to (h, w, batch_size, features)
-        x = tf.transpose(x, [1, 2, 0, 3])
-        # Reshape to a one dimensional tensor of (h*w*batch_size , features)
+        # Keep the inputs batch major, as a one dimensional tensor of (batch_size*h*w , features)
         x = tf.reshape(x, [-1, features])
-        # Split tensor into h*w tensors of size (batch_size , features)
-        x = tf.split(axis=0, num_or_size_splits=h * w, value=x)
-        
-        # Create an input tensor array (literally an array of tensors) to use inside the loop
-        inputs_ta = tf.TensorArray(dtype=tf.float32, size=h * w, name='input_ta')
-        # Unestack the input X in the tensor array
-        inputs_ta = inputs_ta.unstack(x)
+        if hoist_input:
+            # Input part of the gates of all the cells, (batch_size*h*w , 5*rnn_size)
+            x = cell.input_projection(x)
+        # Rows of the cell 0 of each batch entry, the cell t is read by a strided gather
+        batch_rows = tf.range(batch_size_runtime) * (h * w)
+
         # Create an input tensor array for the states
         states_ta = tf.TensorArray(dtype=tf.float32, size=h * w + 1, name='state_ta', clear_after_read=False)
         # And an other for the output
@@ -221,7 +535,7 @@ def multi_dimensional_rnn_while_loop(rnn_size, input_data, sh, dims=None, scope_
             # We build the input state in both dimensions
             current_state = state_up[0], state_last[0], state_up[1], state_last[1]
             # Now we calculate the output state and the cell output
-            out, state = cell(inputs_ta.read(time_), current_state)
+            out, state = cell(tf.gather(x, batch_rows + time_), current_state, input_projected=hoist_input)
             # We write the output to the output tensor array
             outputs_ta_ = outputs_ta_.write(time_, out)
             # And save the output state to the state tensor array
@@ -257,7 +571,8 @@ def multi_dimensional_rnn_while_loop(rnn_size, input_data, sh, dims=None, scope_
         return y, states
 
 
-def multi_dimensional_rnn_static(rnn_size, input_data, sh, dims=None, scope_n="layer1"):
+def multi_dimensional_rnn_static(rnn_size, input_data, sh, dims=None, scope_n="layer1", hoist_input=False,
+                                 fused_ln=False):
     """Implements naive multi dimension recurrent neural networks
 
     @param rnn_size: the hidden units
@@ -266,6 +581,9 @@ def multi_dimensional_rnn_static(rnn_size, input_data, sh, dims=None, scope_n="l
     @param dims: dimensions to reverse the input data,eg.
         dims=[False,True,True,False] => true means reverse dimension
     @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
 
     returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm
     """
@@ -273,63 +591,21 @@ def multi_dimensional_rnn_static(rnn_size, input_data, sh, dims=None, scope_n="l
     with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
 
         # Create multidimensional cell with selected size
-        cell = MultiDimensionalLSTMCell(rnn_size)
-
-        # Get the shape of the imput (batch_size, x, y, channels)
-        shape = input_data.get_shape().as_list()
-        batch_size = shape[0]
-        X_dim = shape[1]
-        Y_dim = shape[2]
-        channels = shape[3]
-        # Window size
-        X_win = sh[0]
-        Y_win = sh[1]
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln)
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh, dims)
         # Get the runtime batch size
         batch_size_runtime = tf.shape(input_data)[0]
 
-        # If the imput cannot be exactly sampled by the window, we patch it with zeros
-        if X_dim % X_win != 0:
-            # Get offset size
-            offset = tf.zeros([batch_size_runtime, X_win - (X_dim % X_win), Y_dim, channels])
-            # Concatenate X dimension
-            input_data = tf.concat(axis=1, values=[input_data, offset])
-            # Get new shape
-            shape = input_data.get_shape().as_list()
-            # Update shape value
-            X_dim = shape[1]
-
-        # The same but for Y axis
-        if Y_dim % Y_win != 0:
-            # Get offset size
-            offset = tf.zeros([batch_size_runtime, X_dim, Y_win - (Y_dim % Y_win), channels])
-            # Concatenate Y dimension
-            input_data = tf.concat(axis=2, values=[input_data, offset])
-            # Get new shape
-            shape = input_data.get_shape().as_list()
-            # Update shape value
-            Y_dim = shape[2]
-
-        # Get the steps to perform in X and Y axis
-        h, w = int(X_dim / X_win), int(Y_dim / Y_win)
-
-        # Get the number of features (total number of imput values per step)
-        features = Y_win * X_win * channels
-
-        # Reshape input data to a tensor containing the step indexes and features inputs
-        # The batch size is inferred from the tensor size
-        x = tf.reshape(input_data, [batch_size_runtime, h, w, features])
-
-        # Reverse the selected dimensions
-        if dims is not None:
-            assert dims[0] is False and dims[3] is False
-            x = tf.reverse(x, dims)
-
-        # Reorder inputs to (h, w, batch_size, features)
-        x = tf.transpose(x, [1, 2, 0, 3])
-        # Reshape to a one dimensional tensor of (h*w*batch_size , features)
-        x = tf.reshape(x, [-1, features])
-        # Split tensor into h*w tensors of size (batch_size , features)
-        x = tf.split(axis=0, num_or_size_splits=h * w, value=x)
+        # Keep the inputs batch major, (batch_size, h*w, features)
+        x = tf.reshape(x, [batch_size_runtime, h * w, features])
+        if hoist_input:
+            # Input part of the gates of all the cells, (batch_size, h*w, 5*rnn_size)
+            x = tf.reshape(cell.input_projection(tf.reshape(x, [-1, features])),
+                           [batch_size_runtime, h * w, 5 * rnn_size])
+        # The h*w cells of size (batch_size , features)
+        x = tf.unstack(x, num=h * w, axis=1)
 
         # static loop
         states = []
@@ -345,16 +621,1033 @@ def multi_dimensional_rnn_static(rnn_size, input_data, sh, dims=None, scope_n="l
             state_last = get_lstm_zero_state(batch_size_runtime, rnn_size) \
                 if i % w == 0 else states[i - 1]
             current_state = state_up[0], state_last[0], state_up[1], state_last[1]
-            out, state = cell(x[i], current_state)
+            out, state = cell(x[i], current_state, input_projected=hoist_input)
             outputs.append(out)
             states.append(state)
-        outputs = tf.stack(outputs)
+        # Stack the outputs batch major, (batch_size, h*w, rnn_size)
+        outputs = tf.stack(outputs, axis=1)
 
         # Reshape outputs to match the shape of the imput
-        y = tf.reshape(outputs, [h, w, batch_size_runtime, rnn_size])
+        y = tf.reshape(outputs, [batch_size_runtime, h, w, rnn_size])
+
+        # Reverse if selected
+        if dims is not None:
+            y = tf.reverse(y, dims)
+
+        # Return the output and the inner states
+        return y, states
+
+
+def _row_scan(cell, x, c_up, h_up, rnn_size, hoist_input=False, final_only=False, transposed=False):
+    """Scans the rows of x of shape [rows,w,batch,features] in the order of
+    multi_dimensional_rnn_while_loop, starting from the states c_up, h_up [w,batch,rnn_size]
+    above the first row. Only the states of the previous and of the current row are kept.
+    With transposed, the rows of x are the columns of the grid: the predecessors are given
+    to the cell in the same (up, left) order as for the grid.
+
+    returns the outputs [rows,w,batch,rnn_size] (None with final_only), the LSTMStateTuple of
+    the last row [w,batch,rnn_size] and the LSTMStateTuple of the last cell [batch,rnn_size]
+    """
+    rows = tf.shape(x)[0]
+    w = x.get_shape()[1].value
+    zero = tf.zeros([tf.shape(x)[2], rnn_size], tf.float32)
+    outputs_ta = tf.TensorArray(dtype=tf.float32, size=1 if final_only else rows * w, name='output_ta')
+
+    def row_body(i, c_up_, h_up_, c_last_, h_last_, outputs_ta_):
+        # states of the current row, they become the previous row of the next one
+        c_ta = tf.TensorArray(dtype=tf.float32, size=w, name='c_row_ta')
+        h_ta = tf.TensorArray(dtype=tf.float32, size=w, name='h_row_ta')
+
+        def col_body(j, c_last_, h_last_, c_ta_, h_ta_, outputs_ta_):
+            # The state on the left of the first column is the zero state
+            if transposed:
+                current_state = c_last_, c_up_[j], h_last_, h_up_[j]
+            else:
+                current_state = c_up_[j], c_last_, h_up_[j], h_last_
+            out, state = cell(x[i, j], current_state, input_projected=hoist_input)
+            if not final_only:
+                outputs_ta_ = outputs_ta_.write(i * w + j, out)
+            return j + 1, state[0], state[1], c_ta_.write(j, state[0]), h_ta_.write(j, state[1]), outputs_ta_
+
+        def col_condition(j, c_last_, h_last_, c_ta_, h_ta_, outputs_ta_):
+            return tf.less(j, w)
+
+        _, c_last_, h_last_, c_ta, h_ta, outputs_ta_ = tf.while_loop(
+            col_condition, col_body, [tf.constant(0), zero, zero, c_ta, h_ta, outputs_ta_],
+            parallel_iterations=1)
+        return i + 1, c_ta.stack(), h_ta.stack(), c_last_, h_last_, outputs_ta_
+
+    def row_condition(i, c_up_, h_up_, c_last_, h_last_, outputs_ta_):
+        return tf.less(i, rows)
+
+    _, c_row, h_row, c_last, h_last, outputs_ta = tf.while_loop(
+        row_condition, row_body, [tf.constant(0), c_up, h_up, zero, zero, outputs_ta],
+        parallel_iterations=1)
+    outputs = None if final_only else tf.reshape(outputs_ta.stack(), [rows, w, -1, rnn_size])
+    return outputs, LSTMStateTuple(c_row, h_row), LSTMStateTuple(c_last, h_last)
+
+
+def multi_dimensional_rnn_inference(rnn_size, input_data, sh, dims=None, scope_n="layer1", hoist_input=False,
+                                    fused_ln=False, final_only=False, precision='float32', input_scale=None):
+    """Implements multi dimension recurrent neural networks for inference
+
+    Same scan as multi_dimensional_rnn_while_loop (and the same variables), but a cell only
+    needs the state above it and the state on its left, so only the states of the previous
+    row and of the current row are kept: (w+1) states instead of h*w+1. The states are not
+    returned, so it can not be used to backpropagate through them.
+
+    @param rnn_size: the hidden units
+    @param input_data: the data to process of shape [batch,h,w,channels]
+    @param sh: [height,width] of the windows
+    @param dims: dimensions to reverse the input data,eg.
+        dims=[False,True,True,False] => true means reverse dimension
+    @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+    @param final_only: only return the output of the last cell of the scan
+    @param precision: precision of the kernel matmuls (float32, bfloat16 or int8),
+        see MultiDimensionalLSTMCell
+    @param input_scale: int8 scale of the inputs of the cells, the max of each row if None
+
+    returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm (or [batch,rnn_size] with
+    final_only) and the LSTMStateTuple of the last cell of the scan
+    """
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
+
+        # Create multidimensional cell with selected size
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln, precision=precision, input_scale=input_scale)
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh, dims)
+        # Get the runtime batch size
+        batch_size_runtime = tf.shape(input_data)[0]
+
+        # Reorder inputs to (h, w, batch_size, features)
+        x = tf.transpose(x, [1, 2, 0, 3])
+        if hoist_input:
+            # Input part of the gates of all the cells, (h, w, batch_size, 5*rnn_size)
+            x = tf.reshape(cell.input_projection(tf.reshape(x, [-1, features])), [h, w, -1, 5 * rnn_size])
+
+        # zeros above the first row
+        c_up = tf.zeros([w, batch_size_runtime, rnn_size], tf.float32)
+        h_up = tf.zeros([w, batch_size_runtime, rnn_size], tf.float32)
+        outputs, _, final_state = _row_scan(cell, x, c_up, h_up, rnn_size,
+                                            hoist_input=hoist_input, final_only=final_only)
+
+        if final_only:
+            # The output of a cell is its hidden state
+            return final_state[1], final_state
 
         # Reorder te dimensions to match the input
-        y = tf.transpose(y, [2, 0, 1, 3])
+        y = tf.transpose(outputs, [2, 0, 1, 3])
+        # Reverse if selected
+        if dims is not None:
+            y = tf.reverse(y, dims)
+
+        # Return the output and the state of the last cell
+        return y, final_state
+
+
+def multi_dimensional_rnn_append(rnn_size, input_data, boundary_state=None, sh=(1, 1), axis=1, scope_n="layer1",
+                                 hoist_input=False, fused_ln=False):
+    """Implements multi dimension recurrent neural networks on a grid growing by rows or columns
+
+    The outputs of the new rows (axis=1) or columns (axis=2) of a grid only depend on their
+    inputs and on the states of the last row (or column) already scanned, so appending costs
+    one cell per new cell instead of a scan of the whole grid. The new boundary states are
+    returned to be fed back with the next block. The outputs are the ones of
+    multi_dimensional_rnn_while_loop on the whole grid (and the variables are the same).
+
+    @param rnn_size: the hidden units
+    @param input_data: the new rows or columns of shape [batch,rows,w,channels] or
+        [batch,h,columns,channels], a multiple of the window size along axis
+    @param boundary_state: LSTMStateTuple of the last row [w/sh[1],batch,rnn_size] (or
+        column [h/sh[0],batch,rnn_size]) returned by the previous call, None for the first block
+    @param sh: [height,width] of the windows, the height must be 1 to append columns since
+        _window_input takes the features of a cell from sh[0] consecutive rows of the grid
+    @param axis: 1 to append rows, 2 to append columns
+    @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+
+    returns [batch,rows/sh[0],w/sh[1],rnn_size] (or [batch,h/sh[0],columns/sh[1],rnn_size]) the
+    output of the lstm for the new block and the LSTMStateTuple of its last row (or column)
+    """
+    assert axis == 1 or (axis == 2 and sh[0] == 1)
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
+
+        # Create multidimensional cell with selected size
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln)
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh)
+        # Get the runtime batch size
+        batch_size_runtime = tf.shape(input_data)[0]
+
+        # Reorder inputs to (h, w, batch_size, features), or (w, h, batch_size, features)
+        # to scan a block of columns column by column
+        x = tf.transpose(x, [1, 2, 0, 3] if axis == 1 else [2, 1, 0, 3])
+        lanes = w if axis == 1 else h
+        if hoist_input:
+            # Input part of the gates of all the cells
+            x = tf.reshape(cell.input_projection(tf.reshape(x, [-1, features])), [-1, lanes, batch_size_runtime,
+                                                                                 5 * rnn_size])
+
+        if boundary_state is None:
+            # zeros above the first row (or on the left of the first column)
+            boundary_state = LSTMStateTuple(tf.zeros([lanes, batch_size_runtime, rnn_size], tf.float32),
+                                            tf.zeros([lanes, batch_size_runtime, rnn_size], tf.float32))
+        outputs, boundary_state, _ = _row_scan(cell, x, boundary_state[0], boundary_state[1], rnn_size,
+                                               hoist_input=hoist_input, transposed=axis == 2)
+
+        # Reorder te dimensions to match the input
+        y = tf.transpose(outputs, [2, 0, 1, 3] if axis == 1 else [2, 1, 0, 3])
+
+        # Return the output and the states of the last row (or column)
+        return y, boundary_state
+
+
+def multi_dimensional_rnn_checkpointed(rnn_size, input_data, sh, dims=None, scope_n="layer1", hoist_input=False,
+                                       fused_ln=False, checkpoint_rows=1):
+    """Implements multi dimension recurrent neural networks with gradient checkpointing
+
+    Same scan as multi_dimensional_rnn_while_loop (and the same variables), done by blocks of
+    checkpoint_rows rows. The forward pass only keeps the states of the row above each block,
+    the backward pass of a block runs its forward pass again to get the gates, the layer norm
+    moments and the states of its cells. Smaller blocks use less memory, the cost is about one
+    more forward pass whatever the block size.
+    The variables are created as resource variables, which tf.custom_gradient requires.
+
+    @param rnn_size: the hidden units
+    @param input_data: the data to process of shape [batch,h,w,channels]
+    @param sh: [height,width] of the windows
+    @param dims: dimensions to reverse the input data,eg.
+        dims=[False,True,True,False] => true means reverse dimension
+    @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+    @param checkpoint_rows: the number of rows recomputed together in the backward pass
+
+    returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm and the LSTMStateTuple
+    of the last cell of the scan
+    """
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n, use_resource=True) as var_scope:
+
+        # Create multidimensional cell with selected size
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln)
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh, dims)
+        # Get the runtime batch size
+        batch_size_runtime = tf.shape(input_data)[0]
+
+        # Reorder inputs to (h, w, batch_size, features)
+        x = tf.transpose(x, [1, 2, 0, 3])
+        recurrent_kernels = []
+        if hoist_input:
+            # Input part of the gates of all the cells, (h, w, batch_size, 5*rnn_size)
+            x = tf.reshape(cell.input_projection(tf.reshape(x, [-1, features])), [h, w, -1, 5 * rnn_size])
+            # passed to the blocks so that their gradients are not dropped by tf.custom_gradient
+            recurrent_kernels = list(cell._recurrent_kernels)
+
+        def block_forward(x_block, c_up, h_up, kernels, reuse):
+            with tf.variable_scope(var_scope, reuse=reuse):
+                if kernels:
+                    cell._recurrent_kernels = tuple(kernels)
+                outputs, row_state, _ = _row_scan(cell, x_block, c_up, h_up, rnn_size, hoist_input=hoist_input)
+                return outputs, row_state[0], row_state[1]
+
+        def block(x_block, c_up, h_up, reuse):
+            @tf.custom_gradient
+            def checkpointed(x_block, c_up, h_up, *kernels):
+                outputs, c_row, h_row = block_forward(x_block, c_up, h_up, kernels, reuse)
+
+                def grad(d_outputs, d_c_row, d_h_row, variables=None):
+                    # recompute the block once the gradients of the next blocks are there,
+                    # so that only one block is alive at a time. The gradients of the inputs
+                    # are returned, they must not flow to the previous blocks from here
+                    with tf.control_dependencies([d_outputs, d_c_row, d_h_row]):
+                        inputs = [tf.stop_gradient(t) for t in (x_block, c_up, h_up) + kernels]
+                    recomputed = block_forward(inputs[0], inputs[1], inputs[2], inputs[3:], True)
+                    variables = variables or []
+                    grads = tf.gradients(recomputed, inputs + list(variables),
+                                         grad_ys=[d_outputs, d_c_row, d_h_row])
+                    grads = [tf.zeros_like(t) if g is None else g for t, g in zip(inputs + list(variables), grads)]
+                    return grads[:len(inputs)], grads[len(inputs):]
+
+                return (outputs, c_row, h_row), grad
+            return checkpointed(x_block, c_up, h_up, *recurrent_kernels)
+
+        # zeros above the first row
+        c_up = tf.zeros([w, batch_size_runtime, rnn_size], tf.float32)
+        h_up = tf.zeros([w, batch_size_runtime, rnn_size], tf.float32)
+        outputs = []
+        for start in range(0, h, checkpoint_rows):
+            block_outputs, c_up, h_up = block(x[start:start + checkpoint_rows], c_up, h_up, start > 0)
+            outputs.append(block_outputs)
+        outputs = tf.concat(outputs, axis=0)
+
+        # Reorder te dimensions to match the input
+        y = tf.transpose(outputs, [2, 0, 1, 3])
+        # Reverse if selected
+        if dims is not None:
+            y = tf.reverse(y, dims)
+
+        # Return the output and the state of the last cell
+        return y, LSTMStateTuple(c_up[-1], h_up[-1])
+
+
+def _grid_shape(x):
+    """returns the [batch,h,w,features] shape of the grid x, the batch size and the unknown
+    dimensions are scalar tensors"""
+    shape_runtime = tf.shape(x)
+    return [shape_runtime[k] if k == 0 or dim is None else dim for k, dim in enumerate(x.get_shape().as_list())]
+
+
+def _wavefront_lanes(h, w):
+    """returns whether the cells of the diagonals are indexed (lanes) by the row, which
+    is when the grid is wider than high, and the number of lanes min(h, w).
+    They are python values for a static grid and tensors for a dynamic one.
+    """
+    if isinstance(h, int) and isinstance(w, int):
+        return h <= w, min(h, w)
+    return tf.less_equal(h, w), tf.minimum(h, w)
+
+
+def _select(cond, a, b):
+    """a if cond else b, for a python or a tensor cond (a and b then have the same shape)"""
+    if isinstance(cond, bool):
+        return a if cond else b
+    return tf.where(cond, a, b)
+
+
+def _wavefront_scan(cell, x, rnn_size, hoist_input=False):
+    """Scans the grid x of shape [batch,h,w,features] by anti-diagonal wavefronts
+
+    A cell (i,j) only depends on (i-1,j) and (i,j-1), so all the cells of the anti-diagonal
+    i+j=d are computed by one batched cell step once the diagonal d-1 is done.
+    The diagonals are kept batch major (batch, lanes, ...) so that the rows given to the
+    cell are grouped by batch entry (see MultiDirectionalLSTMCell).
+
+    The grid size may only be known at runtime, one graph then scans all the grid sizes.
+
+    returns the outputs [batch,h,w,rnn_size] and the states (h*w+1, 2, batch_size, rnn_size)
+    in the layout of multi_dimensional_rnn_while_loop
+    """
+    batch_size_runtime, h, w, features = _grid_shape(x)
+
+    # The cells of a diagonal are indexed (lanes) by the shorter side of the grid,
+    # so that a diagonal never has more than min(h, w) cells
+    by_row, lanes = _wavefront_lanes(h, w)
+    steps = h + w - 1
+    lane = tf.range(lanes)
+
+    # Reshape inputs to (batch_size, h*w, features) to gather the cells of a diagonal
+    x = tf.reshape(x, [batch_size_runtime, h * w, features])
+    if hoist_input:
+        # Input part of the gates of all the cells, (batch_size, h*w, 5*rnn_size)
+        x = tf.reshape(cell.input_projection(tf.reshape(x, [-1, features])),
+                       [batch_size_runtime, h * w, 5 * rnn_size])
+        features = 5 * rnn_size
+
+    outputs_ta = tf.TensorArray(dtype=tf.float32, size=steps, name='output_ta')
+    c_ta = tf.TensorArray(dtype=tf.float32, size=steps, name='c_ta')
+    h_ta = tf.TensorArray(dtype=tf.float32, size=steps, name='h_ta')
+
+    # states of the previous diagonal of shape (batch_size, lanes, rnn_size)
+    c_prev = tf.zeros([batch_size_runtime, lanes, rnn_size], tf.float32)
+    h_prev = tf.zeros([batch_size_runtime, lanes, rnn_size], tf.float32)
+
+    def body(d, c_prev_, h_prev_, outputs_ta_, c_ta_, h_ta_):
+        # Position of the cells of the diagonal d
+        i, j = _select(by_row, lane, d - lane), _select(by_row, d - lane, lane)
+        valid = tf.logical_and(tf.logical_and(i >= 0, i < h), tf.logical_and(j >= 0, j < w))
+        mask = tf.reshape(tf.cast(valid, tf.float32), [1, lanes, 1])
+        # Cells outside the grid read a clipped position and are zeroed after the step
+        ind = tf.clip_by_value(i, 0, h - 1) * w + tf.clip_by_value(j, 0, w - 1)
+        x_d = tf.reshape(tf.gather(x, ind, axis=1), [-1, features])
+
+        # The same lane on the previous diagonal is the neighbour along the lanes,
+        # the previous lane is the neighbour across them (zeros for the first lane)
+        c_shift = tf.concat([tf.zeros_like(c_prev_[:, :1]), c_prev_[:, :-1]], axis=1)
+        h_shift = tf.concat([tf.zeros_like(h_prev_[:, :1]), h_prev_[:, :-1]], axis=1)
+        c_up, h_up = _select(by_row, c_shift, c_prev_), _select(by_row, h_shift, h_prev_)
+        c_last, h_last = _select(by_row, c_prev_, c_shift), _select(by_row, h_prev_, h_shift)
+
+        def flat(t):
+            return tf.reshape(t, [-1, rnn_size])
+        current_state = flat(c_up), flat(c_last), flat(h_up), flat(h_last)
+        _, state = cell(x_d, current_state, input_projected=hoist_input)
+        new_c = tf.reshape(state[0], [-1, lanes, rnn_size]) * mask
+        new_h = tf.reshape(state[1], [-1, lanes, rnn_size]) * mask
+
+        # The output of the cell is its hidden state
+        outputs_ta_ = outputs_ta_.write(d, new_h)
+        c_ta_ = c_ta_.write(d, new_c)
+        h_ta_ = h_ta_.write(d, new_h)
+        return d + 1, new_c, new_h, outputs_ta_, c_ta_, h_ta_
+
+    def condition(d, c_prev_, h_prev_, outputs_ta_, c_ta_, h_ta_):
+        return tf.less(d, steps)
+
+    _, _, _, outputs_ta, c_ta, h_ta = tf.while_loop(
+        condition, body, [tf.constant(0), c_prev, h_prev, outputs_ta, c_ta, h_ta],
+        parallel_iterations=1)
+
+    return _unskew(outputs_ta, c_ta, h_ta, h, w, rnn_size)
+
+
+def _unskew(outputs_ta, c_ta, h_ta, h, w, rnn_size, offset=0):
+    """Gathers the cells of the (steps, batch_size, lanes, rnn_size) diagonals of a wavefront scan
+    back to the grid, the diagonal d is at the step d+offset
+
+    returns the outputs [batch,h,w,rnn_size] and the states (h*w+1, 2, batch_size, rnn_size)
+    in the layout of multi_dimensional_rnn_while_loop
+    """
+    by_row, _ = _wavefront_lanes(h, w)
+    # Diagonal and lane of the cell (i,j), (h*w, 1, 1)
+    ii = tf.reshape(tf.tile(tf.expand_dims(tf.range(h), 1), [1, w]), [-1, 1, 1])
+    jj = tf.reshape(tf.tile(tf.expand_dims(tf.range(w), 0), [h, 1]), [-1, 1, 1])
+    diagonal, lane = ii + jj + offset, _select(by_row, ii, jj)
+
+    def unskew(ta, batch_major):
+        # (steps, batch_size, lanes, rnn_size) => (batch_size, h*w, rnn_size) or (h*w, batch_size, rnn_size)
+        # by one gather of the (diagonal, batch entry, lane) of each cell
+        stacked = ta.stack()
+        batch = tf.reshape(tf.range(tf.shape(stacked)[1]), [1, -1, 1])
+        ind = tf.concat([diagonal + 0 * batch, batch + 0 * diagonal, lane + 0 * batch], axis=2)
+        if batch_major:
+            ind = tf.transpose(ind, [1, 0, 2])
+        return tf.gather_nd(stacked, ind)
+
+    # Reshape outputs to match the shape of the imput
+    y = unskew(outputs_ta, batch_major=True)
+    y = tf.reshape(y, [tf.shape(y)[0], h, w, rnn_size])
+    # Same layout as the states of multi_dimensional_rnn_while_loop:
+    # (h*w+1, 2, batch_size, rnn_size) with the zero state at the end
+    states = tf.stack([unskew(c_ta, batch_major=False), unskew(h_ta, batch_major=False)], axis=1)
+    states = tf.concat([states, tf.zeros_like(states[:1])], axis=0)
+    return y, states
+
+
+def multi_dimensional_rnn_wavefront(rnn_size, input_data, sh, dims=None, scope_n="layer1", hoist_input=False,
+                                    fused_ln=False):
+    """Implements multi dimension recurrent neural networks scanned by anti-diagonal wavefronts
+
+    All the cells of an anti-diagonal are computed by one batched cell step (see _wavefront_scan).
+    This takes h+w-1 loop iterations instead of h*w and returns the same outputs and states as
+    multi_dimensional_rnn_while_loop (the variables are also the same).
+    h and w may be unknown (None) until runtime, one graph then serves all the grid sizes.
+
+    @param rnn_size: the hidden units
+    @param input_data: the data to process of shape [batch,h,w,channels]
+    @param sh: [height,width] of the windows
+    @param dims: dimensions to reverse the input data,eg.
+        dims=[False,True,True,False] => true means reverse dimension
+    @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+
+    returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm
+    """
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
+
+        # Create multidimensional cell with selected size
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln)
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh, dims)
+
+        y, states = _wavefront_scan(cell, x, rnn_size, hoist_input=hoist_input)
+
+        # Reverse if selected
+        if dims is not None:
+            y = tf.reverse(y, dims)
+
+        # Return the output and the inner states
+        return y, states
+
+
+def _masked_wavefront_scan(cell, x, active, rnn_size, hoist_input=False, c_fill=None, h_fill=None):
+    """Same as _wavefront_scan where only the cells active[b,i,j] of the grid x [batch,h,w,features]
+    are computed
+
+    The active cells of each diagonal are gathered into one compact batch for the cell step
+    and scattered back, so the inactive cells cost nothing. The states of the inactive cells,
+    which their active neighbours receive, are zero or given by the grids c_fill and h_fill
+    [batch,h,w,rnn_size]. The outputs of the inactive cells are their hidden states.
+    """
+    batch_size_runtime, h, w, features = _grid_shape(x)
+
+    by_row, lanes = _wavefront_lanes(h, w)
+    steps = h + w - 1
+    lane = tf.range(lanes)
+
+    # Reshape inputs to (batch_size*h*w, features), the cell (i,j) of the batch entry b
+    # is the row b*h*w+i*w+j
+    x = tf.reshape(x, [-1, features])
+    if hoist_input:
+        # Input part of the gates of all the cells, (batch_size*h*w, 5*rnn_size)
+        x = cell.input_projection(x)
+    active = tf.reshape(active, [batch_size_runtime, h * w])
+    batch_rows = tf.expand_dims(tf.range(batch_size_runtime) * (h * w), 1)
+    if c_fill is not None:
+        c_fill = tf.reshape(c_fill, [-1, rnn_size])
+        h_fill = tf.reshape(h_fill, [-1, rnn_size])
+
+    outputs_ta = tf.TensorArray(dtype=tf.float32, size=steps, name='output_ta')
+    c_ta = tf.TensorArray(dtype=tf.float32, size=steps, name='c_ta')
+    h_ta = tf.TensorArray(dtype=tf.float32, size=steps, name='h_ta')
+
+    # states of the previous diagonal of shape (batch_size, lanes, rnn_size)
+    c_prev = tf.zeros([batch_size_runtime, lanes, rnn_size], tf.float32)
+    h_prev = tf.zeros([batch_size_runtime, lanes, rnn_size], tf.float32)
+
+    def body(d, c_prev_, h_prev_, outputs_ta_, c_ta_, h_ta_):
+        # Position of the cells of the diagonal d
+        i, j = _select(by_row, lane, d - lane), _select(by_row, d - lane, lane)
+        valid = tf.logical_and(tf.logical_and(i >= 0, i < h), tf.logical_and(j >= 0, j < w))
+        # Cells outside the grid read a clipped position, they are never active
+        ind = tf.clip_by_value(i, 0, h - 1) * w + tf.clip_by_value(j, 0, w - 1)
+        # (batch_size, lanes) active cells of the diagonal
+        active_d = tf.logical_and(tf.gather(active, ind, axis=1), valid)
+        # (active cells, 2) batch entry and lane of the active cells
+        pos = tf.cast(tf.where(active_d), tf.int32)
+        x_d = tf.gather(x, tf.gather_nd(batch_rows + ind, pos))
+
+        # The same lane on the previous diagonal is the neighbour along the lanes,
+        # the previous lane is the neighbour across them (zeros for the first lane)
+        c_shift = tf.concat([tf.zeros_like(c_prev_[:, :1]), c_prev_[:, :-1]], axis=1)
+        h_shift = tf.concat([tf.zeros_like(h_prev_[:, :1]), h_prev_[:, :-1]], axis=1)
+        c_up, h_up = _select(by_row, c_shift, c_prev_), _select(by_row, h_shift, h_prev_)
+        c_last, h_last = _select(by_row, c_prev_, c_shift), _select(by_row, h_prev_, h_shift)
+
+        current_state = [tf.gather_nd(t, pos) for t in [c_up, c_last, h_up, h_last]]
+        _, state = cell(x_d, current_state, input_projected=hoist_input)
+        new_c = tf.scatter_nd(pos, state[0], [batch_size_runtime, lanes, rnn_size])
+        new_h = tf.scatter_nd(pos, state[1], [batch_size_runtime, lanes, rnn_size])
+        if c_fill is not None:
+            # The inactive cells of the grid take the given states
+            fill = tf.expand_dims(tf.cast(tf.logical_and(tf.logical_not(active_d), valid), tf.float32), 2)
+            new_c += tf.gather(c_fill, batch_rows + ind) * fill
+            new_h += tf.gather(h_fill, batch_rows + ind) * fill
+
+        # The output of the cell is its hidden state
+        outputs_ta_ = outputs_ta_.write(d, new_h)
+        c_ta_ = c_ta_.write(d, new_c)
+        h_ta_ = h_ta_.write(d, new_h)
+        return d + 1, new_c, new_h, outputs_ta_, c_ta_, h_ta_
+
+    def condition(d, c_prev_, h_prev_, outputs_ta_, c_ta_, h_ta_):
+        return tf.less(d, steps)
+
+    _, _, _, outputs_ta, c_ta, h_ta = tf.while_loop(
+        condition, body, [tf.constant(0), c_prev, h_prev, outputs_ta, c_ta, h_ta],
+        parallel_iterations=1)
+    return _unskew(outputs_ta, c_ta, h_ta, h, w, rnn_size)
+
+
+def multi_dimensional_rnn_ragged(rnn_size, input_data, lengths, sh, dims=None, scope_n="layer1", hoist_input=False,
+                                 fused_ln=False):
+    """Implements multi dimension recurrent neural networks over a batch of samples of
+    different sizes, padded to the largest one at the top-left of input_data
+
+    Only the cells inside the extent of their sample are computed (see _masked_wavefront_scan),
+    the others are zero. A sample gives the same outputs as multi_dimensional_rnn_wavefront run
+    on it alone (the variables are also the same).
+
+    @param rnn_size: the hidden units
+    @param input_data: the data to process of shape [batch,h,w,channels], h and w may be None
+    @param lengths: int32 tensor [batch,2] the height and width of each sample in steps of the
+        grid [h/sh[0],w/sh[1]] (in input_data rows and columns when sh=[1,1])
+    @param sh: [height,width] of the windows
+    @param dims: dimensions to reverse the input data,eg.
+        dims=[False,True,True,False] => true means reverse dimension, within the extent of each sample
+    @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+
+    returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm
+    """
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
+
+        # Create multidimensional cell with selected size
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln)
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh)
+
+        def reverse(t):
+            # Reverses the selected dimensions inside the extent of each sample
+            for axis in [1, 2]:
+                if dims is not None and dims[axis]:
+                    t = tf.reverse_sequence(t, lengths[:, axis - 1], seq_axis=axis, batch_axis=0)
+            return t
+
+        # The sample b only covers the cells (i,j) with i<lengths[b,0] and j<lengths[b,1],
+        # the cells outside its extent are zero
+        active = tf.logical_and(tf.expand_dims(tf.sequence_mask(lengths[:, 0], h), 2),
+                                tf.expand_dims(tf.sequence_mask(lengths[:, 1], w), 1))
+        y, states = _masked_wavefront_scan(cell, reverse(x), active, rnn_size, hoist_input=hoist_input)
+
+        # Reverse if selected
+        y = reverse(y)
+
+        # Return the output and the inner states
+        return y, states
+
+
+def multi_dimensional_rnn_pyramid(rnn_size, input_data, sh, factor, keep=0.25, dims=None, scope_n="layer1",
+                                  hoist_input=False, fused_ln=False):
+    """Implements a two level multi dimension recurrent neural network: a coarse pass over blocks of
+    factor[0] x factor[1] cells, then a fine pass over the cells of the blocks it scores as relevant
+
+    The coarse MD-LSTM (scope scope_n_coarse) reads the cells of a block at once. A linear layer scores
+    its outputs and the keep fraction of the blocks with the highest scores of each sample are scanned
+    at full resolution by the fine MD-LSTM (scope scope_n, see _masked_wavefront_scan). The cells of the
+    other blocks take the coarse states of their block, so only the relevant blocks cost a fine step.
+    The output is the fine output of the relevant blocks and the coarse output elsewhere, the score
+    gets its gradient through a straight-through gate on the refinement.
+
+    @param rnn_size: the hidden units
+    @param input_data: the data to process of shape [batch,h,w,channels]
+    @param sh: [height,width] of the windows of the fine pass
+    @param factor: [height,width] of the blocks of the coarse pass, in fine cells
+    @param keep: the fraction of the blocks of each sample scanned by the fine pass
+    @param dims: dimensions to reverse the input data,eg.
+        dims=[False,True,True,False] => true means reverse dimension
+    @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+
+    returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm and the states of the fine pass
+    """
+    # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+    x, h, w, features = _window_input(input_data, sh, dims)
+    batch_size_runtime = tf.shape(x)[0]
+    # Pad the grid to a multiple of the blocks, the padding cells are never scanned by the fine pass
+    fh, fw = factor
+    hc, wc = -(-h // fh), -(-w // fw)
+    x = tf.pad(x, [[0, 0], [0, hc * fh - h], [0, wc * fw - w], [0, 0]])
+
+    # The blocks of cells (batch_size, hc, wc, fh*fw*features)
+    xc = tf.reshape(tf.transpose(tf.reshape(x, [batch_size_runtime, hc, fh, wc, fw, features]), [0, 1, 3, 2, 4, 5]),
+                    [batch_size_runtime, hc, wc, fh * fw * features])
+
+    def upsample(t):
+        # (batch_size, hc, wc, n) => (batch_size, hc*fh, wc*fw, n), each block to its cells
+        n = t.get_shape().as_list()[-1]
+        t = tf.tile(tf.reshape(t, [batch_size_runtime, hc, 1, wc, 1, n]), [1, 1, fh, 1, fw, 1])
+        return tf.reshape(t, [batch_size_runtime, hc * fh, wc * fw, n])
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n + "_coarse"):
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln)
+        yc, states_c = _wavefront_scan(cell, xc, rnn_size, hoist_input=hoist_input)
+        # Relevance of the blocks (batch_size, hc*wc)
+        score_w = vs.get_variable('score/kernel', [rnn_size, 1], dtype=tf.float32)
+        score_b = vs.get_variable('score/bias', [1], dtype=tf.float32, initializer=tf.zeros_initializer())
+        score = tf.reshape(math_ops.matmul(tf.reshape(yc, [-1, rnn_size]), score_w) + score_b,
+                           [batch_size_runtime, hc * wc])
+        relevance = tf.sigmoid(score)
+        # The keep fraction of the blocks of each sample with the highest relevance
+        k = max(1, int(math.ceil(keep * hc * wc)))
+        threshold = tf.nn.top_k(relevance, k=k).values[:, k - 1:]
+        refined = tf.reshape(relevance >= threshold, [batch_size_runtime, hc, wc, 1])
+
+    # The fine cells of the relevant blocks inside the grid
+    inside = tf.logical_and(tf.reshape(tf.range(hc * fh) < h, [1, -1, 1, 1]),
+                            tf.reshape(tf.range(wc * fw) < w, [1, 1, -1, 1]))
+    active = tf.squeeze(tf.logical_and(upsample(tf.cast(refined, tf.float32)) > 0, inside), axis=3)
+    # The coarse states of the blocks (h*w+1, 2, batch_size, rnn_size) => (batch_size, hc, wc, rnn_size)
+    c_coarse, h_coarse = [tf.reshape(tf.transpose(states_c[:-1, s], [1, 0, 2]), [batch_size_runtime, hc, wc, rnn_size])
+                          for s in range(2)]
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln)
+        y, states = _masked_wavefront_scan(cell, x, active, rnn_size, hoist_input=hoist_input,
+                                           c_fill=upsample(c_coarse), h_fill=upsample(yc))
+
+    # Straight-through gate: the value of the refinement is kept and its gradient reaches the relevance
+    gate = upsample(tf.reshape(relevance / tf.stop_gradient(relevance), [batch_size_runtime, hc, wc, 1]))
+    y_coarse = upsample(yc)
+    y = y_coarse + (y - y_coarse) * gate
+    y = y[:, :h, :w]
+
+    # Reverse if selected
+    if dims is not None:
+        y = tf.reverse(y, dims)
+
+    # Return the output and the inner states
+    return y, states
+
+
+def multi_dimensional_rnn_stacked(rnn_size, input_data, sh, num_layers=2, dims=None, scope_n="layer",
+                                  hoist_input=False, fused_ln=False):
+    """Implements num_layers stacked multi dimension recurrent neural networks scanned by one
+    pipelined wavefront
+
+    The cell (i,j) of the layer k only needs the cell (i,j) of the layer k-1, so at the step t
+    the layer k computes its diagonal t-k (see _wavefront_scan) from the diagonal the layer k-1
+    computed at the step t-1. The layers overlap and the stack takes h+w+num_layers-2 steps
+    instead of num_layers*(h+w-1). The outputs and the variables are the ones of stacking
+    multi_dimensional_rnn_wavefront layers with the scopes scope_n1, scope_n2, ...
+
+    @param rnn_size: the hidden units of each layer
+    @param input_data: the data to process of shape [batch,h,w,channels], h and w may be None
+    @param sh: [height,width] of the windows of the first layer
+    @param num_layers: the number of layers
+    @param dims: dimensions to reverse the input data,eg.
+        dims=[False,True,True,False] => true means reverse dimension, for all the layers
+    @param scope_n : the scope of the layers, followed by their number from 1
+    @param hoist_input: compute the input part of the gates of all the cells of the first
+        layer with one matmul before the recurrence
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+
+    returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the last layer and the states
+    (h*w+1, 2, batch_size, rnn_size) of each layer
+    """
+    # Create the multidimensional cell of each layer with selected size in its scope
+    cells, scopes = [], []
+    for k in range(num_layers):
+        with tf.variable_scope("MultiDimensionalLSTMCell-{}{}".format(scope_n, k + 1)) as scope:
+            cells.append(MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln))
+            scopes.append(scope)
+
+    # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+    x, _, _, _ = _window_input(input_data, sh, dims)
+    batch_size_runtime, h, w, features = _grid_shape(x)
+    by_row, lanes = _wavefront_lanes(h, w)
+    steps = h + w - 1 + num_layers - 1
+    lane = tf.range(lanes)
+
+    # Reshape inputs to (batch_size, h*w, features) to gather the cells of a diagonal
+    x = tf.reshape(x, [batch_size_runtime, h * w, features])
+    if hoist_input:
+        with tf.variable_scope(scopes[0]):
+            # Input part of the gates of all the cells, (batch_size, h*w, 5*rnn_size)
+            x = tf.reshape(cells[0].input_projection(tf.reshape(x, [-1, features])),
+                           [batch_size_runtime, h * w, 5 * rnn_size])
+            features = 5 * rnn_size
+
+    outputs_ta = tf.TensorArray(dtype=tf.float32, size=steps, name='output_ta')
+    c_tas = [tf.TensorArray(dtype=tf.float32, size=steps, name='c_ta') for _ in range(num_layers)]
+    h_tas = [tf.TensorArray(dtype=tf.float32, size=steps, name='h_ta') for _ in range(num_layers)]
+
+    # states of the previous diagonal of each layer of shape (batch_size, lanes, rnn_size)
+    c_prev = [tf.zeros([batch_size_runtime, lanes, rnn_size], tf.float32) for _ in range(num_layers)]
+    h_prev = [tf.zeros([batch_size_runtime, lanes, rnn_size], tf.float32) for _ in range(num_layers)]
+
+    def body(t, c_prev_, h_prev_, outputs_ta_, c_tas_, h_tas_):
+        new_cs, new_hs = [], []
+        for k in range(num_layers):
+            # Position of the cells of the diagonal t-k of the layer k
+            d = t - k
+            i, j = _select(by_row, lane, d - lane), _select(by_row, d - lane, lane)
+            valid = tf.logical_and(tf.logical_and(i >= 0, i < h), tf.logical_and(j >= 0, j < w))
+            mask = tf.reshape(tf.cast(valid, tf.float32), [1, lanes, 1])
+            if k == 0:
+                # Cells outside the grid read a clipped position and are zeroed after the step
+                ind = tf.clip_by_value(i, 0, h - 1) * w + tf.clip_by_value(j, 0, w - 1)
+                x_d = tf.reshape(tf.gather(x, ind, axis=1), [-1, features])
+            else:
+                # The same diagonal of the layer below, computed at the previous step
+                x_d = tf.reshape(h_prev_[k - 1], [-1, rnn_size])
+
+            # The same lane on the previous diagonal is the neighbour along the lanes,
+            # the previous lane is the neighbour across them (zeros for the first lane)
+            c_shift = tf.concat([tf.zeros_like(c_prev_[k][:, :1]), c_prev_[k][:, :-1]], axis=1)
+            h_shift = tf.concat([tf.zeros_like(h_prev_[k][:, :1]), h_prev_[k][:, :-1]], axis=1)
+            c_up, h_up = _select(by_row, c_shift, c_prev_[k]), _select(by_row, h_shift, h_prev_[k])
+            c_last, h_last = _select(by_row, c_prev_[k], c_shift), _select(by_row, h_prev_[k], h_shift)
+
+            def flat(t_):
+                return tf.reshape(t_, [-1, rnn_size])
+            current_state = flat(c_up), flat(c_last), flat(h_up), flat(h_last)
+            with tf.variable_scope(scopes[k]):
+                _, state = cells[k](x_d, current_state, input_projected=hoist_input and k == 0)
+            new_cs.append(tf.reshape(state[0], [-1, lanes, rnn_size]) * mask)
+            new_hs.append(tf.reshape(state[1], [-1, lanes, rnn_size]) * mask)
+
+        # The output of the stack is the hidden state of the last layer
+        outputs_ta_ = outputs_ta_.write(t, new_hs[-1])
+        c_tas_ = [ta.write(t, new_c) for ta, new_c in zip(c_tas_, new_cs)]
+        h_tas_ = [ta.write(t, new_h) for ta, new_h in zip(h_tas_, new_hs)]
+        return t + 1, new_cs, new_hs, outputs_ta_, c_tas_, h_tas_
+
+    def condition(t, c_prev_, h_prev_, outputs_ta_, c_tas_, h_tas_):
+        return tf.less(t, steps)
+
+    _, _, _, outputs_ta, c_tas, h_tas = tf.while_loop(
+        condition, body, [tf.constant(0), c_prev, h_prev, outputs_ta, c_tas, h_tas], parallel_iterations=1)
+
+    # The diagonal d of the layer k is at the step d+k
+    states = []
+    for k in range(num_layers):
+        y, states_k = _unskew(outputs_ta, c_tas[k], h_tas[k], h, w, rnn_size, offset=k)
+        states.append(states_k)
+
+    # Reverse if selected
+    if dims is not None:
+        y = tf.reverse(y, dims)
+
+    # Return the output and the inner states
+    return y, states
+
+
+# Axes of [batch,h,w,features] reversed for the four scan directions, which start from
+# the top-left, top-right, bottom-left and bottom-right corners
+DIRECTIONS = [[], [2], [1], [1, 2]]
+
+
+def multi_dimensional_rnn_multi_directional(rnn_size, input_data, sh, scope_n="layer1", hoist_input=False,
+                                            fused_ln=False):
+    """Implements the four directions multi dimension recurrent neural networks layer
+
+    The grid flipped for each of the DIRECTIONS is stacked along the batch axis and the four
+    directions, each with its own weights (see MultiDirectionalLSTMCell), are scanned by one
+    anti-diagonal wavefront loop instead of four loops.
+
+    @param rnn_size: the hidden units of each direction
+    @param input_data: the data to process of shape [batch,h,w,channels]
+    @param sh: [height,width] of the windows
+    @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the two recurrent projections
+    @param fused_ln: normalize the five gates of a cell with one moments computation
+
+    returns [batch,h/sh[0],w/sh[1],4*rnn_size] the outputs of the DIRECTIONS concatenated
+    along the last axis, and the states (h*w+1, 2, 4*batch_size, rnn_size) where the
+    directions are the blocks of the batch axis, each in its own scan order
+    """
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
+
+        # Create the cell of the four directions with selected size
+        cell = MultiDirectionalLSTMCell(rnn_size, num_directions=len(DIRECTIONS), fused_ln=fused_ln)
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh)
+
+        # Flip the grid of each direction and stack them to (4*batch_size, h, w, features)
+        x = tf.concat([tf.reverse(x, d) if d else x for d in DIRECTIONS], axis=0)
+
+        y, states = _wavefront_scan(cell, x, rnn_size, hoist_input=hoist_input)
+
+        # Un-flip the output of each direction
+        y = tf.split(y, len(DIRECTIONS), axis=0)
+        y = tf.concat([tf.reverse(y_d, d) if d else y_d for y_d, d in zip(y, DIRECTIONS)], axis=3)
+
+        # Return the output and the inner states
+        return y, states
+
+
+def _hyperplane_tables(shape):
+    """Index tables of the hyperplanes sum(idx)=k of a grid of the given shape
+
+    returns, for the planes x lanes slots (lanes is the size of the largest plane):
+    cells: the row major index of the cell of a slot (0 for the empty slots)
+    valid: whether a slot holds a cell
+    preds: for each dimension d, the slot in the previous plane of the cell idx-e_d,
+        lanes when it is outside the grid
+    slots: the slot of each cell in the stacked (planes*lanes) slots
+    """
+    idx = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), axis=-1).reshape([-1, len(shape)])
+    plane = idx.sum(axis=1)
+    planes = plane.max() + 1
+    lanes = np.bincount(plane).max()
+    # slot of each cell in its plane
+    lane = np.zeros_like(plane)
+    for k in range(planes):
+        lane[plane == k] = np.arange(np.sum(plane == k))
+    cells = np.zeros([planes, lanes], np.int32)
+    valid = np.zeros([planes, lanes], np.float32)
+    preds = np.full([planes, lanes, len(shape)], lanes, np.int32)
+    cells[plane, lane] = np.arange(len(idx))
+    valid[plane, lane] = 1
+    strides = np.cumprod([1] + list(shape[:0:-1]))[::-1]
+    for d in range(len(shape)):
+        has_pred = idx[:, d] > 0
+        preds[plane[has_pred], lane[has_pred], d] = lane[np.arange(len(idx))[has_pred] - strides[d]]
+    return cells, valid, preds, (plane * lanes + lane).astype(np.int32)
+
+
+def multi_dimensional_rnn_hyperplane(rnn_size, input_data, scope_n="layer1", hoist_input=False, fused_ln=False):
+    """Implements N dimension recurrent neural networks scanned by hyperplane wavefronts
+
+    A cell idx depends on the N cells idx-e_d, so all the cells of the hyperplane sum(idx)=k are
+    computed by one batched cell step once the plane k-1 is done. This takes sum(shape)-N+1
+    loop iterations instead of prod(shape). In 2D this is the anti-diagonal wavefront and the
+    variables are the same as the ones of multi_dimensional_rnn_while_loop.
+
+    @param rnn_size: the hidden units
+    @param input_data: the data to process of shape [batch,d1,...,dN,features]
+    @param scope_n : the scope
+    @param hoist_input: compute the input part of the gates of all the cells with one matmul
+        before the recurrence, which then only does the recurrent projections
+    @param fused_ln: normalize the gates of a cell with one moments computation
+
+    returns [batch,d1,...,dN,rnn_size] the output of the lstm and the states
+    (prod(shape)+1, 2, batch_size, rnn_size) with the cells in row major order and the zero
+    state at the end
+    """
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
+
+        shape = input_data.get_shape().as_list()[1:-1]
+        features = input_data.get_shape()[-1].value
+        num_dims = len(shape)
+        # Create multidimensional cell with selected size
+        cell = MultiDimensionalLSTMCell(rnn_size, fused_ln=fused_ln, num_dims=num_dims)
+        # Get the runtime batch size
+        batch_size_runtime = tf.shape(input_data)[0]
+
+        cells, valid, preds, slots = _hyperplane_tables(shape)
+        planes, lanes = cells.shape
+        cells, valid, preds = tf.constant(cells), tf.constant(valid), tf.constant(preds)
+
+        # Reshape inputs to (batch_size, cells, features) to gather the cells of a plane
+        x = tf.reshape(input_data, [batch_size_runtime, -1, features])
+        if hoist_input:
+            # Input part of the gates of all the cells, (batch_size, cells, num_gates*rnn_size)
+            x = tf.reshape(cell.input_projection(tf.reshape(x, [-1, features])),
+                           [batch_size_runtime, -1, (num_dims + 3) * rnn_size])
+            features = (num_dims + 3) * rnn_size
+
+        outputs_ta = tf.TensorArray(dtype=tf.float32, size=planes, name='output_ta')
+        c_ta = tf.TensorArray(dtype=tf.float32, size=planes, name='c_ta')
+        h_ta = tf.TensorArray(dtype=tf.float32, size=planes, name='h_ta')
+
+        # states of the previous plane of shape (batch_size, lanes, rnn_size)
+        c_prev = tf.zeros([batch_size_runtime, lanes, rnn_size], tf.float32)
+        h_prev = tf.zeros([batch_size_runtime, lanes, rnn_size], tf.float32)
+
+        def flat(t):
+            return tf.reshape(t, [-1, rnn_size])
+
+        def body(k, c_prev_, h_prev_, outputs_ta_, c_ta_, h_ta_):
+            x_k = tf.reshape(tf.gather(x, cells[k], axis=1), [-1, features])
+            # The predecessors outside the grid read the zero state in the extra slot
+            c_pad = tf.concat([c_prev_, tf.zeros_like(c_prev_[:, :1])], axis=1)
+            h_pad = tf.concat([h_prev_, tf.zeros_like(h_prev_[:, :1])], axis=1)
+            cs = [flat(tf.gather(c_pad, preds[k, :, d], axis=1)) for d in range(num_dims)]
+            hs = [flat(tf.gather(h_pad, preds[k, :, d], axis=1)) for d in range(num_dims)]
+            _, state = cell(x_k, cs + hs, input_projected=hoist_input)
+            # The empty slots are zeroed after the step
+            mask = tf.reshape(valid[k], [1, lanes, 1])
+            new_c = tf.reshape(state[0], [-1, lanes, rnn_size]) * mask
+            new_h = tf.reshape(state[1], [-1, lanes, rnn_size]) * mask
+
+            # The output of the cell is its hidden state
+            outputs_ta_ = outputs_ta_.write(k, new_h)
+            c_ta_ = c_ta_.write(k, new_c)
+            h_ta_ = h_ta_.write(k, new_h)
+            return k + 1, new_c, new_h, outputs_ta_, c_ta_, h_ta_
+
+        def condition(k, c_prev_, h_prev_, outputs_ta_, c_ta_, h_ta_):
+            return tf.less(k, planes)
+
+        _, _, _, outputs_ta, c_ta, h_ta = tf.while_loop(
+            condition, body, [tf.constant(0), c_prev, h_prev, outputs_ta, c_ta, h_ta],
+            parallel_iterations=1)
+
+        def unskew(ta):
+            # (planes, batch_size, lanes, rnn_size) => (batch_size, cells, rnn_size)
+            stacked = tf.reshape(tf.transpose(ta.stack(), [1, 0, 2, 3]),
+                                 [batch_size_runtime, planes * lanes, rnn_size])
+            return tf.gather(stacked, slots, axis=1)
+
+        # Reshape outputs to match the shape of the imput
+        y = tf.reshape(unskew(outputs_ta), [batch_size_runtime] + shape + [rnn_size])
+        states = tf.transpose(tf.stack([unskew(c_ta), unskew(h_ta)], axis=1), [2, 1, 0, 3])
+        states = tf.concat([states, tf.zeros_like(states[:1])], axis=0)
+
+        # Return the output and the inner states
+        return y, states
+
+
+_md_lstm_op = None
+
+
+def _load_md_lstm_op():
+    """Loads md_lstm_op.so (built by build.sh) the first time the native engine is used"""
+    global _md_lstm_op
+    if _md_lstm_op is None:
+        _md_lstm_op = tf.load_op_library(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'md_lstm_op.so'))
+    return _md_lstm_op
+
+
+@ops.RegisterGradient("MdLstmForward")
+def _md_lstm_forward_grad(op, grad_h, grad_c):
+    return _load_md_lstm_op().md_lstm_backward(*(list(op.inputs) + list(op.outputs) + [grad_h, grad_c]),
+                                               forget_bias=op.get_attr('forget_bias'))
+
+
+def multi_dimensional_rnn_native(rnn_size, input_data, sh, dims=None, scope_n="layer1", fused_ln=False):
+    """Implements multi dimension recurrent neural networks with the fused CPU kernel of md_lstm_op.cc
+
+    The input part of the gates of all the cells is computed by one matmul, the recurrence, the
+    gates and the layer norms are run by the MdLstmForward op (and MdLstmBackward for the
+    gradients), sharded over the worker threads. The variables are the same as the ones of
+    multi_dimensional_rnn_while_loop.
+
+    @param rnn_size: the hidden units
+    @param input_data: the data to process of shape [batch,h,w,channels]
+    @param sh: [height,width] of the windows
+    @param dims: dimensions to reverse the input data,eg.
+        dims=[False,True,True,False] => true means reverse dimension
+    @param scope_n : the scope
+    @param fused_ln: store the layer norm of the five gates in gates/layer_norm (see fused_ln)
+
+    returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm and the states
+    (h*w+1, 2, batch_size, rnn_size) in the layout of multi_dimensional_rnn_while_loop
+    """
+
+    with tf.variable_scope("MultiDimensionalLSTMCell-" + scope_n):
+
+        # Pad the input to the window size and reshape it to (batch_size, h, w, features)
+        x, h, w, features = _window_input(input_data, sh, dims)
+        # Get the runtime batch size
+        batch_size_runtime = tf.shape(input_data)[0]
+
+        # The variables of MultiDimensionalLSTMCell
+        with tf.variable_scope("MultiDimensionalLSTMCell"):
+            weights = vs.get_variable('kernel', [features + 2 * rnn_size, 5 * rnn_size], dtype=tf.float32,
+                                      initializer=None)
+
+            def ln_variables(scope, shape):
+                with tf.variable_scope(scope + 'layer_norm'):
+                    return tf.get_variable('scale', shape=shape, initializer=tf.constant_initializer(1)), \
+                           tf.get_variable('shift', shape=shape, initializer=tf.constant_initializer(0))
+            if fused_ln:
+                gate_scale, gate_shift = ln_variables('gates/', [5, rnn_size])
+            else:
+                gates = [ln_variables(g + '/', [rnn_size]) for g in MultiDimensionalLSTMCell.GATES]
+                gate_scale, gate_shift = tf.stack([g[0] for g in gates]), tf.stack([g[1] for g in gates])
+            new_h_scale, new_h_shift = ln_variables('new_h/', [rnn_size])
+
+        # Input part of the gates of all the cells, (batch_size, h, w, 5*rnn_size)
+        x_proj = tf.reshape(math_ops.matmul(tf.reshape(x, [-1, features]), weights[:features]),
+                            [batch_size_runtime, h, w, 5 * rnn_size])
+        y, c = _load_md_lstm_op().md_lstm_forward(x_proj, weights[features:], gate_scale, gate_shift,
+                                                  new_h_scale, new_h_shift)
+
+        # Same layout as the states of multi_dimensional_rnn_while_loop:
+        # (h*w+1, 2, batch_size, rnn_size) with the zero state at the end
+        states = tf.transpose(tf.reshape(tf.stack([c, y], axis=1), [batch_size_runtime, 2, h * w, rnn_size]),
+                              [2, 1, 0, 3])
+        states = tf.concat([states, tf.zeros_like(states[:1])], axis=0)
+
         # Reverse if selected
         if dims is not None:
             y = tf.reverse(y, dims)
@@ -0,0 +1,222 @@
+import numpy as np
+
+
+def load_weights(path):
+    """Loads the weights of an MD-LSTM layer written by md_lstm.export_weights
+
+    The layer norm of the gates is returned as one (num_gates, num_units) scale and shift,
+    whether the layer was trained with fused_ln (gates/layer_norm) or not (i/, j/, f1/, f2/, o/).
+    """
+    with np.load(path) as data:
+        weights = dict(data.items())
+    if 'precision' in weights:
+        # written by save_weights
+        weights['precision'] = str(weights['precision'])
+        return weights
+    if 'gates/layer_norm/scale' not in weights:
+        gates = ['i', 'j', 'f1', 'f2', 'o']
+        for v in ['scale', 'shift']:
+            weights['gates/layer_norm/' + v] = np.stack([weights['{}/layer_norm/{}'.format(g, v)] for g in gates])
+    return {
+        'kernel': weights['kernel'],
+        'gates_scale': weights['gates/layer_norm/scale'],
+        'gates_shift': weights['gates/layer_norm/shift'],
+        'new_h_scale': weights['new_h/layer_norm/scale'],
+        'new_h_shift': weights['new_h/layer_norm/shift'],
+    }
+
+
+def save_weights(path, weights):
+    """Writes the weights given by load_weights or quantize_weights to the npz file path"""
+    np.savez(path, **{k: v for k, v in weights.items() if v is not None})
+
+
+def to_bfloat16(x):
+    """Rounds (to nearest even) the float32 x to bfloat16 values, which are kept as float32"""
+    bits = np.array(x, dtype=np.float32).view(np.uint32)
+    bits += 0x7FFF + ((bits >> 16) & 1)
+    bits &= 0xFFFF0000
+    return bits.view(np.float32)
+
+
+def quantize_weights(weights, precision, input_scale=None):
+    """Reduced precision weights for the matmuls of multi_dimensional_rnn, the layer norms and the
+    states stay float32.
+
+    bfloat16: the kernel is rounded to bfloat16 (kept as its uint16 bits) and so are the inputs
+        of the matmuls, which accumulate in float32.
+    int8: the kernel is quantized with one scale per output channel (column). The cell inputs are
+        quantized with input_scale (given by calibrate, or the max of each row if None) and the hidden
+        units with the max of each row: they are often far smaller than their (-1, 1) range, and the
+        layer norm of the gates would scale up their quantization error.
+
+    This is the accuracy reference of md_lstm.MultiDimensionalLSTMCell(precision=...): the reduced
+    precision values are run by float32 matmuls, the int8 products are exact in float32 (the bfloat16
+    matmul of TensorFlow also rounds its outputs to bfloat16).
+    """
+    quantized = dict(weights, precision=precision)
+    if precision == 'bfloat16':
+        quantized['kernel'] = (to_bfloat16(weights['kernel']).view(np.uint32) >> 16).astype(np.uint16)
+    elif precision == 'int8':
+        kernel = weights['kernel']
+        scale = np.maximum(np.abs(kernel).max(axis=0), 1e-8) / 127
+        quantized['kernel'] = np.round(kernel / scale).astype(np.int8)
+        quantized['kernel_scale'] = scale.astype(np.float32)
+        quantized['input_scale'] = None if input_scale is None else np.float32(input_scale)
+    elif precision != 'float32':
+        raise Exception('not supported precision (should be one of "float32", "bfloat16", "int8").')
+    return quantized
+
+
+def float_kernel(weights):
+    """The kernel of the weights as float32, whatever their precision"""
+    precision = weights.get('precision', 'float32')
+    if precision == 'bfloat16':
+        return (weights['kernel'].astype(np.uint32) << 16).view(np.float32)
+    if precision == 'int8':
+        # the quantized values, the scales are applied by matmul
+        return weights['kernel'].astype(np.float32)
+    return weights['kernel']
+
+
+def calibrate(weights, batches, sh, dims=None, percentiles=(100, 99.99, 99.9)):
+    """int8 weights with the scale of the cell inputs which gives the outputs the closest to float32
+    on the batches of input data: the max of each row (dynamic) or a percentile of the inputs (static).
+    Few inputs (e.g. one channel) are better kept dynamic, as the layer norm of the gates only keeps
+    their sign then.
+
+    returns the int8 weights and the relative error of their outputs on the batches
+    """
+    reference = [multi_dimensional_rnn(weights, x, sh, dims) for x in batches]
+    inputs = np.abs(np.concatenate([window_input(np.asarray(x, dtype=np.float32), sh, dims).reshape(-1)
+                                    for x in batches]))
+    best = None
+    for input_scale in [None] + [max(np.percentile(inputs, p), 1e-8) / 127 for p in percentiles]:
+        quantized = quantize_weights(weights, 'int8', input_scale=input_scale)
+        err = np.sqrt(sum(np.sum(np.square(multi_dimensional_rnn(quantized, x, sh, dims) - y))
+                          for x, y in zip(batches, reference)) / sum(np.sum(np.square(y)) for y in reference))
+        if best is None or err < best[1]:
+            best = quantized, err
+    return best
+
+
+def matmul(a, kernel, weights, scale=None, out=None):
+    """matmul(a, kernel) in the precision of the weights, kernel is a part of the rows of weights['kernel']
+    as float32 and scale the int8 scale of a (the max of each row if None)"""
+    precision = weights.get('precision', 'float32')
+    if precision == 'bfloat16':
+        return np.matmul(to_bfloat16(a), kernel, out=out)
+    if precision == 'int8':
+        if scale is None:
+            scale = np.maximum(np.abs(a).max(axis=-1, keepdims=True), 1e-8) / 127
+        out = np.matmul(np.clip(np.round(a / scale), -127, 127), kernel, out=out)
+        out *= scale
+        out *= weights['kernel_scale']
+        return out
+    return np.matmul(a, kernel, out=out)
+
+
+def sigmoid(x, out=None):
+    out = np.negative(x, out=out)
+    np.exp(out, out=out)
+    out += 1
+    return np.reciprocal(out, out=out)
+
+
+def ln(x, scale, shift, epsilon=1e-5):
+    """ Layer normalizes x along its last axis in place """
+    x -= x.mean(axis=-1, keepdims=True)
+    x /= np.sqrt(np.mean(np.square(x), axis=-1, keepdims=True) + epsilon)
+    x *= scale
+    x += shift
+    return x
+
+
+def reverse(x, dims):
+    """Reverses the dimensions of x for which dims is True"""
+    return x[tuple(slice(None, None, -1) if rev else slice(None) for rev in dims)]
+
+
+def window_input(input_data, sh, dims=None):
+    """Same as md_lstm._window_input: pads the input to a multiple of the window size and
+    reshapes it to the grid of steps [batch,h/sh[0],w/sh[1],features]"""
+    bs, X_dim, Y_dim, channels = input_data.shape
+    X_win, Y_win = sh
+    pad = [(0, 0), (0, -X_dim % X_win), (0, -Y_dim % Y_win), (0, 0)]
+    input_data = np.pad(input_data, pad, 'constant')
+    h, w = input_data.shape[1] // X_win, input_data.shape[2] // Y_win
+    x = np.reshape(input_data, [bs, h, w, Y_win * X_win * channels])
+    if dims is not None:
+        x = reverse(x, dims)
+    return x
+
+
+def multi_dimensional_rnn(weights, input_data, sh, dims=None, forget_bias=0.0):
+    """NumPy forward pass of md_lstm.multi_dimensional_rnn_while_loop
+
+    The input part of the gates of all the cells is computed by one matmul, then the cells
+    of each anti-diagonal are computed at once for the whole batch into preallocated buffers.
+
+    @param weights: the weights given by load_weights
+    @param input_data: the data to process of shape [batch,h,w,channels]
+    @param sh: [height,width] of the windows
+    @param dims: dimensions to reverse the input data,eg.
+        dims=[False,True,True,False] => true means reverse dimension
+    @param forget_bias: the forget_bias of the MultiDimensionalLSTMCell
+
+    returns [batch,h/sh[0],w/sh[1],rnn_size] the output of the lstm
+    """
+    # reduced precision kernels (see quantize_weights) are run on float32
+    kernel = float_kernel(weights)
+    num_gates, rnn_size = weights['gates_scale'].shape
+    x = window_input(np.asarray(input_data, dtype=kernel.dtype), sh, dims)
+    bs, h, w, features = x.shape
+    w_x, w_h1, w_h2 = kernel[:features], kernel[features:features + rnn_size], kernel[features + rnn_size:]
+
+    # Input part of the gates of all the cells, (h, w, batch_size, num_gates*rnn_size)
+    x = np.transpose(x, [1, 2, 0, 3])
+    x_proj = matmul(x.reshape([-1, features]), w_x, weights, scale=weights.get('input_scale'))
+    x_proj = x_proj.reshape([h, w, bs, num_gates * rnn_size])
+
+    # States of the grid with a zero border above the first row and on the left
+    # of the first column: the cell (i,j) is at (i+1,j+1)
+    c = np.zeros([h + 1, w + 1, bs, rnn_size], kernel.dtype)
+    hid = np.zeros([h + 1, w + 1, bs, rnn_size], kernel.dtype)
+    # Buffers of the longest diagonal, the cells of a diagonal are the first axis
+    lanes = min(h, w)
+    gates_buf = np.empty([lanes, bs, num_gates * rnn_size], kernel.dtype)
+    rec_buf = np.empty([lanes, bs, num_gates * rnn_size], kernel.dtype)
+    act_buf = np.empty([lanes, bs, rnn_size], kernel.dtype)
+
+    for d in range(h + w - 1):
+        # Position of the cells of the diagonal d
+        ii = np.arange(max(0, d - w + 1), min(h, d + 1))
+        jj = d - ii
+        n = len(ii)
+        gates = gates_buf[:n]
+        gates[...] = x_proj[ii, jj]
+        gates += matmul(hid[ii, jj + 1], w_h1, weights, out=rec_buf[:n])
+        gates += matmul(hid[ii + 1, jj], w_h2, weights, out=rec_buf[:n])
+
+        # Layer normalization of each gate
+        gates = ln(gates.reshape([n, bs, num_gates, rnn_size]), weights['gates_scale'], weights['gates_shift'])
+        i, j, f1, f2, o = [gates[:, :, g] for g in range(num_gates)]
+
+        # gate activation
+        sigmoid(i, out=i)
+        f1 += forget_bias
+        sigmoid(f1, out=f1)
+        f2 += forget_bias
+        sigmoid(f2, out=f2)
+        sigmoid(o, out=o)
+
+        new_c = c[ii, jj + 1] * f1 + c[ii + 1, jj] * f2 + i * np.tanh(j, out=j)
+        c[ii + 1, jj + 1] = new_c
+        new_h = np.tanh(ln(new_c, weights['new_h_scale'], weights['new_h_shift']), out=act_buf[:n])
+        hid[ii + 1, jj + 1] = new_h * o
+
+    y = np.transpose(hid[1:, 1:], [2, 0, 1, 3])
+    # Reverse if selected
+    if dims is not None:
+        y = reverse(y, dims)
+    return y
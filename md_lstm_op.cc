@@ -0,0 +1,458 @@
+#include "math.h"
+#include "algorithm"
+#include "mutex"
+#include "vector"
+#include "third_party/eigen3/Eigen/Core"
+#include "tensorflow/core/framework/op.h"
+#include "tensorflow/core/framework/shape_inference.h"
+#include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/util/work_sharder.h"
+
+using namespace tensorflow;
+
+// The whole 2D MD-LSTM scan of md_lstm.py in one op. The input part of the gates (x_proj) is
+// computed outside by one matmul, the op does the recurrent projections, the layer norm of the
+// five gates (i, j, f1, f2, o) and of the new state, the same as MultiDimensionalLSTMCell.
+REGISTER_OP("MdLstmForward")
+  .Attr("forget_bias: float = 0.0")
+  .Input("x_proj: float")
+  .Input("w_rec: float")
+  .Input("gate_scale: float")
+  .Input("gate_shift: float")
+  .Input("new_h_scale: float")
+  .Input("new_h_shift: float")
+  .Output("h: float")
+  .Output("c: float")
+  .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
+    ::tensorflow::shape_inference::ShapeHandle input0;
+    ::tensorflow::shape_inference::ShapeHandle input1;
+    ::tensorflow::shape_inference::ShapeHandle input2;
+    ::tensorflow::shape_inference::ShapeHandle input4;
+    ::tensorflow::shape_inference::ShapeHandle output;
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(0), 4, &input0));
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(1), 2, &input1));
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(2), 2, &input2));
+    TF_RETURN_IF_ERROR(c->WithRank(c->input(4), 1, &input4));
+    TF_RETURN_IF_ERROR(c->ReplaceDim(input0, 3, c->Dim(input4, 0), &output));
+    c->set_output(0, output);
+    c->set_output(1, output);
+    return Status::OK();
+  });
+
+REGISTER_OP("MdLstmBackward")
+  .Attr("forget_bias: float = 0.0")
+  .Input("x_proj: float")
+  .Input("w_rec: float")
+  .Input("gate_scale: float")
+  .Input("gate_shift: float")
+  .Input("new_h_scale: float")
+  .Input("new_h_shift: float")
+  .Input("h: float")
+  .Input("c: float")
+  .Input("grad_h: float")
+  .Input("grad_c: float")
+  .Output("grad_x_proj: float")
+  .Output("grad_w_rec: float")
+  .Output("grad_gate_scale: float")
+  .Output("grad_gate_shift: float")
+  .Output("grad_new_h_scale: float")
+  .Output("grad_new_h_shift: float")
+  .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
+    for (int i = 0; i < 6; i++) c->set_output(i, c->input(i));
+    return Status::OK();
+  });
+
+const float LN_EPSILON = 1e-5;
+
+typedef Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> Matrix;
+typedef Eigen::Map<const Matrix> ConstMatrixMap;
+
+static inline float Sigmoid(float x) {
+  return 1.0f / (1.0f + expf(-x));
+}
+
+// normalizes x[0:n] into xhat and returns 1/std
+static float LayerNorm(const float* x, int64 n, float* xhat) {
+  float mean = 0;
+  for (int64 u = 0; u < n; u++) mean += x[u];
+  mean /= n;
+  float var = 0;
+  for (int64 u = 0; u < n; u++) {
+    xhat[u] = x[u] - mean;
+    var += xhat[u] * xhat[u];
+  }
+  const float inv_std = 1.0f / sqrtf(var / n + LN_EPSILON);
+  for (int64 u = 0; u < n; u++) xhat[u] *= inv_std;
+  return inv_std;
+}
+
+// dx from dxhat, the gradient of the normalized xhat
+static void LayerNormGrad(const float* dxhat, const float* xhat, float inv_std, int64 n, float* dx) {
+  float mean_dxhat = 0;
+  float mean_dxhat_xhat = 0;
+  for (int64 u = 0; u < n; u++) {
+    mean_dxhat += dxhat[u];
+    mean_dxhat_xhat += dxhat[u] * xhat[u];
+  }
+  mean_dxhat /= n;
+  mean_dxhat_xhat /= n;
+  for (int64 u = 0; u < n; u++) dx[u] = inv_std * (dxhat[u] - mean_dxhat - xhat[u] * mean_dxhat_xhat);
+}
+
+// A block of independent cells (of the same anti-diagonal), the recurrent projections of the
+// block are two matmuls. The intermediate values of the last Forward are kept for Backward.
+class MdLstmBlock {
+  public:
+    MdLstmBlock(int64 n, float forget_bias, const float* w_rec, const float* gate_scale, const float* gate_shift,
+      const float* new_h_scale, const float* new_h_shift)
+      : n_(n), forget_bias_(forget_bias), w_up_(w_rec, n, 5 * n), w_left_(w_rec + 5 * n * n, n, 5 * n),
+        gate_scale_(gate_scale), gate_shift_(gate_shift), new_h_scale_(new_h_scale), new_h_shift_(new_h_shift) {}
+
+    // cells holds the index of the cells in the (batch, h, w) grid, up and left the ones of
+    // their predecessors (-1 on the first row or column). hs and cs are the hidden units and
+    // states of the grid, the new ones are kept in the block until Store.
+    void Forward(const std::vector<int64>& cells, const std::vector<int64>& up, const std::vector<int64>& left,
+      const float* x_proj, const float* hs, const float* cs) {
+      const int64 n = n_;
+      const int64 m = 5 * n;
+      const int64 size = cells.size();
+      a_.resize(size, m);
+      h_up_.setZero(size, n);
+      h_left_.setZero(size, n);
+      c_up_.setZero(size, n);
+      c_left_.setZero(size, n);
+      for (int64 r = 0; r < size; r++) {
+        std::copy(x_proj + cells[r] * m, x_proj + (cells[r] + 1) * m, a_.row(r).data());
+        if (up[r] >= 0) {
+          std::copy(hs + up[r] * n, hs + (up[r] + 1) * n, h_up_.row(r).data());
+          std::copy(cs + up[r] * n, cs + (up[r] + 1) * n, c_up_.row(r).data());
+        }
+        if (left[r] >= 0) {
+          std::copy(hs + left[r] * n, hs + (left[r] + 1) * n, h_left_.row(r).data());
+          std::copy(cs + left[r] * n, cs + (left[r] + 1) * n, c_left_.row(r).data());
+        }
+      }
+      // projections
+      a_.noalias() += h_up_ * w_up_;
+      a_.noalias() += h_left_ * w_left_;
+
+      xhat_.resize(size, m);
+      gate_.resize(size, m);
+      inv_std_.resize(size, 6);
+      chat_.resize(size, n);
+      tc_.resize(size, n);
+      h_.resize(size, n);
+      c_.resize(size, n);
+      for (int64 r = 0; r < size; r++) {
+        float* xhat = xhat_.row(r).data();
+        float* gate = gate_.row(r).data();
+        // layer norm and activation of the gates i, j, f1, f2, o
+        for (int64 g = 0; g < 5; g++) {
+          inv_std_(r, g) = LayerNorm(a_.row(r).data() + g * n, n, xhat + g * n);
+          for (int64 u = g * n; u < (g + 1) * n; u++) {
+            const float z = xhat[u] * gate_scale_[u] + gate_shift_[u];
+            if (g == 1) gate[u] = tanhf(z);
+            else if (g == 2 || g == 3) gate[u] = Sigmoid(z + forget_bias_);
+            else gate[u] = Sigmoid(z);
+          }
+        }
+        const float* i = gate;
+        const float* j = gate + n;
+        const float* f1 = gate + 2 * n;
+        const float* f2 = gate + 3 * n;
+        const float* o = gate + 4 * n;
+        float* c = c_.row(r).data();
+        float* h = h_.row(r).data();
+        for (int64 u = 0; u < n; u++) {
+          c[u] = c_up_(r, u) * f1[u] + c_left_(r, u) * f2[u] + i[u] * j[u];
+        }
+        // layer norm of the new state
+        inv_std_(r, 5) = LayerNorm(c, n, chat_.row(r).data());
+        for (int64 u = 0; u < n; u++) {
+          tc_(r, u) = tanhf(chat_(r, u) * new_h_scale_[u] + new_h_shift_[u]);
+          h[u] = tc_(r, u) * o[u];
+        }
+      }
+    }
+
+    // writes the hidden units and states of the last Forward block at the index of the cells
+    void Store(const std::vector<int64>& cells, float* hs, float* cs) const {
+      const int64 n = n_;
+      for (size_t r = 0; r < cells.size(); r++) {
+        std::copy(h_.row(r).data(), h_.row(r).data() + n, hs + cells[r] * n);
+        std::copy(c_.row(r).data(), c_.row(r).data() + n, cs + cells[r] * n);
+      }
+    }
+
+    // gradients of the last Forward block given the gradients dh, dc (size x num_units) of its
+    // outputs. The gradients of the inputs of the cells are written at their index in dx_proj,
+    // the ones sent to their up and left predecessors at their index in dh_up, dc_up, dh_left,
+    // dc_left, and the ones of the parameters are added to the (thread local) d* buffers.
+    void Backward(const std::vector<int64>& cells, const Matrix& dh, const Matrix& dc_out, float* dx_proj,
+      float* dh_up, float* dc_up, float* dh_left, float* dc_left, Matrix* dw_up, Matrix* dw_left,
+      float* dgate_scale, float* dgate_shift, float* dnew_h_scale, float* dnew_h_shift) {
+      const int64 n = n_;
+      const int64 m = 5 * n;
+      const int64 size = cells.size();
+      da_.resize(size, m);
+      std::vector<float> dz(m), dchat(n), dc(n);
+      for (int64 r = 0; r < size; r++) {
+        const float* xhat = xhat_.row(r).data();
+        const float* gate = gate_.row(r).data();
+        const float* i = gate;
+        const float* j = gate + n;
+        const float* f1 = gate + 2 * n;
+        const float* f2 = gate + 3 * n;
+        const float* o = gate + 4 * n;
+        // through h = tanh(ln(c)) * o
+        for (int64 u = 0; u < n; u++) {
+          const float t = tc_(r, u);
+          dz[4 * n + u] = dh(r, u) * t * o[u] * (1 - o[u]);
+          const float dzc = dh(r, u) * o[u] * (1 - t * t);
+          dnew_h_scale[u] += dzc * chat_(r, u);
+          dnew_h_shift[u] += dzc;
+          dchat[u] = dzc * new_h_scale_[u];
+        }
+        LayerNormGrad(&dchat[0], chat_.row(r).data(), inv_std_(r, 5), n, &dc[0]);
+        // through c = c_up * f1 + c_left * f2 + i * j
+        for (int64 u = 0; u < n; u++) {
+          const float d = dc[u] + dc_out(r, u);
+          dz[u] = d * j[u] * i[u] * (1 - i[u]);
+          dz[n + u] = d * i[u] * (1 - j[u] * j[u]);
+          dz[2 * n + u] = d * c_up_(r, u) * f1[u] * (1 - f1[u]);
+          dz[3 * n + u] = d * c_left_(r, u) * f2[u] * (1 - f2[u]);
+          dc_up[cells[r] * n + u] = d * f1[u];
+          dc_left[cells[r] * n + u] = d * f2[u];
+        }
+        // through the layer norm of the gates
+        float* da = da_.row(r).data();
+        for (int64 u = 0; u < m; u++) {
+          dgate_scale[u] += dz[u] * xhat[u];
+          dgate_shift[u] += dz[u];
+          dz[u] *= gate_scale_[u];
+        }
+        for (int64 g = 0; g < 5; g++) {
+          LayerNormGrad(&dz[g * n], xhat + g * n, inv_std_(r, g), n, da + g * n);
+        }
+        std::copy(da, da + m, dx_proj + cells[r] * m);
+      }
+      // through the projections
+      dw_up->noalias() += h_up_.transpose() * da_;
+      dw_left->noalias() += h_left_.transpose() * da_;
+      Matrix dh_pred = da_ * w_up_.transpose();
+      for (int64 r = 0; r < size; r++) std::copy(dh_pred.row(r).data(), dh_pred.row(r).data() + n, dh_up + cells[r] * n);
+      dh_pred.noalias() = da_ * w_left_.transpose();
+      for (int64 r = 0; r < size; r++) {
+        std::copy(dh_pred.row(r).data(), dh_pred.row(r).data() + n, dh_left + cells[r] * n);
+      }
+    }
+
+  private:
+    const int64 n_;
+    const float forget_bias_;
+    ConstMatrixMap w_up_;
+    ConstMatrixMap w_left_;
+    const float* gate_scale_;
+    const float* gate_shift_;
+    const float* new_h_scale_;
+    const float* new_h_shift_;
+    Matrix a_, h_up_, h_left_, c_up_, c_left_, xhat_, gate_, inv_std_, chat_, tc_, h_, c_, da_;
+};
+
+static void CheckInputs(OpKernelContext* context, int64 n) {
+  OP_REQUIRES(context, context->input(0).dims() == 4 && context->input(0).dim_size(3) == 5 * n,
+    errors::InvalidArgument("x_proj must be [batch, h, w, 5*num_units]"));
+  OP_REQUIRES(context, context->input(1).dims() == 2 && context->input(1).dim_size(0) == 2 * n &&
+    context->input(1).dim_size(1) == 5 * n, errors::InvalidArgument("w_rec must be [2*num_units, 5*num_units]"));
+  OP_REQUIRES(context, context->input(2).NumElements() == 5 * n && context->input(3).NumElements() == 5 * n,
+    errors::InvalidArgument("gate_scale and gate_shift must be [5, num_units]"));
+  OP_REQUIRES(context, context->input(5).NumElements() == n,
+    errors::InvalidArgument("new_h_shift must be [num_units]"));
+}
+
+// the cells [start, limit) of the (batch x cells of the diagonal d) units, with their predecessors
+static void DiagonalCells(int64 start, int64 limit, int64 d, int64 h, int64 w, std::vector<int64>* cells,
+  std::vector<int64>* up, std::vector<int64>* left) {
+  const int64 i_min = std::max<int64>(0, d - w + 1);
+  const int64 size = std::min<int64>(h - 1, d) - i_min + 1;
+  cells->clear();
+  up->clear();
+  left->clear();
+  for (int64 unit = start; unit < limit; unit++) {
+    const int64 b = unit / size;
+    const int64 i = i_min + unit % size;
+    const int64 j = d - i;
+    const int64 ind = (b * h + i) * w + j;
+    cells->push_back(ind);
+    up->push_back(i > 0 ? ind - w : -1);
+    left->push_back(j > 0 ? ind - 1 : -1);
+  }
+}
+
+static int64 DiagonalSize(int64 d, int64 h, int64 w) {
+  return std::min<int64>(h - 1, d) - std::max<int64>(0, d - w + 1) + 1;
+}
+
+// The cells of an anti-diagonal only depend on the previous one, they are sharded over
+// the worker threads (batch x cells of the diagonal)
+class MdLstmForwardOp : public OpKernel {
+  public:
+    explicit MdLstmForwardOp(OpKernelConstruction* context) : OpKernel(context) {
+      OP_REQUIRES_OK(context, context->GetAttr("forget_bias", &forget_bias_));
+    }
+
+    void Compute(OpKernelContext* context) override {
+      const Tensor& x_proj_t = context->input(0);
+      const int64 n = context->input(4).NumElements();
+      CheckInputs(context, n);
+      if (!context->status().ok()) return;
+      const int64 batch_size = x_proj_t.dim_size(0);
+      const int64 h = x_proj_t.dim_size(1);
+      const int64 w = x_proj_t.dim_size(2);
+      const float* x_proj = x_proj_t.flat<float>().data();
+      const float* w_rec = context->input(1).flat<float>().data();
+      const float* gate_scale = context->input(2).flat<float>().data();
+      const float* gate_shift = context->input(3).flat<float>().data();
+      const float* new_h_scale = context->input(4).flat<float>().data();
+      const float* new_h_shift = context->input(5).flat<float>().data();
+      // output
+      TensorShape output_shape({batch_size, h, w, n});
+      Tensor* h_t = NULL;
+      Tensor* c_t = NULL;
+      OP_REQUIRES_OK(context, context->allocate_output(0, output_shape, &h_t));
+      OP_REQUIRES_OK(context, context->allocate_output(1, output_shape, &c_t));
+      float* hs = h_t->flat<float>().data();
+      float* cs = c_t->flat<float>().data();
+      const float forget_bias = forget_bias_;
+      auto worker_threads = *(context->device()->tensorflow_cpu_worker_threads());
+      const int64 cost = 25 * n * n;
+      for (int64 d = 0; d < h + w - 1; d++) {
+        Shard(worker_threads.num_threads, worker_threads.workers, batch_size * DiagonalSize(d, h, w), cost,
+          [&](int64 start, int64 limit) {
+            MdLstmBlock block(n, forget_bias, w_rec, gate_scale, gate_shift, new_h_scale, new_h_shift);
+            std::vector<int64> cells, up, left;
+            DiagonalCells(start, limit, d, h, w, &cells, &up, &left);
+            block.Forward(cells, up, left, x_proj, hs, cs);
+            block.Store(cells, hs, cs);
+          });
+      }
+    }
+
+  private:
+    float forget_bias_;
+};
+
+// The anti-diagonals are run in reverse order, their cells are sharded over the worker
+// threads (batch x cells of the diagonal) and their internals are recomputed from the saved
+// states. A cell sends the gradients of its predecessors to buffers at its own index, so the
+// shards never write to the same place. The gradients of the weights are summed by shard and
+// merged at the end of the shard.
+class MdLstmBackwardOp : public OpKernel {
+  public:
+    explicit MdLstmBackwardOp(OpKernelConstruction* context) : OpKernel(context) {
+      OP_REQUIRES_OK(context, context->GetAttr("forget_bias", &forget_bias_));
+    }
+
+    void Compute(OpKernelContext* context) override {
+      const Tensor& x_proj_t = context->input(0);
+      const int64 n = context->input(4).NumElements();
+      CheckInputs(context, n);
+      if (!context->status().ok()) return;
+      const int64 batch_size = x_proj_t.dim_size(0);
+      const int64 h = x_proj_t.dim_size(1);
+      const int64 w = x_proj_t.dim_size(2);
+      const float* x_proj = x_proj_t.flat<float>().data();
+      const float* w_rec = context->input(1).flat<float>().data();
+      const float* gate_scale = context->input(2).flat<float>().data();
+      const float* gate_shift = context->input(3).flat<float>().data();
+      const float* new_h_scale = context->input(4).flat<float>().data();
+      const float* new_h_shift = context->input(5).flat<float>().data();
+      const float* hs = context->input(6).flat<float>().data();
+      const float* cs = context->input(7).flat<float>().data();
+      const float* grad_h = context->input(8).flat<float>().data();
+      const float* grad_c = context->input(9).flat<float>().data();
+      // output
+      Tensor* grads_t[6];
+      for (int k = 0; k < 6; k++) {
+        OP_REQUIRES_OK(context, context->allocate_output(k, context->input(k).shape(), &grads_t[k]));
+      }
+      float* dx_proj = grads_t[0]->flat<float>().data();
+      Matrix dw_up = Matrix::Zero(n, 5 * n);
+      Matrix dw_left = Matrix::Zero(n, 5 * n);
+      std::vector<float> dgate_scale(5 * n, 0), dgate_shift(5 * n, 0), dnew_h_scale(n, 0), dnew_h_shift(n, 0);
+      // gradients sent by each cell to its up and left predecessors
+      Tensor pred_t[4];
+      for (int k = 0; k < 4; k++) {
+        OP_REQUIRES_OK(context, context->allocate_temp(DT_FLOAT, context->input(6).shape(), &pred_t[k]));
+      }
+      float* dh_up = pred_t[0].flat<float>().data();
+      float* dc_up = pred_t[1].flat<float>().data();
+      float* dh_left = pred_t[2].flat<float>().data();
+      float* dc_left = pred_t[3].flat<float>().data();
+
+      const float forget_bias = forget_bias_;
+      std::mutex mu;
+      auto worker_threads = *(context->device()->tensorflow_cpu_worker_threads());
+      const int64 cost = 75 * n * n;
+      for (int64 d = h + w - 2; d >= 0; d--) {
+        Shard(worker_threads.num_threads, worker_threads.workers, batch_size * DiagonalSize(d, h, w), cost,
+          [&](int64 start, int64 limit) {
+            MdLstmBlock block(n, forget_bias, w_rec, gate_scale, gate_shift, new_h_scale, new_h_shift);
+            std::vector<int64> cells, up, left;
+            DiagonalCells(start, limit, d, h, w, &cells, &up, &left);
+            // recompute the internals of the cells
+            block.Forward(cells, up, left, x_proj, hs, cs);
+            // gradients of the outputs of the cells, from the loss and from their successors
+            Matrix dh(cells.size(), n), dc(cells.size(), n);
+            for (size_t r = 0; r < cells.size(); r++) {
+              const int64 ind = cells[r];
+              const int64 i = (ind / w) % h;
+              const int64 j = ind % w;
+              for (int64 u = 0; u < n; u++) {
+                dh(r, u) = grad_h[ind * n + u];
+                dc(r, u) = grad_c[ind * n + u];
+                if (i + 1 < h) {
+                  dh(r, u) += dh_up[(ind + w) * n + u];
+                  dc(r, u) += dc_up[(ind + w) * n + u];
+                }
+                if (j + 1 < w) {
+                  dh(r, u) += dh_left[(ind + 1) * n + u];
+                  dc(r, u) += dc_left[(ind + 1) * n + u];
+                }
+              }
+            }
+            // thread local gradients of the weights
+            Matrix local_dw_up = Matrix::Zero(n, 5 * n);
+            Matrix local_dw_left = Matrix::Zero(n, 5 * n);
+            std::vector<float> local_dgate_scale(5 * n, 0), local_dgate_shift(5 * n, 0);
+            std::vector<float> local_dnew_h_scale(n, 0), local_dnew_h_shift(n, 0);
+            block.Backward(cells, dh, dc, dx_proj, dh_up, dc_up, dh_left, dc_left, &local_dw_up, &local_dw_left,
+              &local_dgate_scale[0], &local_dgate_shift[0], &local_dnew_h_scale[0], &local_dnew_h_shift[0]);
+            std::lock_guard<std::mutex> lock(mu);
+            dw_up += local_dw_up;
+            dw_left += local_dw_left;
+            for (int64 u = 0; u < 5 * n; u++) {
+              dgate_scale[u] += local_dgate_scale[u];
+              dgate_shift[u] += local_dgate_shift[u];
+            }
+            for (int64 u = 0; u < n; u++) {
+              dnew_h_scale[u] += local_dnew_h_scale[u];
+              dnew_h_shift[u] += local_dnew_h_shift[u];
+            }
+          });
+      }
+      float* dw_rec = grads_t[1]->flat<float>().data();
+      std::copy(dw_up.data(), dw_up.data() + 5 * n * n, dw_rec);
+      std::copy(dw_left.data(), dw_left.data() + 5 * n * n, dw_rec + 5 * n * n);
+      std::copy(dgate_scale.begin(), dgate_scale.end(), grads_t[2]->flat<float>().data());
+      std::copy(dgate_shift.begin(), dgate_shift.end(), grads_t[3]->flat<float>().data());
+      std::copy(dnew_h_scale.begin(), dnew_h_scale.end(), grads_t[4]->flat<float>().data());
+      std::copy(dnew_h_shift.begin(), dnew_h_shift.end(), grads_t[5]->flat<float>().data());
+    }
+
+  private:
+    float forget_bias_;
+};
+
+REGISTER_KERNEL_BUILDER(Name("MdLstmForward").Device(DEVICE_CPU), MdLstmForwardOp);
+REGISTER_KERNEL_BUILDER(Name("MdLstmBackward").Device(DEVICE_CPU), MdLstmBackwardOp);
@@ -0,0 +1,103 @@
+import argparse, logging, os, json, tempfile
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='accuracy of the reduced precision MD-LSTM cell')
+    parser.add_argument('-l', '--load_model_path', help='path of the trained model (checkpoint) to quantize',
+                        type=str, required=True)
+    parser.add_argument('-p', '--precisions', help='comma separated precisions (int8, bfloat16)', type=str,
+                        default='int8,bfloat16')
+    parser.add_argument('-o', '--output', help='path of the accuracy report', type=str, default='mdlstm.json')
+    parser.add_argument('-d', '--data', help='data type', type=str, default='ir')
+    parser.add_argument('-f', '--feature', help='ir feature used to generate match matrix',
+                        type=str, default='tf_proximity')
+    parser.add_argument('-c', '--calibration_batches', help='how many batches to calibrate the int8 inputs',
+                        type=int, default=10)
+    parser.add_argument('-e', '--eval_batches', help='how many batches to compare with float32', type=int,
+                        default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+import numpy as np
+import tensorflow as tf
+import md_lstm_np
+from md_lstm import multi_dimensional_rnn_inference, restore_fused_ln, export_weights
+from data_gen import next_batch
+SEED = 2018
+
+# synthetic data of main.py
+batch_size = 256
+h = 5
+w = 10
+anisotropy = False
+distribution = 'power_law'
+mean_match_query_term = 3
+mean_match_count = 5
+mean_match_doc_term = max(1, int(mean_match_count * h / mean_match_query_term))
+
+
+def get_batch():
+    if args.data == 'gau':
+        batch = next_batch(args.data, batch_size, h, w, anisotropy)
+    else:
+        batch = next_batch(args.data, batch_size, h, w, mean_match_query_term=mean_match_query_term,
+                           mean_match_doc_term=mean_match_doc_term, dist=distribution)
+    return np.expand_dims(batch[0], axis=3).astype(np.float32)
+
+
+def load_float_weights():
+    # the float32 weights of the checkpoint, for md_lstm_np
+    path = os.path.join(tempfile.mkdtemp(), 'mdlstm.npz')
+    export_weights(args.load_model_path, path)
+    return md_lstm_np.load_weights(path)
+
+
+def run_cell(batches, rnn_size, precision='float32', input_scale=None):
+    """Outputs of the MD-LSTM of the checkpoint in precision on the batches"""
+    with tf.Graph().as_default():
+        x = tf.placeholder(tf.float32, [None, h, w, 1])
+        # the fused layer norm takes the checkpoints saved with and without it (see restore_fused_ln)
+        y, _ = multi_dimensional_rnn_inference(rnn_size, x, sh=[1, 1], hoist_input=True, fused_ln=True,
+                                               precision=precision, input_scale=input_scale)
+        with tf.Session() as sess:
+            restore_fused_ln(sess, args.load_model_path)
+            return [sess.run(y, feed_dict={x: batch}) for batch in batches]
+
+
+def main():
+    np.random.seed(SEED)
+    weights = load_float_weights()
+    rnn_size = weights['gates_scale'].shape[1]
+    calibration = [get_batch() for _ in range(args.calibration_batches)]
+    evaluation = [get_batch() for _ in range(args.eval_batches)]
+    reference = run_cell(evaluation, rnn_size)
+    ref = np.concatenate([y.reshape(-1) for y in reference])
+    report = {}
+    for precision in args.precisions.split(','):
+        # md_lstm_np runs the same reduced precision arithmetic, it picks the int8 input scale
+        # and checks the outputs of the cell
+        if precision == 'int8':
+            quantized, _ = md_lstm_np.calibrate(weights, calibration, sh=[1, 1])
+        else:
+            quantized = md_lstm_np.quantize_weights(weights, precision)
+        input_scale = quantized.get('input_scale')
+        outputs = run_cell(evaluation, rnn_size, precision, input_scale)
+        err = np.concatenate([np.abs(y - y_ref).reshape(-1) for y, y_ref in zip(outputs, reference)])
+        np_err = max(np.abs(md_lstm_np.multi_dimensional_rnn(quantized, x, sh=[1, 1]) - y).max()
+                     for x, y in zip(evaluation, outputs))
+        report[precision] = {
+            'kernel_bytes': int(weights['kernel'].size * (1 if precision == 'int8' else 2)),
+            'float32_kernel_bytes': int(weights['kernel'].size * 4),
+            'max_abs_err': float(err.max()),
+            'mean_abs_err': float(err.mean()),
+            'rel_err': float(np.linalg.norm(err) / max(np.linalg.norm(ref), 1e-12)),
+            'md_lstm_np_max_abs_diff': float(np_err),
+        }
+        if precision == 'int8':
+            report[precision]['input_scale'] = None if input_scale is None else float(input_scale)
+        logging.info('{}: {}'.format(precision, report[precision]))
+    with open(args.output, 'w') as fout:
+        json.dump(report, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
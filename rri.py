@@ -1,4 +1,5 @@
 import sys
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import variable_scope as vs
 from cnn import cnn, DynamicMaxPooling
@@ -24,6 +25,97 @@ def batch_slice(batch, start, offset, pad_values=None):
     return region
 
 
+def sparse_batch_slice(batch, start, offset):
+    '''
+    batch_slice of a SparseTensor batch padded with zeros, only the entries of batch are visited
+    '''
+    max_offset = tf.cast(tf.reduce_max(offset), dtype=tf.int64)
+    b = batch.indices[:, 0]
+    pos = batch.indices[:, 1] - tf.cast(tf.gather(start, b), dtype=tf.int64)
+    in_region = tf.logical_and(pos >= 0, pos < max_offset)
+    indices = tf.boolean_mask(tf.concat([batch.indices[:, :1], tf.expand_dims(pos, axis=1), batch.indices[:, 2:]],
+                                        axis=1), in_region)
+    shape = tf.concat([batch.dense_shape[:1], [max_offset], batch.dense_shape[2:]], axis=0)
+    return tf.scatter_nd(indices, tf.boolean_mask(batch.values, in_region), shape)
+
+
+def row_max_density(match_matrix, dq_size, row_splits=None):
+    '''
+    maximal similarity of each doc position (batch_size, max_d_len) among all the query positions, the
+    padding of query is ignored and the density is not smaller than the smallest positive float like in jumper.
+    When row_splits is given, match_matrix is the SparseTensor of "indicator_sparse" interaction.
+    '''
+    if row_splits is not None:
+        has_match = tf.reshape(row_splits[1:] > row_splits[:-1], tf.shape(match_matrix)[:2])
+        return tf.where(has_match, tf.ones_like(has_match, dtype=tf.float32),
+                        tf.fill(tf.shape(has_match), np.finfo(np.float32).tiny))
+    q_mask = tf.tile(tf.expand_dims(tf.sequence_mask(dq_size[:, 1], tf.shape(match_matrix)[2]), axis=1),
+                     [1, tf.shape(match_matrix)[1], 1])
+    # the kernels start the max from FLT_MIN, so rows without positive similarity get FLT_MIN
+    return tf.maximum(tf.reduce_max(tf.where(q_mask, match_matrix,
+                                             tf.fill(tf.shape(match_matrix), np.finfo(np.float32).min)), axis=2),
+                      np.finfo(np.float32).tiny)
+
+
+def summed_area_table(match_matrix, row_splits=None):
+    '''
+    integral image of match_matrix (batch_size, max_d_len, max_q_len) with a leading zero row and column,
+    i.e., sat[b, i, j] is the sum of match_matrix[b, :i, :j].
+    When row_splits is given, match_matrix is the SparseTensor of "indicator_sparse" interaction and the rows
+    of the table are its entries instead of doc positions, i.e., sat[k, j] is the sum of the first k entries
+    whose query position is smaller than j.
+    '''
+    if row_splits is not None:
+        entries = tf.one_hot(match_matrix.indices[:, 2], tf.cast(match_matrix.dense_shape[2], dtype=tf.int32),
+                             dtype=tf.float32) * tf.expand_dims(match_matrix.values, axis=1)
+        sat = tf.cumsum(tf.cumsum(entries, axis=0), axis=1)
+        return tf.pad(sat, [[1, 0], [1, 0]], 'CONSTANT')
+    sat = tf.cumsum(tf.cumsum(match_matrix, axis=1), axis=2)
+    return tf.pad(sat, [[0, 0], [1, 0], [1, 0]], 'CONSTANT')
+
+
+def region_sum(sat, start, end, row_splits=None):
+    '''
+    sum of match_matrix[b, start[b, ..., 0]:end[b, ..., 0], start[b, ..., 1]:end[b, ..., 1]] for all b using
+    the summed area table of match_matrix, indices are clipped like python slices
+    '''
+    bs = tf.shape(start)[0]
+    if row_splits is not None:
+        max_d_len = (tf.shape(row_splits)[0] - 1) // bs
+        size = tf.stack([max_d_len, tf.shape(sat)[1] - 1])
+    else:
+        size = tf.shape(sat)[1:] - 1
+    start = tf.minimum(tf.maximum(start, 0), size)
+    end = tf.minimum(tf.maximum(end, start), size)
+    b = tf.zeros_like(start[..., 0]) + tf.reshape(tf.range(bs), [-1] + [1] * (len(start.get_shape()) - 2))
+    def corner(d, q):
+        if row_splits is not None:
+            # the entries before doc position d of sample b
+            k = tf.cast(tf.gather(row_splits, b * max_d_len + d), dtype=tf.int32)
+            return tf.gather_nd(sat, tf.stack([k, q], axis=-1))
+        return tf.gather_nd(sat, tf.stack([b, d, q], axis=-1))
+    return corner(end[..., 0], end[..., 1]) - corner(start[..., 0], end[..., 1]) - \
+           corner(end[..., 0], start[..., 1]) + corner(start[..., 0], start[..., 1])
+
+
+def cached_repr(cache, docid, start, offset, compute, shape):
+    '''
+    representation (batch_size, *shape) of the regions (docid, start, offset) looked up in cache
+    (cache.DocReprCache), compute(ind) is only run on the samples ind missing in cache and its
+    results are saved into cache
+    '''
+    hit, hit_repr = tf.py_func(cache.lookup, [docid, start, offset, shape], [tf.bool, tf.float32],
+                               stateful=True, name='lookup')
+    hit.set_shape([None])
+    hit_ind = tf.cast(tf.where(hit)[:, 0], dtype=tf.int32)
+    miss_ind = tf.cast(tf.where(tf.logical_not(hit))[:, 0], dtype=tf.int32)
+    miss_repr = compute(miss_ind)
+    saved = tf.py_func(cache.store, [tf.gather(docid, miss_ind), tf.gather(start, miss_ind),
+                                     tf.gather(offset, miss_ind), miss_repr], tf.bool, stateful=True, name='store')
+    with tf.control_dependencies([saved]):
+        return tf.dynamic_stitch([hit_ind, miss_ind], [tf.reshape(hit_repr, [-1] + shape), miss_repr])
+
+
 def get_glimpse_location(match_matrix, dq_size, location, glimpse):
     '''
     get next glimpse location (g_t+1) based on last jump location (j_t)
@@ -71,8 +163,9 @@ def get_jump_location(match_matrix, dq_size, location, jump, **kwargs):
         #new_location = jumper.min_density(match_matrix=match_matrix, dq_size=dq_size, location=location,
         #                                  min_density=min_density)
         # there is no need to use multi-thread op, because this is fast and thus not the bottleneck
+        # the query span of location is always the whole query, so the density of each row is precomputed
         new_location = jumper.min_density_multi_cpu(
-            match_matrix=match_matrix, dq_size=dq_size, location=location, min_density=kwargs['min_density'],
+            density=kwargs['density'], dq_size=dq_size, location=location, min_density=kwargs['min_density'],
             min_jump_offset=kwargs['min_jump_offset'], use_ratio=False, only_one=False)
         new_location = tf.stop_gradient(new_location)
     elif jump == 'all':
@@ -99,6 +192,7 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
     query_repr_ta = kwargs['query_repr_ta']
     time = kwargs['time']
     is_stop = kwargs['is_stop']
+    active = kwargs['active']
     cur_location = location_ta.read(time)
     cur_next_location = location_ta.read(time + 1)
     with vs.variable_scope('ReprCond'):
@@ -109,22 +203,27 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
         query_reuse = \
             tf.logical_and(tf.reduce_all(tf.equal(cur_location[:, 1:4:2], cur_next_location[:, 1:4:2])), 
                            tf.greater_equal(time, 1))
+    def compact(t):
+        return t if active is None else tf.gather(t, active)
+    def scatter(t):
+        # back to the whole batch, the samples not active are zeros which are masked by is_stop
+        if active is None:
+            return t
+        return tf.scatter_nd(tf.expand_dims(active, axis=1), t, tf.concat([[bs], tf.shape(t)[1:]], axis=0))
+    if active is not None:
+        # only the active samples are represented
+        dq_size, query, query_emb, doc, doc_emb, location = \
+            [compact(t) for t in [dq_size, query, query_emb, doc, doc_emb, location]]
+        if kwargs['match_row_splits'] is None:
+            # the SparseTensor of "indicator_sparse" is not used by the represent methods compacted
+            match_matrix = compact(match_matrix)
+    n = tf.shape(location)[0]
     if represent == 'sum_hard':
         state_ta = tf.cond(tf.greater(time, 0), lambda: state_ta, lambda: state_ta.write(0, tf.zeros([bs, 1])))
         start = tf.cast(tf.floor(location[:, :2]), dtype=tf.int32)
         end = tf.cast(tf.floor(location[:, :2] + location[:, 2:]), dtype=tf.int32)
-        ind = tf.constant(0)
-        representation_ta = tf.TensorArray(dtype=tf.float32, size=bs,
-                                           name='representation_ta', clear_after_read=False)
-        def body(i, m, s, e, r):
-            r_i = tf.reduce_sum(m[i][s[i, 0]:e[i, 0], s[i, 1]:e[i, 1]])
-            r = r.write(i, tf.reshape(r_i, [1]))
-            return i + 1, m, s, e, r
-        _, _, _, _, representation_ta = \
-            tf.while_loop(lambda i, m, s, e, r: i < bs, body,
-                          [ind, match_matrix, start, end, representation_ta],
-                          parallel_iterations=1000)
-        representation = representation_ta.stack()
+        representation = tf.expand_dims(region_sum(kwargs['match_matrix_sat'], start, end,
+                                                    row_splits=kwargs['match_row_splits']), axis=-1)
     elif represent == 'interaction_copy_hard':
         '''
         This represent method just copy the match_matrix selected by current region to state_ta.
@@ -135,7 +234,10 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
         start = tf.cast(tf.floor(location[:, :2]), dtype=tf.int32)
         offset = tf.cast(tf.floor(location[:, 2:]), dtype=tf.int32)
         d_start, d_offset = start[:, 0], offset[:, 0]
-        local_match_matrix = batch_slice(match_matrix, d_start, d_offset, pad_values=0)
+        if kwargs['match_row_splits'] is not None:
+            local_match_matrix = sparse_batch_slice(match_matrix, d_start, d_offset)
+        else:
+            local_match_matrix = batch_slice(match_matrix, d_start, d_offset, pad_values=0)
         # initialize the first element of state_ta
         state_ta = tf.cond(tf.greater(time, 0), lambda: state_ta, 
             lambda: state_ta.write(0, tf.zeros_like(local_match_matrix)))
@@ -160,7 +262,7 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
         local_match_matrix = tf.image.crop_and_resize(
             tf.expand_dims(match_matrix, -1),
             boxes=tf.cast(tf.stack([d_start, q_start, d_end, q_end], axis=-1), dtype=tf.float32),
-            box_ind=tf.range(bs),
+            box_ind=tf.range(n),
             crop_size=[max_jump_offset, max_jump_offset2],
             method='bilinear',
             name='local_interaction'
@@ -170,7 +272,7 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
                 architecture=[(5, 5, 1, 8), (max_jump_offset/5, max_jump_offset2/5)], 
                 activation='relu',
                 dpool_index=None)
-            representation = tf.reshape(inter_repr, [bs, -1])
+            representation = tf.reshape(inter_repr, [n, -1])
     elif represent in {'rnn_hard', 'cnn_hard', 'interaction_cnn_hard'}:
         if represent in {'rnn_hard', 'cnn_hard'}:
             state_ta = tf.cond(tf.greater(time, 0), lambda: state_ta, lambda: state_ta.write(0, tf.zeros([bs, 1])))
@@ -202,11 +304,11 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
                 inter_repr = cnn(local_match_matrix, architecture=[(5, 5, 1, 8), (5, 5)], activation='relu',
                 #inter_repr = cnn(local_match_matrix, architecture=[(5, 5, 1, 16), (500, 10), (5, 5, 16, 16), (1, 1), (5, 5, 16, 16), (10, 1), (5, 5, 16, 100), (25, 10)], activation='relu',
                     dpool_index=inter_dpool_index)
-                representation = tf.reshape(inter_repr, [bs, -1])
+                representation = tf.reshape(inter_repr, [n, -1])
         elif represent == 'rnn_hard':
             #rnn_cell = tf.nn.rnn_cell.BasicRNNCell(kwargs['rnn_size'])
             rnn_cell = tf.nn.rnn_cell.GRUCell(kwargs['rnn_size'])
-            initial_state = rnn_cell.zero_state(bs, dtype=tf.float32)
+            initial_state = rnn_cell.zero_state(n, dtype=tf.float32)
             d_outputs, d_state = tf.nn.dynamic_rnn(rnn_cell, d_region, initial_state=initial_state,
                                                    sequence_length=d_offset, dtype=tf.float32)
             q_outputs, q_state = tf.nn.dynamic_rnn(rnn_cell, q_region, initial_state=initial_state,
@@ -224,17 +326,22 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
                                   lambda: doc_repr_ta.write(0, tf.zeros([bs, 10, doc_arch[-2][-1]])))
             query_repr_ta = tf.cond(tf.greater(time, 0), lambda: query_repr_ta, 
                                     lambda: query_repr_ta.write(0, tf.zeros([bs, 5, query_arch[-2][-1]])))
-            def get_doc_repr():
+            def get_doc_repr(ind=None):
                 nonlocal d_region, max_jump_offset, word_vector_dim, separate, d_offset, doc_arch, doc_after_pool_size
-                d_region = tf.pad(d_region, [[0, 0], [0, max_jump_offset - tf.shape(d_region)[1]], [0, 0]], 
-                                  'CONSTANT', constant_values=0)
-                d_region.set_shape([None, max_jump_offset, word_vector_dim])
+                region, region_offset, d_len = d_region, d_offset, dq_size[:, 0]
+                if ind is not None:
+                    # only the regions of the samples in ind
+                    region, region_offset, d_len = \
+                        tf.gather(region, ind), tf.gather(region_offset, ind), tf.gather(d_len, ind)
+                region = tf.pad(region, [[0, 0], [0, max_jump_offset - tf.shape(region)[1]], [0, 0]], 
+                                'CONSTANT', constant_values=0)
+                region.set_shape([None, max_jump_offset, word_vector_dim])
                 with vs.variable_scope('DocCNN' if separate else 'CNN'):
-                    doc_dpool_index = DynamicMaxPooling.dynamic_pooling_index_1d(d_offset, max_jump_offset)
-                    doc_repr = cnn(d_region, architecture=doc_arch, activation='relu',
+                    doc_dpool_index = DynamicMaxPooling.dynamic_pooling_index_1d(region_offset, max_jump_offset)
+                    doc_repr = cnn(region, architecture=doc_arch, activation='relu',
                                    dpool_index=doc_dpool_index)
                 with vs.variable_scope('LengthOrderAwareMaskPooling'):
-                    mask_prob = tf.minimum(tf.ceil(doc_after_pool_size ** 2 / dq_size[:, 0]), doc_after_pool_size) / 50
+                    mask_prob = tf.minimum(tf.ceil(doc_after_pool_size ** 2 / d_len), doc_after_pool_size) / 50
                     # length-aware mask
                     mask_ber = tf.distributions.Bernoulli(probs=mask_prob)
                     mask = tf.transpose(mask_ber.sample([doc_after_pool_size]), [1, 0])
@@ -264,12 +371,19 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
                     query_repr = tf.layers.max_pooling1d(query_repr, pool_size=[10], strides=[10],
                                                          padding='SAME', name='pool')
                 return query_repr
-            doc_repr = tf.cond(doc_reuse, lambda: doc_repr_ta.read(time), get_doc_repr)
-            query_repr = tf.cond(query_reuse, lambda: query_repr_ta.read(time), get_query_repr)
+            if kwargs['doc_repr_cache'] is not None:
+                # the CNN only runs on the doc regions not cached
+                compute_doc_repr = lambda: cached_repr(kwargs['doc_repr_cache'], compact(kwargs['docid']), d_start,
+                                                       d_offset, get_doc_repr, [10, doc_arch[-2][-1]])
+            else:
+                compute_doc_repr = get_doc_repr
+            doc_repr = tf.cond(doc_reuse, lambda: compact(doc_repr_ta.read(time)), compute_doc_repr)
+            query_repr = tf.cond(query_reuse, lambda: compact(query_repr_ta.read(time)), get_query_repr)
             #doc_repr = tf.cond(tf.constant(False), lambda: doc_repr_ta.read(time), get_doc_repr)
             #query_repr = tf.cond(tf.constant(False), lambda: query_repr_ta.read(time), get_query_repr)
-            doc_repr_ta = doc_repr_ta.write(time + 1, tf.where(is_stop, doc_repr_ta.read(time), doc_repr))
-            query_repr_ta = query_repr_ta.write(time + 1, tf.where(is_stop, query_repr_ta.read(time), query_repr))
+            doc_repr_ta = doc_repr_ta.write(time + 1, tf.where(is_stop, doc_repr_ta.read(time), scatter(doc_repr)))
+            query_repr_ta = query_repr_ta.write(time + 1, tf.where(is_stop, query_repr_ta.read(time),
+                                                                   scatter(query_repr)))
             cnn_final_dim = 10 * doc_arch[-2][-1] + 5 * query_arch[-2][-1]
             #cnn_final_dim = doc_arch[-1][0] * doc_arch[-2][-1] + query_arch[-1][0] * query_arch[-2][-1]
             dq_repr = tf.reshape(tf.concat([doc_repr, query_repr], axis=1), [-1, cnn_final_dim])
@@ -280,13 +394,14 @@ def get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, wo
         representation = tf.ones_like(location[:, :1])
     else:
         raise NotImplementedError()
-    state_ta = state_ta.write(time + 1, tf.where(is_stop, state_ta.read(time), representation))
+    state_ta = state_ta.write(time + 1, tf.where(is_stop, state_ta.read(time), scatter(representation)))
     return state_ta, doc_repr_ta, query_repr_ta
 
 
 def rri(query, doc, dq_size, max_jump_step, word_vector, interaction='dot', glimpse='fix_hard', glimpse_fix_size=None,
         min_density=None, use_ratio=False, min_jump_offset=1, jump='max_hard', represent='sum_hard', separate=False, 
-        aggregate='max', rnn_size=None, max_jump_offset=None, max_jump_offset2=None, keep_prob=1.0):
+        aggregate='max', rnn_size=None, max_jump_offset=None, max_jump_offset2=None, keep_prob=1.0,
+        docid=None, doc_repr_cache=None):
     bs = tf.shape(query)[0]
     max_q_len = tf.shape(query)[1]
     max_d_len = tf.shape(doc)[1]
@@ -296,7 +411,15 @@ def rri(query, doc, dq_size, max_jump_step, word_vector, interaction='dot', glim
         doc_emb = tf.nn.embedding_lookup(word_vector, doc)
     with vs.variable_scope('Match'):
         # match_matrix is of shape (batch_size, max_d_len, max_q_len)
-        if interaction == 'indicator':
+        match_row_splits = None
+        if interaction == 'indicator_sparse':
+            # only the matched positions are kept, as a SparseTensor and the CSR offsets of each doc position
+            if jump == 'max_hard' or represent == 'interaction_cnn_hard_resize':
+                raise ValueError('{} and {} need the dense match matrix'.format(jump, represent))
+            match_indices, match_row_splits = jumper.indicator_match(query=query, doc=doc, dq_size=dq_size)
+            match_matrix = tf.SparseTensor(match_indices, tf.ones_like(match_indices[:, 0], dtype=tf.float32),
+                                           tf.cast(tf.stack([bs, max_d_len, max_q_len]), dtype=tf.int64))
+        elif interaction == 'indicator':
             match_matrix = tf.cast(tf.equal(tf.expand_dims(doc, axis=2), tf.expand_dims(query, axis=1)),
                                    dtype=tf.float32)
         else:
@@ -306,83 +429,144 @@ def rri(query, doc, dq_size, max_jump_step, word_vector, interaction='dot', glim
                 match_matrix = tf.matmul(doc_emb, tf.transpose(query_emb, [0, 2, 1]))
                 match_matrix /= tf.expand_dims(tf.sqrt(tf.reduce_sum(doc_emb * doc_emb, axis=2)), axis=2) * \
                                 tf.expand_dims(tf.sqrt(tf.reduce_sum(query_emb * query_emb, axis=2)), axis=1)
+        # computed once and shared by the jumper ops
+        density = row_max_density(match_matrix, dq_size, row_splits=match_row_splits)
         if min_density != None:
             if use_ratio:
-                density = tf.reduce_max(match_matrix, 2)
-                mean_density = tf.reduce_mean(density, 1)
-                max_density = tf.reduce_max(density, 1)
+                # only the doc positions before d_len, the padding of the match matrix is arbitrary
+                d_mask = tf.sequence_mask(dq_size[:, 0], tf.shape(density)[1])
+                density_in_doc = tf.where(d_mask, density, tf.zeros_like(density))
+                mean_density = tf.reduce_sum(density_in_doc, 1) / \
+                    tf.cast(tf.maximum(dq_size[:, 0], 1), dtype=tf.float32)
+                max_density = tf.reduce_max(density_in_doc, 1)
                 min_density = (max_density - mean_density) * min_density + mean_density
             else:
                 min_density = tf.ones_like(dq_size[:, 0], dtype=tf.float32) * min_density
-    with vs.variable_scope('SelectiveJump'):
-        location_ta = tf.TensorArray(dtype=tf.float32, size=1, name='location_ta',
-                                     clear_after_read=False, dynamic_size=True) # (d_ind,q_ind,d_len,q_len)
-        location_ta = location_ta.write(0, tf.zeros([bs, 4])) # start from the top-left corner
-        state_ta = tf.TensorArray(dtype=tf.float32, size=1, name='state_ta', clear_after_read=False, 
-                                  dynamic_size=True)
-        query_repr_ta = tf.TensorArray(dtype=tf.float32, size=1, name='query_repr_ta', clear_after_read=False, 
-                                       dynamic_size=True)
-        doc_repr_ta = tf.TensorArray(dtype=tf.float32, size=1, name='doc_repr_ta', clear_after_read=False, 
-                                     dynamic_size=True)
-        step = tf.zeros([bs], dtype=tf.int32)
-        total_offset = tf.zeros([bs], dtype=tf.float32)
-        is_stop = tf.zeros([bs], dtype=tf.bool)
-        time = tf.constant(0)
-        def cond(time, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, location_ta, dq_size, total_offset):
-            return tf.logical_and(tf.logical_not(tf.reduce_all(is_stop)),
-                                  tf.less(time, tf.constant(max_jump_step)))
-        def body(time, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, location_ta, dq_size, total_offset):
-            cur_location = location_ta.read(time)
-            #time = tf.Print(time, [time], message='time:')
-            with vs.variable_scope('Glimpse'):
-                glimpse_location = get_glimpse_location(match_matrix, dq_size, cur_location, glimpse)
-                # stop when the start index overflow
-                new_stop = tf.reduce_any(glimpse_location[:, :2] > tf.cast(dq_size - 1, tf.float32), axis=1)
-                glimpse_location = tf.where(new_stop, cur_location, glimpse_location)
-                is_stop = tf.logical_or(is_stop, new_stop)
-            with vs.variable_scope('Jump'):
-                new_location = get_jump_location(match_matrix, dq_size, glimpse_location, jump, 
-                    min_density=min_density, min_jump_offset=min_jump_offset)
-                if max_jump_offset != None:
-                    # truncate long document offset
-                    new_location = tf.concat([new_location[:, :2],
-                                              tf.minimum(new_location[:, 2:3], max_jump_offset), 
-                                              new_location[:, 3:]], axis=1)
-                if max_jump_offset2 != None:
-                    # truncate long query offset
-                    new_location = tf.concat([new_location[:, :2],
-                                              new_location[:, 2:3], 
-                                              tf.minimum(new_location[:, 3:], max_jump_offset2)], 
-                                              axis=1)
-                # stop when the start index overflow
-                new_stop = tf.reduce_any(new_location[:, :2] > tf.cast(dq_size - 1, tf.float32), axis=1)
-                is_stop = tf.logical_or(is_stop, new_stop)
-                location_ta = location_ta.write(time + 1, tf.where(is_stop, cur_location, new_location))
-                # total length to be modeled
-                total_offset += tf.where(is_stop, tf.zeros_like(total_offset), new_location[:, 2])
-                # actual rnn length (with padding)
-                #total_offset += tf.where(is_stop, tf.zeros_like(total_offset), 
-                #    tf.ones_like(total_offset) * \
-                #    tf.reduce_max(tf.where(is_stop, tf.zeros_like(total_offset), new_location[:, 2])))
-            with vs.variable_scope('Represent'):
-                cur_next_location = location_ta.read(time + 1)
-                # location_one_out is to prevent duplicate time-consuming calculation
-                location_one_out = tf.where(is_stop, tf.ones_like(cur_location), cur_next_location)
-                state_ta, doc_repr_ta, query_repr_ta = \
-                    get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, word_vector, \
-                                       location_one_out, represent, max_jump_offset=max_jump_offset, \
-                                       max_jump_offset2=max_jump_offset2, rnn_size=rnn_size, keep_prob=keep_prob, \
-                                       separate=separate, location_ta=location_ta, state_ta=state_ta, doc_repr_ta=doc_repr_ta, \
-                                       query_repr_ta=query_repr_ta, time=time, is_stop=is_stop)
-            step = step + tf.where(is_stop, tf.zeros([bs], dtype=tf.int32), tf.ones([bs], dtype=tf.int32))
-            return time + 1, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, location_ta, dq_size, total_offset
-        _, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, location_ta, dq_size, total_offset = \
-            tf.while_loop(cond, body, [time, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, 
-                          location_ta, dq_size, total_offset], parallel_iterations=1)
+    if represent == 'sum_hard':
+        with vs.variable_scope('SummedAreaTable'):
+            # built once so that the sum of any region costs four gathers at each jump step
+            match_matrix_sat = summed_area_table(match_matrix, row_splits=match_row_splits)
+    else:
+        match_matrix_sat = None
+    if glimpse == 'all_next_hard' and jump == 'min_density_hard':
+        with vs.variable_scope('Trajectory'):
+            # the trajectory only depends on the match matrix, so all the jumps are found in one pass
+            trajectory, trajectory_step = jumper.min_density_trajectory(
+                density=density, dq_size=dq_size, min_density=min_density,
+                min_jump_offset=min_jump_offset, max_jump_step=max_jump_step,
+                max_jump_offset=max_jump_offset if max_jump_offset != None else -1.0)
+            trajectory = tf.stop_gradient(trajectory)
+            if max_jump_offset2 != None:
+                # truncate long query offset
+                trajectory = tf.concat([trajectory[:, :, :3], tf.minimum(trajectory[:, :, 3:], max_jump_offset2)],
+                                       axis=2)
+    else:
+        trajectory = None
+    time = tf.constant(0)
+    if trajectory is not None and represent == 'sum_hard':
+        with vs.variable_scope('SelectiveJump'):
+            # all the regions are summed as one batch instead of one jump step at a time
+            num_step = tf.minimum(max_jump_step, tf.reduce_max(trajectory_step) + 1)
+            trajectory = trajectory[:, :num_step]
+            step = trajectory_step
+            is_stop = tf.less(step, num_step)
+            is_active = tf.less(tf.expand_dims(tf.range(num_step), axis=0), tf.expand_dims(step, axis=1))
+            total_offset = tf.reduce_sum(tf.where(is_active, trajectory[:, :, 2], tf.zeros_like(trajectory[:, :, 2])),
+                                         axis=1)
+            start = tf.cast(tf.floor(trajectory[:, :, :2]), dtype=tf.int32)
+            end = tf.cast(tf.floor(trajectory[:, :, :2] + trajectory[:, :, 2:]), dtype=tf.int32)
+            representation = tf.transpose(region_sum(match_matrix_sat, start, end, row_splits=match_row_splits))
+            active_ratio = tf.reduce_mean(tf.cast(is_active, dtype=tf.float32), axis=0)
+            states = tf.expand_dims(tf.concat([tf.zeros([1, bs]), representation], axis=0), axis=-1)
+            location = tf.concat([tf.zeros([bs, 1, 4]), trajectory], axis=1)
+    else:
+        with vs.variable_scope('SelectiveJump'):
+            location_ta = tf.TensorArray(dtype=tf.float32, size=1, name='location_ta',
+                                         clear_after_read=False, dynamic_size=True) # (d_ind,q_ind,d_len,q_len)
+            location_ta = location_ta.write(0, tf.zeros([bs, 4])) # start from the top-left corner
+            state_ta = tf.TensorArray(dtype=tf.float32, size=1, name='state_ta', clear_after_read=False, 
+                                      dynamic_size=True)
+            query_repr_ta = tf.TensorArray(dtype=tf.float32, size=1, name='query_repr_ta', clear_after_read=False, 
+                                           dynamic_size=True)
+            doc_repr_ta = tf.TensorArray(dtype=tf.float32, size=1, name='doc_repr_ta', clear_after_read=False, 
+                                         dynamic_size=True)
+            step = tf.zeros([bs], dtype=tf.int32)
+            total_offset = tf.zeros([bs], dtype=tf.float32)
+            is_stop = tf.zeros([bs], dtype=tf.bool)
+            def cond(time, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, location_ta, dq_size, total_offset):
+                return tf.logical_and(tf.logical_not(tf.reduce_all(is_stop)),
+                                      tf.less(time, tf.constant(max_jump_step)))
+            def body(time, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, location_ta, dq_size, total_offset):
+                cur_location = location_ta.read(time)
+                #time = tf.Print(time, [time], message='time:')
+                if trajectory is not None:
+                    with vs.variable_scope('Jump'):
+                        new_location = trajectory[:, time]
+                        is_stop = tf.greater_equal(time, trajectory_step)
+                        location_ta = location_ta.write(time + 1, new_location)
+                        # total length to be modeled
+                        total_offset += tf.where(is_stop, tf.zeros_like(total_offset), new_location[:, 2])
+                else:
+                    with vs.variable_scope('Glimpse'):
+                        glimpse_location = get_glimpse_location(match_matrix, dq_size, cur_location, glimpse)
+                        # stop when the start index overflow
+                        new_stop = tf.reduce_any(glimpse_location[:, :2] > tf.cast(dq_size - 1, tf.float32), axis=1)
+                        glimpse_location = tf.where(new_stop, cur_location, glimpse_location)
+                        is_stop = tf.logical_or(is_stop, new_stop)
+                    with vs.variable_scope('Jump'):
+                        new_location = get_jump_location(match_matrix, dq_size, glimpse_location, jump, 
+                            min_density=min_density, min_jump_offset=min_jump_offset, density=density)
+                        if max_jump_offset != None:
+                            # truncate long document offset
+                            new_location = tf.concat([new_location[:, :2],
+                                                      tf.minimum(new_location[:, 2:3], max_jump_offset), 
+                                                      new_location[:, 3:]], axis=1)
+                        if max_jump_offset2 != None:
+                            # truncate long query offset
+                            new_location = tf.concat([new_location[:, :2],
+                                                      new_location[:, 2:3], 
+                                                      tf.minimum(new_location[:, 3:], max_jump_offset2)], 
+                                                      axis=1)
+                        # stop when the start index overflow
+                        new_stop = tf.reduce_any(new_location[:, :2] > tf.cast(dq_size - 1, tf.float32), axis=1)
+                        is_stop = tf.logical_or(is_stop, new_stop)
+                        location_ta = location_ta.write(time + 1, tf.where(is_stop, cur_location, new_location))
+                        # total length to be modeled
+                        total_offset += tf.where(is_stop, tf.zeros_like(total_offset), new_location[:, 2])
+                        # actual rnn length (with padding)
+                        #total_offset += tf.where(is_stop, tf.zeros_like(total_offset), 
+                        #    tf.ones_like(total_offset) * \
+                        #    tf.reduce_max(tf.where(is_stop, tf.zeros_like(total_offset), new_location[:, 2])))
+                with vs.variable_scope('Represent'):
+                    cur_next_location = location_ta.read(time + 1)
+                    # location_one_out is to prevent duplicate time-consuming calculation
+                    location_one_out = tf.where(is_stop, tf.ones_like(cur_location), cur_next_location)
+                    if represent in {'rnn_hard', 'cnn_hard', 'interaction_cnn_hard', 'interaction_cnn_hard_resize'}:
+                        # gather the samples not stopped instead of representing the whole batch
+                        active = tf.cast(tf.where(tf.logical_not(is_stop))[:, 0], dtype=tf.int32)
+                        # keep one sample when all are stopped so that the shapes stay valid
+                        active = tf.cond(tf.size(active) > 0, lambda: active, lambda: tf.zeros([1], dtype=tf.int32))
+                    else:
+                        active = None
+                    state_ta, doc_repr_ta, query_repr_ta = \
+                        get_representation(match_matrix, dq_size, query, query_emb, doc, doc_emb, word_vector, \
+                                           location_one_out, represent, max_jump_offset=max_jump_offset, \
+                                           max_jump_offset2=max_jump_offset2, rnn_size=rnn_size, keep_prob=keep_prob, \
+                                           separate=separate, location_ta=location_ta, state_ta=state_ta, doc_repr_ta=doc_repr_ta, \
+                                           query_repr_ta=query_repr_ta, time=time, is_stop=is_stop, \
+                                           match_matrix_sat=match_matrix_sat, match_row_splits=match_row_splits, \
+                                           docid=docid, doc_repr_cache=doc_repr_cache, active=active)
+                step = step + tf.where(is_stop, tf.zeros([bs], dtype=tf.int32), tf.ones([bs], dtype=tf.int32))
+                return time + 1, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, location_ta, dq_size, total_offset
+            num_iter, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, location_ta, dq_size, total_offset = \
+                tf.while_loop(cond, body, [time, is_stop, step, state_ta, doc_repr_ta, query_repr_ta, 
+                              location_ta, dq_size, total_offset], parallel_iterations=1)
+            states = state_ta.stack()
+            location = tf.transpose(location_ta.stack(), [1, 0, 2])
+            # is_stop never turns back, so the samples active at iteration t are those with more than t steps
+            active_ratio = tf.reduce_mean(tf.cast(tf.less(tf.expand_dims(tf.range(num_iter), axis=1),
+                                                          tf.expand_dims(step, axis=0)), dtype=tf.float32), axis=1)
     with vs.variable_scope('Aggregate'):
-        states = state_ta.stack()
-        location = location_ta.stack()
-        location = tf.transpose(location, [1, 0 ,2])
         stop_ratio = tf.reduce_mean(tf.cast(is_stop, tf.float32))
         complete_ratio = tf.reduce_mean(tf.reduce_min(
             [(location[:, -1, 0] + location[:, -1, 2]) / tf.cast(dq_size[:, 0], dtype=tf.float32),
@@ -417,4 +601,4 @@ def rri(query, doc, dq_size, max_jump_step, word_vector, interaction='dot', glim
                 signal = tf.reshape(concat_repr, [bs, 200])
         return signal, {'step': step, 'location': location, 'match_matrix': match_matrix, 
                         'complete_ratio': complete_ratio, 'is_stop': is_stop, 'stop_ratio': stop_ratio,
-                        'doc_emb': doc_emb, 'total_offset': total_offset}
\ No newline at end of file
+                        'doc_emb': doc_emb, 'total_offset': total_offset, 'active_ratio': active_ratio}
\ No newline at end of file
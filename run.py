@@ -1,4 +1,4 @@
-import argparse, logging, os, random, time, json, functools
+import argparse, logging, os, random, time, json, functools, hashlib
 from itertools import groupby
 import numpy as np
 from sklearn.base import BaseEstimator, ClassifierMixin
@@ -7,6 +7,7 @@ from utils import Vocab, WordVector, load_prep_file, load_train_test_file, print
 from metric import evaluate, ndcg
 from rri import rri
 from cnn import DynamicMaxPooling
+from cache import MatchMatrixCache, DocReprCache
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='run')
@@ -27,6 +28,12 @@ if __name__ == '__main__':
         action='store_true')
     parser.add_argument('-p', '--paradigm', help='learning to rank paradigm', type=str, 
         default='pointwise')
+    parser.add_argument('--bucket_width', help='batch the docs by length buckets of this width \
+        (both the batcher and tfrecord)', type=int, default=None)
+    parser.add_argument('--match_cache', help='path prefix of the on-disk match matrix cache \
+        (only valid when word vectors are not trained)', type=str, default=None)
+    parser.add_argument('--doc_repr_cache', help='how many doc regions whose cnn_hard representations \
+        are cached when scoring', type=int, default=None)
     args = parser.parse_args()
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -53,12 +60,25 @@ def data_pad(samples, max_len, dtype=None):
     return np.array([s + [0] * (max_len - len(s)) for s in samples], dtype=dtype)
 
 
-def data_assemble(filepath, query_raw, doc_raw, max_q_len, max_d_len, relevance_mapper=None):
+def data_assemble(filepath, query_raw, doc_raw, max_q_len, max_d_len, relevance_mapper=None, bucket_width=None):
     relevance_mapper = relevance_mapper or (lambda x: x)
     samples = load_train_test_file(filepath, file_format=args.format, reverse=args.reverse)
     samples_gb_q = groupby(samples, lambda x: x[0]) # queries should be sorted
     X = []
     y = []
+    # the two docs of a pair must be in the same batch
+    unit_size = 2 if filepath.endswith('pairwise') else 1
+    def make_batch(result, with_relevance):
+        yield_result = {
+            'qd_size': np.array(result['qd_size'], dtype=np.int32),
+        }
+        if with_relevance:
+            yield_result['relevance'] = np.array(result['relevance'], dtype=np.int32)
+        yield_result['query'] = data_pad(result['query'], np.max(yield_result['qd_size'][:, 0]), np.int32)
+        yield_result['doc'] = data_pad(result['doc'], np.max(yield_result['qd_size'][:, 1]), np.int32)
+        yield_result['qid'] = np.array(result['qid'], dtype=str)
+        yield_result['docid'] = np.array(result['docid'], dtype=str)
+        return yield_result
     def batcher(X, y=None, batch_size=128, use_permutation=True, batch_num=None):
         rb = batch_size
         result = {
@@ -98,16 +118,7 @@ def data_assemble(filepath, query_raw, doc_raw, max_q_len, max_d_len, relevance_
                 doc_ind = 0
             if rb == 0 or (len(result['qd_size']) > 0 and query_ind >= len(X)):
                 # return batch
-                yield_result = {
-                    'qd_size': np.array(result['qd_size'], dtype=np.int32),
-                }
-                if q_y != None:
-                    yield_result['relevance'] = np.array(result['relevance'], dtype=np.int32)
-                yield_result['query'] = data_pad(result['query'], np.max(yield_result['qd_size'][:, 0]),
-                                           np.int32)
-                yield_result['doc'] = data_pad(result['doc'], np.max(yield_result['qd_size'][:, 1]), np.int32)
-                yield_result['qid'] = np.array(result['qid'], dtype=str)
-                yield_result['docid'] = np.array(result['docid'], dtype=str)
+                yield_result = make_batch(result, q_y != None)
                 #print('qid: {}'.format(list(zip(range(len(result['qid'])), result['qid']))))
                 #print('docid: {}'.format(list(zip(range(len(result['docid'])), result['docid']))))
                 total_batch_num += 1
@@ -125,6 +136,52 @@ def data_assemble(filepath, query_raw, doc_raw, max_q_len, max_d_len, relevance_
                     'query': [],
                     'doc': [],
                 }
+    def bucket_batcher(X, y=None, batch_size=128, use_permutation=True, batch_num=None):
+        '''
+        batches of the samples whose doc lengths fall in the same bucket of width bucket_width, so that
+        a long doc only pads the batches of its bucket. Inside a bucket the samples of a query stay together.
+        '''
+        if use_permutation:
+            # permutation wrt query
+            perm = np.random.permutation(len(X))
+        else:
+            perm = list(range(len(X)))
+        buckets = {}
+        for q in perm:
+            for d in range(0, len(X[q]['query']), unit_size):
+                d_len = max([qd[1] for qd in X[q]['qd_size'][d:d + unit_size]])
+                buckets.setdefault(d_len // bucket_width, []).append((q, d))
+        batches = []
+        for b in sorted(buckets):
+            units = buckets[b]
+            batches.extend([units[i:i + batch_size // unit_size]
+                            for i in range(0, len(units), batch_size // unit_size)])
+        if use_permutation:
+            # don't train bucket by bucket
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        if batch_num:
+            # end the batcher without traverse all the samples
+            batches = batches[:batch_num]
+        start_time = time.time()
+        for units in batches:
+            result = {
+                'qid': [],
+                'docid': [],
+                'qd_size': [],
+                'relevance': [],
+                'query': [],
+                'doc': [],
+            }
+            for q, d in units:
+                for s in range(d, d + unit_size):
+                    for k in ['qid', 'docid', 'qd_size', 'query', 'doc']:
+                        result[k].append(X[q][k][s])
+                    if y != None:
+                        result['relevance'].append(y[q]['relevance'][s])
+            yield make_batch(result, y != None), time.time() - start_time
+            start_time = time.time()
+    if bucket_width != None:
+        batcher = bucket_batcher
     if filepath.endswith('pointwise'):
         for q, q_samples in samples_gb_q:
             q_x = {
@@ -185,13 +242,13 @@ def data_assemble(filepath, query_raw, doc_raw, max_q_len, max_d_len, relevance_
                     dm2 = dm
                     q_x['docid'].append(s[2])
                     q_x['docid'].append(s[1])
-                    q_y['relevance'].append(-s[2])
-                    q_y['relevance'].append(-s[2])
+                    q_y['relevance'].append(-s[3])
+                    q_y['relevance'].append(-s[3])
                 else:
                     q_x['docid'].append(s[1])
                     q_x['docid'].append(s[2])
-                    q_y['relevance'].append(s[2])
-                    q_y['relevance'].append(s[2])
+                    q_y['relevance'].append(s[3])
+                    q_y['relevance'].append(s[3])
                 q_x['doc'].append(dm1)
                 q_x['doc'].append(dm2)
                 q_x['qd_size'].append([len(qm), len(dm1)])
@@ -217,7 +274,8 @@ class RRI(object):
                  max_jump_offset=None, max_jump_offset2=None, rel_level=2, loss_func='regression', keep_prob=1.0, 
                  paradigm='pointwise', learning_rate=0.1, random_seed=0, 
                  n_epochs=100, batch_size=100, batch_num=None, batcher=None, verbose=1, save_epochs=None, reuse_model=None, 
-                 save_model=None, summary_path=None, tfrecord=False):
+                 save_model=None, summary_path=None, tfrecord=False, bucket_width=None, match_cache=None,
+                 doc_repr_cache=None):
         self.max_q_len = max_q_len
         self.max_d_len = max_d_len
         self.max_jump_step = max_jump_step
@@ -255,6 +313,9 @@ class RRI(object):
         self.save_model = save_model
         self.summary_path = summary_path
         self.tfrecord = tfrecord
+        self.bucket_width = bucket_width
+        self.match_cache = match_cache
+        self.doc_repr_cache = doc_repr_cache
 
 
     @staticmethod
@@ -332,6 +393,8 @@ class RRI(object):
                 self.qd_size = tf.placeholder(tf.int32, shape=[None, 2], name='query_doc_size')
                 # relevance signal (only useful when using pointwise)
                 self.relevance = tf.placeholder(tf.int32, shape=[None], name='relevance')
+                # doc id (only useful when using doc_repr_cache)
+                self.docid = tf.placeholder(tf.string, shape=[None], name='docid')
             else:
                 '''
                 dataset transformation function
@@ -346,7 +409,14 @@ class RRI(object):
                     dataset = dataset.prefetch(256)
                     if is_train:
                         dataset = dataset.shuffle(buffer_size=1)
-                    dataset = dataset.padded_batch(self.batch_size, padded_shapes=dataset.output_shapes)
+                    if self.bucket_width != None:
+                        # batches of docs of similar lengths (the last dimension of doc)
+                        boundaries = list(range(self.bucket_width, self.max_d_len + 1, self.bucket_width))
+                        dataset = dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+                            lambda query, doc, qd_size, relevance: tf.shape(doc)[-1], boundaries,
+                            [self.batch_size] * (len(boundaries) + 1), padded_shapes=dataset.output_shapes))
+                    else:
+                        dataset = dataset.padded_batch(self.batch_size, padded_shapes=dataset.output_shapes)
                     return dataset
                 if self.paradigm == 'pointwise':
                     parse_fn = RRI.parse_tfexample_fn_pointwise
@@ -405,7 +475,9 @@ class RRI(object):
                     min_jump_offset=self.min_jump_offset, max_jump_offset2=self.max_jump_offset2,
                      jump=self.jump, represent=self.represent, 
                     separate=self.separate, aggregate=self.aggregate, rnn_size=self.rnn_size, 
-                    max_jump_offset=self.max_jump_offset, keep_prob=self.keep_prob_)
+                    max_jump_offset=self.max_jump_offset, keep_prob=self.keep_prob_,
+                    docid=self.docid if self.doc_repr_cache != None else None,
+                    doc_repr_cache=self.doc_repr_cache_ if self.doc_repr_cache != None else None)
         if self.loss_func == 'classification':
             with vs.variable_scope('ClassificationLoss'):
                 logit_w = tf.get_variable('logit_weight', shape=[self.outputs.get_shape()[1], self.rel_level])
@@ -449,11 +521,42 @@ class RRI(object):
             self.loss_func = 'pairwise_margin'
         if self.loss_func not in {'classification', 'regression', 'pairwise_margin'}:
             raise ValueError('loss_func not supported')
+        if self.match_cache != None:
+            if self.word_vector_trainable:
+                raise ValueError('match_cache is only valid when word vectors are not trained')
+            if self.tfrecord or self.interaction == 'indicator_sparse':
+                raise ValueError('match_cache needs the batcher and the dense match matrix')
+            if not hasattr(self, 'match_cache_'):
+                # everything that changes the match matrix of a pair
+                config = {
+                    'interaction': self.interaction,
+                    'word_vector': hashlib.md5(np.ascontiguousarray(self.word_vector).tobytes()).hexdigest(),
+                    'use_pad_word': self.use_pad_word,
+                    'max_q_len': self.max_q_len,
+                    'max_d_len': self.max_d_len,
+                    'format': args.format,
+                    'reverse': args.reverse,
+                }
+                self.match_cache_ = MatchMatrixCache(self.match_cache, config=config)
+        if self.doc_repr_cache != None:
+            if self.represent != 'cnn_hard':
+                raise ValueError('doc_repr_cache is only valid when cnn_hard is used')
+            if self.tfrecord:
+                raise ValueError('doc_repr_cache needs the batcher')
+            if not hasattr(self, 'doc_repr_cache_'):
+                self.doc_repr_cache_ = DocReprCache(self.doc_repr_cache)
 
 
     def feed_dict_postprocess(self, fd, is_train=True):
         feed_dict = {self.query: fd['query'], self.doc: fd['doc'], self.qd_size: fd['qd_size'],
                      self.relevance: fd['relevance']}
+        if self.doc_repr_cache != None:
+            feed_dict[self.docid] = fd['docid']
+        if self.match_cache != None:
+            # feeding the match matrix skips the embedding lookup and the matching
+            match_matrix = self.match_cache_.get_batch(fd)
+            if match_matrix is not None:
+                feed_dict[self.rri_info['match_matrix']] = match_matrix
         if is_train:
             feed_dict[self.keep_prob_] = self.keep_prob
         else:
@@ -461,6 +564,17 @@ class RRI(object):
         return feed_dict
 
 
+    def run_with_match_cache(self, fetch, fd, feed_dict, **kwargs):
+        '''
+        session run that saves the match matrices of the batch when they are not fed from the cache
+        '''
+        if self.match_cache == None or self.rri_info['match_matrix'] in feed_dict:
+            return self.session_.run(fetch, feed_dict=feed_dict, **kwargs)
+        result = self.session_.run(fetch + [self.rri_info['match_matrix']], feed_dict=feed_dict, **kwargs)
+        self.match_cache_.put_batch(fd, result[-1])
+        return result[:-1]
+
+
     def fit_iterable_tfrecord(self, train_file_pattern):
         # check params
         self.check_params()
@@ -526,18 +640,26 @@ class RRI(object):
             epoch += 1
             start = time.time()
             feed_time_all = 0
-            loss_list, com_r_list, stop_r_list, total_offset_list, step_list = [], [], [], [], []
+            if self.match_cache != None:
+                self.match_cache_.hit, self.match_cache_.miss = 0, 0
+            if self.doc_repr_cache != None:
+                # doc representations become stale once the CNN weights are updated
+                self.doc_repr_cache_.clear()
+            loss_list, com_r_list, stop_r_list, total_offset_list, step_list, active_r_list = [], [], [], [], [], []
+            doc_len_all, doc_pad_len_all = 0, 0
             for i, (fd, feed_time) in enumerate(self.batcher(X, y, self.batch_size, use_permutation=True, batch_num=self.batch_num)):
                 feed_time_all += feed_time
                 batch_size = len(fd['query'])
+                doc_len_all += np.sum(fd['qd_size'][:, 1])
+                doc_pad_len_all += fd['doc'].size
                 fetch = [self.rri_info['step'], self.rri_info['location'], self.rri_info['match_matrix'],
                          self.loss, self.rri_info['complete_ratio'], self.rri_info['is_stop'], self.rri_info['stop_ratio'], 
-                         self.rri_info['total_offset'], self.trainer]
+                         self.rri_info['total_offset'], self.rri_info['active_ratio'], self.trainer]
                 feed_dict = self.feed_dict_postprocess(fd, is_train=True)
                 start_time = time.time()
                 if self.summary_path != None and i % 1 == 0: # run statistics
-                    step, location, match_matrix, loss, com_r, is_stop, stop_r, total_offset, _ = \
-                        self.session_.run(fetch, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+                    step, location, match_matrix, loss, com_r, is_stop, stop_r, total_offset, active_r, _ = \
+                        self.run_with_match_cache(fetch, fd, feed_dict, options=run_options, run_metadata=run_metadata)
                     end_time = time.time()
                     self.train_writer.add_run_metadata(run_metadata, 'step%d' % i)
                     print('adding run metadata for {}'.format(i))
@@ -556,12 +678,13 @@ class RRI(object):
                         trace_file.write(trace.generate_chrome_trace_format())
                     print('profile run metadata for {}'.format(i))
                 else:
-                    step, location, match_matrix, loss, com_r, is_stop, stop_r, total_offset, _ = \
-                        self.session_.run(fetch, feed_dict=feed_dict)
+                    step, location, match_matrix, loss, com_r, is_stop, stop_r, total_offset, active_r, _ = \
+                        self.run_with_match_cache(fetch, fd, feed_dict)
                     end_time = time.time()
                 loss_list.append(loss)
                 com_r_list.append(com_r)
                 stop_r_list.append(stop_r)
+                active_r_list.append(np.mean(active_r))
                 [total_offset_list.append(to) for to in total_offset]
                 [step_list.append(st) for st in step]
                 if self.verbose >= 2:
@@ -596,7 +719,14 @@ class RRI(object):
                                 fd['qd_size'][b], step[b], is_stop[b], total_offset[b]))
                             print('qid: {}, docid: {}'.format(fd['qid'][b], fd['docid'][b]))
                             print(location[b, :step[b]+1])
-                            print(np.max(match_matrix[b][:fd['qd_size'][b, 1], :fd['qd_size'][b, 0]], axis=1))
+                            if isinstance(match_matrix, tf.SparseTensorValue):
+                                # "indicator_sparse" interaction only keeps the matches
+                                match_b = np.zeros(match_matrix.dense_shape[1:])
+                                ind_b = match_matrix.indices[match_matrix.indices[:, 0] == b]
+                                match_b[ind_b[:, 1], ind_b[:, 2]] = 1
+                            else:
+                                match_b = match_matrix[b]
+                            print(np.max(match_b[:fd['qd_size'][b, 1], :fd['qd_size'][b, 0]], axis=1))
                             bcont = input('break? y for yes:')
                             if bcont == 'y':
                                 break
@@ -605,6 +735,12 @@ class RRI(object):
                       .format('EPO[{}_{:>3.1f}_{:>3.1f}]'.format(epoch, (time.time() - start) / 60, feed_time_all/60),
                               'train', np.mean(loss_list), np.mean(stop_r_list), 
                               np.mean(total_offset_list), np.mean(step_list)), end='', flush=True)
+                # ratio of the doc positions that are padding
+                print('\tpad:{:>5.3f}'.format(1 - doc_len_all / max(doc_pad_len_all, 1)), end='', flush=True)
+                # ratio of the samples still active at each jump step
+                print('\tactive:{:>5.3f}'.format(np.mean(active_r_list)), end='', flush=True)
+                if self.match_cache != None:
+                    print('\tcache:{:>5.3f}'.format(self.match_cache_.hit_rate()), end='', flush=True)
             if self.save_epochs and epoch % self.save_epochs == 0:  # save the model
                 if self.save_model:
                     self.saver.save(self.session_, self.save_model)
@@ -627,10 +763,10 @@ class RRI(object):
         for i, (fd, feed_time) in enumerate(self.batcher(X, y, self.batch_size, use_permutation=False)):
             feed_dict = self.feed_dict_postprocess(fd, is_train=False)
             if self.loss_func in {'classification', 'pairwise_margin'}:
-                loss, _, acc = self.session_.run([self.loss, self.acc_op, self.acc], feed_dict=feed_dict)
+                loss, _, acc = self.run_with_match_cache([self.loss, self.acc_op, self.acc], fd, feed_dict)
                 acc_list.append(acc)
             else:
-                loss, = self.session_.run([self.loss], feed_dict=feed_dict)
+                loss, = self.run_with_match_cache([self.loss], fd, feed_dict)
             loss_list.append(loss)
         return np.mean(loss_list), np.mean(acc_list)
 
@@ -640,6 +776,10 @@ class RRI(object):
         if not hasattr(self, 'session_'):
             raise AttributeError('need fit or fit_iterable to be called before prediction')
         q_list, doc_list, score_list, loss_list = [], [], [], []
+        if self.doc_repr_cache != None:
+            # the weights are frozen when scoring
+            self.doc_repr_cache_.enabled = True
+            self.doc_repr_cache_.hit, self.doc_repr_cache_.miss = 0, 0
         for i, (fd, feed_time) in enumerate(self.batcher(X, None, self.batch_size, use_permutation=False)):
             fd['relevance'] = np.ones([fd['query'].shape[0]], dtype=np.int32) * (self.rel_level - 1)
             feed_dict = self.feed_dict_postprocess(fd, is_train=False)
@@ -647,17 +787,19 @@ class RRI(object):
                 if self.rel_level != 2:
                     raise Exception('prediction under classification loss function with >2 \
                         relevance level is not support')
-                losses, = self.session_.run([self.losses], feed_dict=feed_dict)
+                losses, = self.run_with_match_cache([self.losses], fd, feed_dict)
                 [loss_list.append(l) for l in losses]
                 [score_list.append(-l) for l in losses]
                 [q_list.append(q) for q in fd['qid']]
                 [doc_list.append(d) for d in fd['docid']]
             elif self.loss_func in {'regression', 'pairwise_margin'}:
-                scores, loss, = self.session_.run([self.scores, self.loss], feed_dict=feed_dict)
+                scores, loss, = self.run_with_match_cache([self.scores, self.loss], fd, feed_dict)
                 loss_list.append(loss)
                 [score_list.append(s) for s in scores]
                 [q_list.append(q) for q in fd['qid']]
                 [doc_list.append(d) for d in fd['docid']]
+        if self.doc_repr_cache != None:
+            self.doc_repr_cache_.enabled = False
         ranks = {}
         for q, dl in groupby(sorted(zip(q_list, doc_list, score_list), key=lambda x: x[0]), lambda x: x[0]):
             dl = sorted(dl, key=lambda x: -x[2])
@@ -726,7 +868,7 @@ def train_test():
                 return rel_level - 1
             return r
         train_X, train_y, batcher = data_assemble(train_file, query_raw, doc_raw, max_q_len, max_d_len, 
-                                                  relevance_mapper=relevance_mapper)
+                                                  relevance_mapper=relevance_mapper, bucket_width=args.bucket_width)
         '''
         doc_len_list = []
         for q_x in train_X:
@@ -804,6 +946,9 @@ def train_test():
         'save_model': args.save_model_path, 
         'summary_path': args.tf_summary_path,
         'tfrecord': args.tfrecord,
+        'bucket_width': args.bucket_width,
+        'match_cache': args.match_cache,
+        'doc_repr_cache': args.doc_repr_cache,
     }
     if args.config != None:
         model_config_.update(model_config)
@@ -823,6 +968,8 @@ def train_test():
             print('\t{:>7}:{:>5.3f}:{:>5.3f}:{:>5.3f}'
                 .format('test_{:>3.1f}'.format((time.time()-start)/60), 
                     loss, acc, avg_score), end='', flush=True)
+            if rri.doc_repr_cache != None:
+                print('\trepr cache:{:>5.3f}'.format(rri.doc_repr_cache_.hit_rate()), end='', flush=True)
     else:
         for e in rri.fit_iterable_tfrecord('data/bing/test.prep.pairwise.tfrecord-???-of-???'):
             print(e)